@@ -1,288 +1,480 @@
-from flask import Flask, render_template, jsonify, request
-import firebase_admin
-from firebase_admin import credentials, db
+from flask import Flask, Response, g, get_template_attribute, make_response, render_template, jsonify, request
+import atexit
+import bisect
+import click
+import collections
+import csv
 import datetime
-import random
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import math
+import os
+import queue
+import re
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+
+import metrics
+from storage import create_storage
+
+try:
+    import orjson
+except ImportError:  # /data payloads fall back to the standard json encoder
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # /sensor_data then only accepts JSON and binary frames
+    msgpack = None
+
+try:
+    import fcntl
+except ImportError:  # Windows has no pre-forking servers, so the ingest lock is not needed
+    fcntl = None
+
+# Module setup time (storage, caches, routes) is reported on /health
+APP_LOAD_STARTED = time.perf_counter()
 
 # ---------- FLASK APP ----------
 app = Flask(__name__)
 
-# ---------- FIREBASE CONFIG ----------
-# Replace with your Firebase service account key file and DB URL
-try:
-    cred = credentials.Certificate("firebase_config.json")
-    firebase_admin.initialize_app(cred, {
-        'databaseURL': 'https://project-2625a-default-rtdb.firebaseio.com/'
-    })
-    firebase_initialized = True
-    print("Firebase initialized successfully")
-except Exception as e:
-    print(f"Firebase initialization failed: {e}")
-    firebase_initialized = False
+# ---------- STORAGE CONFIG ----------
+# "firebase" (default), "sqlite" for a local embedded store, or "mirrored" to
+# serve reads locally while writing through to Firebase as well.
+# Set FIREBASE_CREDENTIALS / FIREBASE_DATABASE_URL / SQLITE_PATH to override paths.
+# Firebase is initialized on first use and retried in the background if that fails.
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "firebase")
+storage = create_storage(STORAGE_BACKEND)
+
+
+# ---------- INSTRUMENTATION ----------
+# Route, storage and hot-function latencies are exposed on /metrics in the
+# Prometheus text format. PROFILER_ENABLED=1 adds /debug/profile, which samples
+# every thread's stack for a few seconds and returns the hottest ones.
+
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "0") == "1"
+PROFILER_MAX_SECONDS = float(os.environ.get("PROFILER_MAX_SECONDS", "30"))
+
+REQUEST_LATENCY = metrics.REGISTRY.histogram(
+    "hydroai_http_request_duration_seconds", "Time spent handling a request",
+    ("route", "method"))
+REQUESTS = metrics.REGISTRY.counter(
+    "hydroai_http_requests_total", "Requests handled", ("route", "method", "status"))
+REQUEST_ERRORS = metrics.REGISTRY.counter(
+    "hydroai_http_request_errors_total", "Requests answered with a 5xx status", ("route", "method"))
+STAGE_LATENCY = metrics.REGISTRY.histogram(
+    "hydroai_stage_duration_seconds", "Time spent in data access functions and rendering steps",
+    ("stage",))
 
 
 # ---------- ENHANCED WATER QUALITY FUNCTIONS ----------
 
+TDS_QUALITY_THRESHOLDS = (50, 150, 250, 350, 500, 900)
+
+# Band 0 is "No Data"; band i > 0 is the i-th interval cut by TDS_QUALITY_THRESHOLDS
+TDS_QUALITY_BANDS = tuple(MappingProxyType(band) for band in (
+    {
+        "level": "No Data",
+        "class": "no-data",
+        "description": "No sensor data available",
+        "drinking_safety": "Cannot assess without data",
+        "health_impact": "Unknown - connect sensors",
+        "usage": "Not determinable",
+        "risk_level": "Unknown"
+    },
+    {
+        "level": "Ultra Pure",
+        "class": "ultra-pure",
+        "description": "Extremely pure demineralized water",
+        "drinking_safety": "Not ideal for regular drinking - lacks essential minerals",
+        "health_impact": "May leach minerals from body with long-term consumption",
+        "usage": "Laboratory use, specific medical applications, batteries",
+        "risk_level": "Low"
+    },
+    {
+        "level": "Excellent",
+        "class": "excellent",
+        "description": "Ideal mineralized drinking water",
+        "drinking_safety": "Perfect for drinking and cooking",
+        "health_impact": "Contains beneficial minerals like calcium and magnesium",
+        "usage": "Drinking, cooking, baby formula, brewing coffee/tea",
+        "risk_level": "Very Low"
+    },
+    {
+        "level": "Good",
+        "class": "good",
+        "description": "Good quality potable water",
+        "drinking_safety": "Safe for drinking and domestic use",
+        "health_impact": "Adequate mineral content for daily consumption",
+        "usage": "General drinking, cooking, bathing, gardening",
+        "risk_level": "Low"
+    },
+    {
+        "level": "Fair",
+        "class": "fair",
+        "description": "Acceptable quality with some impurities",
+        "drinking_safety": "Generally safe with filtration recommended",
+        "health_impact": "May contain elevated levels of certain minerals",
+        "usage": "Domestic use with filtration, gardening, cleaning",
+        "risk_level": "Moderate"
+    },
+    {
+        "level": "Poor",
+        "class": "poor",
+        "description": "Low quality water with significant impurities",
+        "drinking_safety": "Not recommended without treatment",
+        "health_impact": "May cause digestive issues with prolonged consumption",
+        "usage": "Limited domestic use, toilet flushing, irrigation",
+        "risk_level": "High"
+    },
+    {
+        "level": "Unacceptable",
+        "class": "unacceptable",
+        "description": "Highly contaminated water",
+        "drinking_safety": "Not safe for drinking - treatment required",
+        "health_impact": "Risk of gastrointestinal diseases and other health issues",
+        "usage": "Industrial use only, construction, firefighting",
+        "risk_level": "Very High"
+    },
+    {
+        "level": "Hazardous",
+        "class": "hazardous",
+        "description": "Severely contaminated - immediate action required",
+        "drinking_safety": "Dangerous to health - avoid all contact",
+        "health_impact": "Serious health risks including poisoning and disease",
+        "usage": "Not recommended for any use without treatment",
+        "risk_level": "Critical"
+    }
+))
+
+TEMPERATURE_THRESHOLDS = (5, 15, 25, 35, 50)
+
+# Band 0 is "no data", then one band per interval cut by TEMPERATURE_THRESHOLDS
+TEMPERATURE_RECOMMENDATION_BANDS = (
+    (
+        "No temperature data available",
+        "Connect temperature sensor for complete analysis"
+    ),
+    (
+        "🚫 Water is very cold - may affect digestion",
+        "⚠️ Consider warming to room temperature before drinking",
+        "❄️ Cold water may constrict blood vessels temporarily",
+        "💧 Ideal for refrigeration and cold storage"
+    ),
+    (
+        "✅ Cool water - refreshing for drinking",
+        "👍 Ideal temperature for water storage",
+        "⚡ Good for metabolic functions and hydration",
+        "🌡️ Perfect temperature for athletic activities"
+    ),
+    (
+        "✅ Room temperature - ideal for drinking",
+        "👍 Best for hydration and digestion",
+        "⚡ Optimal for nutrient absorption",
+        "💫 Most comfortable for daily consumption"
+    ),
+    (
+        "⚠️ Slightly warm - pleasant for drinking in cold weather",
+        "🔍 Monitor water source for bacterial growth",
+        "⏰ Not ideal for long-term storage",
+        "🌡️ Good for digestion and metabolism"
+    ),
+    (
+        "🚨 Warm water - potential contamination risk",
+        "🔍 Check water source and storage conditions",
+        "⏰ Immediate consumption recommended",
+        "🦠 May promote bacterial growth if stored"
+    ),
+    (
+        "🚨 CRITICAL: Hot water - high contamination risk",
+        "🆘 Immediate testing and investigation required",
+        "🔧 Check for equipment malfunction",
+        "🚱 Avoid consumption until verified safe"
+    )
+)
+
+IMPROVEMENT_TDS_THRESHOLDS = (50, 250, 500, 900)
+
+IMPROVEMENT_TDS_SUGGESTIONS = (
+    (
+        "🔌 Connect water quality sensors",
+        "📊 Enable data collection system",
+        "🔄 Check sensor connections and power"
+    ),
+    (
+        "💎 Add mineral supplements for drinking water",
+        "🔄 Consider remineralization filter system",
+        "🚰 Mix with natural mineral water for drinking",
+        "📈 Monitor mineral levels regularly"
+    ),
+    (
+        "✅ Maintain current filtration system",
+        "📅 Regular quarterly water testing recommended",
+        "👀 Monitor for sudden TDS changes",
+        "💧 Continue good water storage practices"
+    ),
+    (
+        "🔄 Install RO water purification system",
+        "⚡ Use activated carbon filters",
+        "🔦 Consider UV purification for bacteria",
+        "📋 Test for specific contaminants (lead, arsenic)",
+        "💡 Improve source water protection"
+    ),
+    (
+        "🚨 IMMEDIATE: Install RO purification system",
+        "🆘 Use bottled water for drinking and cooking",
+        "📞 Professional water testing needed immediately",
+        "🔧 Check plumbing system for contamination sources",
+        "💧 Install whole-house filtration system"
+    ),
+    (
+        "🆘 CRITICAL: USE BOTTLED WATER IMMEDIATELY",
+        "📞 Contact water quality authorities immediately",
+        "🔧 Professional remediation required",
+        "🧪 Comprehensive water testing essential",
+        "🏠 Consider alternative water sources"
+    )
+)
+
+# No temperature advice, too warm (> 35), too cold (< 10)
+IMPROVEMENT_TEMPERATURE_SUGGESTIONS = (
+    (),
+    (
+        "🌡️ Store water in cool, dark place",
+        "🧊 Use insulated water containers",
+        "🔍 Monitor for bacterial growth regularly",
+        "⏰ Reduce water storage time"
+    ),
+    (
+        "☕ Allow water to reach room temperature before drinking",
+        "🏠 Check for pipe insulation issues",
+        "💧 Consider water heating options",
+        "🌡️ Monitor for freezing in cold weather"
+    )
+)
+
+GENERAL_SUGGESTIONS = (
+    "📊 Regular monitoring with this dashboard",
+    "📝 Maintain water quality log",
+    "🔔 Set up alerts for quality changes",
+    "🌱 Consider environmental factors affecting water source"
+)
+
+
+def is_missing(value):
+    """Readings of 0, '-', empty or NaN mean the sensor reported nothing"""
+    return value is None or value == 0 or value == '-' or value == '' or value != value
+
+
+def tds_quality_band(tds_value):
+    """Index into TDS_QUALITY_BANDS for a single TDS value"""
+    if is_missing(tds_value):
+        return 0
+    return bisect.bisect_right(TDS_QUALITY_THRESHOLDS, tds_value) + 1
+
+
+def temperature_band(temperature):
+    """Index into TEMPERATURE_RECOMMENDATION_BANDS for a single temperature"""
+    if is_missing(temperature):
+        return 0
+    return bisect.bisect_right(TEMPERATURE_THRESHOLDS, temperature) + 1
+
+
+def improvement_tds_band(tds_value):
+    """Index into IMPROVEMENT_TDS_SUGGESTIONS for a single TDS value"""
+    if is_missing(tds_value):
+        return 0
+    return bisect.bisect_right(IMPROVEMENT_TDS_THRESHOLDS, tds_value) + 1
+
+
+def improvement_temperature_band(temperature):
+    """Index into IMPROVEMENT_TEMPERATURE_SUGGESTIONS for a single temperature"""
+    if is_missing(temperature):
+        return 0
+    if temperature > 35:
+        return 1
+    if temperature < 10:
+        return 2
+    return 0
+
+
 def get_tds_quality_details(tds_value):
     """Get detailed quality information based on TDS level"""
-    if tds_value == 0 or tds_value == '-':
-        return {
-            "level": "No Data",
-            "class": "no-data",
-            "description": "No sensor data available",
-            "drinking_safety": "Cannot assess without data",
-            "health_impact": "Unknown - connect sensors",
-            "usage": "Not determinable",
-            "risk_level": "Unknown"
-        }
-    elif tds_value < 50:
-        return {
-            "level": "Ultra Pure",
-            "class": "ultra-pure",
-            "description": "Extremely pure demineralized water",
-            "drinking_safety": "Not ideal for regular drinking - lacks essential minerals",
-            "health_impact": "May leach minerals from body with long-term consumption",
-            "usage": "Laboratory use, specific medical applications, batteries",
-            "risk_level": "Low"
-        }
-    elif tds_value < 150:
-        return {
-            "level": "Excellent",
-            "class": "excellent",
-            "description": "Ideal mineralized drinking water",
-            "drinking_safety": "Perfect for drinking and cooking",
-            "health_impact": "Contains beneficial minerals like calcium and magnesium",
-            "usage": "Drinking, cooking, baby formula, brewing coffee/tea",
-            "risk_level": "Very Low"
-        }
-    elif tds_value < 250:
-        return {
-            "level": "Good",
-            "class": "good",
-            "description": "Good quality potable water",
-            "drinking_safety": "Safe for drinking and domestic use",
-            "health_impact": "Adequate mineral content for daily consumption",
-            "usage": "General drinking, cooking, bathing, gardening",
-            "risk_level": "Low"
-        }
-    elif tds_value < 350:
-        return {
-            "level": "Fair",
-            "class": "fair",
-            "description": "Acceptable quality with some impurities",
-            "drinking_safety": "Generally safe with filtration recommended",
-            "health_impact": "May contain elevated levels of certain minerals",
-            "usage": "Domestic use with filtration, gardening, cleaning",
-            "risk_level": "Moderate"
-        }
-    elif tds_value < 500:
-        return {
-            "level": "Poor",
-            "class": "poor",
-            "description": "Low quality water with significant impurities",
-            "drinking_safety": "Not recommended without treatment",
-            "health_impact": "May cause digestive issues with prolonged consumption",
-            "usage": "Limited domestic use, toilet flushing, irrigation",
-            "risk_level": "High"
-        }
-    elif tds_value < 900:
-        return {
-            "level": "Unacceptable",
-            "class": "unacceptable",
-            "description": "Highly contaminated water",
-            "drinking_safety": "Not safe for drinking - treatment required",
-            "health_impact": "Risk of gastrointestinal diseases and other health issues",
-            "usage": "Industrial use only, construction, firefighting",
-            "risk_level": "Very High"
-        }
-    else:
-        return {
-            "level": "Hazardous",
-            "class": "hazardous",
-            "description": "Severely contaminated - immediate action required",
-            "drinking_safety": "Dangerous to health - avoid all contact",
-            "health_impact": "Serious health risks including poisoning and disease",
-            "usage": "Not recommended for any use without treatment",
-            "risk_level": "Critical"
-        }
+    return dict(TDS_QUALITY_BANDS[tds_quality_band(tds_value)])
 
 
 def get_temperature_recommendations(temperature):
     """Get recommendations based on water temperature"""
-    recommendations = []
-
-    if temperature == 0 or temperature == '-':
-        recommendations.extend([
-            "No temperature data available",
-            "Connect temperature sensor for complete analysis"
-        ])
-    elif temperature < 5:
-        recommendations.extend([
-            "🚫 Water is very cold - may affect digestion",
-            "⚠️ Consider warming to room temperature before drinking",
-            "❄️ Cold water may constrict blood vessels temporarily",
-            "💧 Ideal for refrigeration and cold storage"
-        ])
-    elif 5 <= temperature < 15:
-        recommendations.extend([
-            "✅ Cool water - refreshing for drinking",
-            "👍 Ideal temperature for water storage",
-            "⚡ Good for metabolic functions and hydration",
-            "🌡️ Perfect temperature for athletic activities"
-        ])
-    elif 15 <= temperature < 25:
-        recommendations.extend([
-            "✅ Room temperature - ideal for drinking",
-            "👍 Best for hydration and digestion",
-            "⚡ Optimal for nutrient absorption",
-            "💫 Most comfortable for daily consumption"
-        ])
-    elif 25 <= temperature < 35:
-        recommendations.extend([
-            "⚠️ Slightly warm - pleasant for drinking in cold weather",
-            "🔍 Monitor water source for bacterial growth",
-            "⏰ Not ideal for long-term storage",
-            "🌡️ Good for digestion and metabolism"
-        ])
-    elif 35 <= temperature < 50:
-        recommendations.extend([
-            "🚨 Warm water - potential contamination risk",
-            "🔍 Check water source and storage conditions",
-            "⏰ Immediate consumption recommended",
-            "🦠 May promote bacterial growth if stored"
-        ])
-    else:
-        recommendations.extend([
-            "🚨 CRITICAL: Hot water - high contamination risk",
-            "🆘 Immediate testing and investigation required",
-            "🔧 Check for equipment malfunction",
-            "🚱 Avoid consumption until verified safe"
-        ])
-
-    return recommendations
+    return list(TEMPERATURE_RECOMMENDATION_BANDS[temperature_band(temperature)])
 
 
 def get_improvement_suggestions(tds_value, temperature):
     """Get comprehensive improvement suggestions"""
-    suggestions = []
-
-    # TDS-based suggestions
-    if tds_value == 0 or tds_value == '-':
-        suggestions.extend([
-            "🔌 Connect water quality sensors",
-            "📊 Enable data collection system",
-            "🔄 Check sensor connections and power"
-        ])
-    elif tds_value < 50:
-        suggestions.extend([
-            "💎 Add mineral supplements for drinking water",
-            "🔄 Consider remineralization filter system",
-            "🚰 Mix with natural mineral water for drinking",
-            "📈 Monitor mineral levels regularly"
-        ])
-    elif tds_value < 250:
-        suggestions.extend([
-            "✅ Maintain current filtration system",
-            "📅 Regular quarterly water testing recommended",
-            "👀 Monitor for sudden TDS changes",
-            "💧 Continue good water storage practices"
-        ])
-    elif tds_value < 500:
-        suggestions.extend([
-            "🔄 Install RO water purification system",
-            "⚡ Use activated carbon filters",
-            "🔦 Consider UV purification for bacteria",
-            "📋 Test for specific contaminants (lead, arsenic)",
-            "💡 Improve source water protection"
-        ])
-    elif tds_value < 900:
-        suggestions.extend([
-            "🚨 IMMEDIATE: Install RO purification system",
-            "🆘 Use bottled water for drinking and cooking",
-            "📞 Professional water testing needed immediately",
-            "🔧 Check plumbing system for contamination sources",
-            "💧 Install whole-house filtration system"
-        ])
-    else:
-        suggestions.extend([
-            "🆘 CRITICAL: USE BOTTLED WATER IMMEDIATELY",
-            "📞 Contact water quality authorities immediately",
-            "🔧 Professional remediation required",
-            "🧪 Comprehensive water testing essential",
-            "🏠 Consider alternative water sources"
-        ])
-
-    # Temperature-based suggestions
-    if temperature != 0 and temperature != '-':
-        if temperature > 35:
-            suggestions.extend([
-                "🌡️ Store water in cool, dark place",
-                "🧊 Use insulated water containers",
-                "🔍 Monitor for bacterial growth regularly",
-                "⏰ Reduce water storage time"
-            ])
-        elif temperature < 10:
-            suggestions.extend([
-                "☕ Allow water to reach room temperature before drinking",
-                "🏠 Check for pipe insulation issues",
-                "💧 Consider water heating options",
-                "🌡️ Monitor for freezing in cold weather"
-            ])
-
-    # General suggestions
-    suggestions.extend([
-        "📊 Regular monitoring with this dashboard",
-        "📝 Maintain water quality log",
-        "🔔 Set up alerts for quality changes",
-        "🌱 Consider environmental factors affecting water source"
-    ])
-
+    suggestions = list(IMPROVEMENT_TDS_SUGGESTIONS[improvement_tds_band(tds_value)])
+    suggestions.extend(IMPROVEMENT_TEMPERATURE_SUGGESTIONS[improvement_temperature_band(temperature)])
+    suggestions.extend(GENERAL_SUGGESTIONS)
     return suggestions
 
 
-def get_additional_parameters(tds_value, temperature):
-    """Generate simulated additional water parameters based on TDS and temperature"""
-    if tds_value == 0 or tds_value == '-':
-        return {
-            "ph": "-",
-            "turbidity": "-",
-            "chlorine": "-",
-            "hardness": "-",
-            "alkalinity": "-"
-        }
+@functools.lru_cache(maxsize=1)
+def numpy_module():
+    """NumPy, imported on first bulk classification to keep worker startup fast"""
+    try:
+        import numpy
+    except ImportError:  # bulk classification falls back to bisect
+        return None
+    return numpy
 
-    # Simulate pH based on TDS (generally inverse relationship)
-    if tds_value < 100:
-        ph_value = round(6.8 + random.uniform(0.1, 0.4), 1)  # Slightly acidic for pure water
-    elif tds_value < 300:
-        ph_value = round(7.0 + random.uniform(0.1, 0.5), 1)  # Near neutral
-    elif tds_value < 600:
-        ph_value = round(7.2 + random.uniform(0.1, 0.6), 1)  # Slightly alkaline
-    else:
-        ph_value = round(7.5 + random.uniform(0.2, 0.8), 1)  # Alkaline
 
-    # Simulate turbidity (generally correlates with TDS)
-    turbidity = min(10, round(tds_value / 100 + random.uniform(0.1, 0.5), 1))
+def classify_bulk(tds_values, temperatures):
+    """Band indices for many readings at once
+
+    Returns (tds_bands, temperature_bands) indexing TDS_QUALITY_BANDS and
+    TEMPERATURE_RECOMMENDATION_BANDS; uses NumPy searchsorted when available.
+    """
+    np = numpy_module()
+    if np is None:
+        return ([tds_quality_band(v) for v in tds_values],
+                [temperature_band(v) for v in temperatures])
+
+    tds = bulk_values(np, tds_values)
+    tds_bands = np.searchsorted(TDS_QUALITY_THRESHOLDS, tds, side='right') + 1
+    tds_bands[(tds == 0) | np.isnan(tds)] = 0
+
+    temps = bulk_values(np, temperatures)
+    temp_bands = np.searchsorted(TEMPERATURE_THRESHOLDS, temps, side='right') + 1
+    temp_bands[(temps == 0) | np.isnan(temps)] = 0
+    return tds_bands.tolist(), temp_bands.tolist()
+
+
+def bulk_values(np, values):
+    """Float array for classify_bulk; missing values ('-', None, '') become NaN"""
+    try:
+        return np.asarray(values, dtype=float)
+    except (TypeError, ValueError):
+        return np.asarray([math.nan if is_missing(value) else value for value in values], dtype=float)
+
+
+# Derived parameters are simulated from TDS with jitter seeded by the reading
+# itself, so each reading always maps to the same values. They are computed
+# once at ingest and stored with the reading; derive_parameters_bulk() is the
+# vectorized form used for history and backfill and gives identical results.
+
+DERIVED_FIELDS = ("ph", "turbidity", "chlorine", "hardness", "alkalinity")
+MISSING_PARAMETERS = MappingProxyType({field: "-" for field in DERIVED_FIELDS})
+# (TDS below, base pH, jitter low, jitter high); pH rises with TDS
+PH_BANDS = ((100, 6.8, 0.1, 0.4), (300, 7.0, 0.1, 0.5), (600, 7.2, 0.1, 0.6), (float("inf"), 7.5, 0.2, 0.8))
+CHLORINE_TDS_THRESHOLD = 300
+MASK64 = 0xFFFFFFFFFFFFFFFF
+GOLDEN64 = 0x9E3779B97F4A7C15
 
-    # Simulate chlorine residual
-    if tds_value < 300:
-        chlorine = round(0.2 + random.uniform(0.1, 0.3), 2)
-    else:
-        chlorine = round(0.1 + random.uniform(0.0, 0.2), 2)
 
-    # Simulate hardness (correlates with TDS)
-    hardness = round(tds_value * 0.7 + random.uniform(-10, 10))
+def mix64(z):
+    """SplitMix64 finalizer"""
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
 
-    # Simulate alkalinity
-    alkalinity = round(tds_value * 0.5 + random.uniform(-20, 20))
 
+def float_bits(value):
+    return struct.unpack("<Q", struct.pack("<d", value))[0]
+
+
+def round_half_up(value, digits):
+    scale = 10 ** digits
+    return math.floor(value * scale + 0.5) / scale
+
+
+def reading_uniforms(epoch, tds_value, temperature):
+    """Five uniforms in [0, 1) seeded from one reading"""
+    seed = mix64(mix64(mix64(epoch & MASK64) ^ float_bits(tds_value)) ^ float_bits(temperature))
+    return [(mix64((seed + (k + 1) * GOLDEN64) & MASK64) >> 11) * 2.0 ** -53 for k in range(len(DERIVED_FIELDS))]
+
+
+def derive_parameters(key, tds_value, temperature):
+    """Simulated pH, turbidity, chlorine, hardness and alkalinity for one reading"""
+    if is_missing(tds_value):
+        return dict(MISSING_PARAMETERS)
+
+    tds_value = float(tds_value)
+    u = reading_uniforms(key_to_epoch(key) if key else 0, tds_value, float(temperature))
+    _, base, low, high = next(band for band in PH_BANDS if tds_value < band[0])
+    if tds_value < CHLORINE_TDS_THRESHOLD:
+        chlorine = 0.2 + (0.1 + (0.3 - 0.1) * u[2])
+    else:
+        chlorine = 0.1 + (0.0 + (0.2 - 0.0) * u[2])
     return {
-        "ph": ph_value,
-        "turbidity": turbidity,
-        "chlorine": chlorine,
-        "hardness": hardness,
-        "alkalinity": alkalinity
+        "ph": round_half_up(base + (low + (high - low) * u[0]), 1),
+        "turbidity": min(10.0, round_half_up(tds_value / 100 + (0.1 + (0.5 - 0.1) * u[1]), 1)),
+        "chlorine": round_half_up(chlorine, 2),
+        "hardness": int(math.floor(tds_value * 0.7 + (-10 + (10 - -10) * u[3]) + 0.5)),
+        "alkalinity": int(math.floor(tds_value * 0.5 + (-20 + (20 - -20) * u[4]) + 0.5))
+    }
+
+
+def derive_parameters_bulk(keys, tds_values, temperatures):
+    """derive_parameters() for many readings at once, with NumPy when available"""
+    np = numpy_module()
+    if np is None:
+        return [derive_parameters(k, t, c) for k, t, c in zip(keys, tds_values, temperatures)]
+
+    def mix(z):
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+    tds = np.asarray(tds_values, dtype=np.float64)
+    temps = np.asarray(temperatures, dtype=np.float64)
+    epochs = np.array([key_to_epoch(k) if k else 0 for k in keys], dtype=np.int64).view(np.uint64)
+    seed = mix(mix(mix(epochs) ^ tds.view(np.uint64)) ^ temps.view(np.uint64))
+    u = [(mix(seed + np.uint64(((k + 1) * GOLDEN64) & MASK64)) >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+         for k in range(len(DERIVED_FIELDS))]
+
+    band = np.searchsorted(np.array([b[0] for b in PH_BANDS[:-1]]), tds, side='right')
+    base = np.array([b[1] for b in PH_BANDS])[band]
+    low = np.array([b[2] for b in PH_BANDS])[band]
+    high = np.array([b[3] for b in PH_BANDS])[band]
+    chlorine = np.where(tds < CHLORINE_TDS_THRESHOLD,
+                        0.2 + (0.1 + (0.3 - 0.1) * u[2]),
+                        0.1 + (0.0 + (0.2 - 0.0) * u[2]))
+    columns = {
+        "ph": np.floor((base + (low + (high - low) * u[0])) * 10 + 0.5) / 10,
+        "turbidity": np.minimum(10, np.floor((tds / 100 + (0.1 + (0.5 - 0.1) * u[1])) * 10 + 0.5) / 10),
+        "chlorine": np.floor(chlorine * 100 + 0.5) / 100,
+        "hardness": np.floor(tds * 0.7 + (-10 + (10 - -10) * u[3]) + 0.5).astype(np.int64),
+        "alkalinity": np.floor(tds * 0.5 + (-20 + (20 - -20) * u[4]) + 0.5).astype(np.int64)
     }
+    columns = {field: column.tolist() for field, column in columns.items()}
+    return [dict(MISSING_PARAMETERS) if is_missing(t) else {field: columns[field][i] for field in DERIVED_FIELDS}
+            for i, t in enumerate(tds_values)]
+
+
+def get_additional_parameters(tds_value, temperature, timestamp=None):
+    """Derived water parameters for a reading (see derive_parameters)"""
+    return derive_parameters(timestamp, tds_value, temperature)
+
+
+def parameters_row(params):
+    """Derived parameters as floats in DERIVED_FIELDS order, NaN when missing"""
+    return tuple(math.nan if params[field] == "-" else float(params[field]) for field in DERIVED_FIELDS)
+
+
+def parameters_from_row(values):
+    if math.isnan(values[0]):
+        return dict(MISSING_PARAMETERS)
+    ph, turbidity, chlorine, hardness, alkalinity = values
+    return {"ph": ph, "turbidity": turbidity, "chlorine": chlorine,
+            "hardness": int(hardness), "alkalinity": int(alkalinity)}
 
 
 def get_water_quality_standards():
@@ -309,132 +501,2848 @@ def get_water_quality_standards():
     }
 
 
+# ---------- READING CACHE ----------
+
+READING_CACHE_TTL = float(os.environ.get("READING_CACHE_TTL", "10"))
+READING_CACHE_SIZE = int(os.environ.get("READING_CACHE_SIZE", "20"))
+
+
+KEY_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def key_to_epoch(key):
+    """Whole seconds since 1970 for a water_data key, treating it as naive UTC"""
+    return (datetime.datetime.fromisoformat(key) - KEY_EPOCH) // datetime.timedelta(seconds=1)
+
+
+def local_epoch(unix_time):
+    """A Unix (UTC) time as seconds in the key_to_epoch scale of server-local keys"""
+    return key_to_epoch(datetime.datetime.fromtimestamp(unix_time).strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+def epoch_to_key(epoch):
+    return (KEY_EPOCH + datetime.timedelta(seconds=epoch)).isoformat()
+
+
+def dump_json(value):
+    """Compact JSON bytes, via orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def reading_json(reading):
+    """A reading encoded as its /data chart record (see format_reading)"""
+    return dump_json(format_reading(reading))
+
+
+def join_json(fragments):
+    return b"[" + b",".join(fragments) + b"]"
+
+
+class ReadingCache:
+    """In-process read-through cache of the most recent readings window
+
+    Readings are kept oldest-first in a fixed-size ring of parallel columns:
+    epoch seconds, TDS/temperature and the derived parameters as machine
+    values, plus each reading's /data record, encoded once when it enters
+    the window.
+    """
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.fill_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._epochs = array("q", [0]) * size
+        self._tds = array("d", [0.0]) * size
+        self._temperatures = array("d", [0.0]) * size
+        self._params = array("d", [math.nan]) * (size * len(DERIVED_FIELDS))
+        self._json = [None] * size
+        self._start = 0
+        self._count = 0
+        self._loaded_at = None
+
+    def _is_fresh(self):
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def _slot(self, index):
+        return (self._start + index) % self.size
+
+    def _params_at(self, slot):
+        width = len(DERIVED_FIELDS)
+        return tuple(self._params[slot * width:(slot + 1) * width])
+
+    def _rows(self):
+        return [(self._epochs[slot], self._tds[slot], self._temperatures[slot], self._params_at(slot),
+                 self._json[slot])
+                for slot in map(self._slot, range(self._count))]
+
+    @staticmethod
+    def _row(reading):
+        # orjson hands back over-allocated buffers; keep an exact-size copy
+        encoded = bytes(memoryview(reading_json(reading)))
+        params = reading.get("params") or derive_parameters(reading["timestamp"], reading["tds"],
+                                                            reading["temperature"])
+        return (key_to_epoch(reading["timestamp"]), float(reading["tds"]),
+                float(reading["temperature"]), parameters_row(params), encoded)
+
+    def _write(self, slot, row):
+        self._epochs[slot], self._tds[slot], self._temperatures[slot], params, self._json[slot] = row
+        width = len(DERIVED_FIELDS)
+        self._params[slot * width:(slot + 1) * width] = array("d", params)
+
+    def _reset(self, rows):
+        rows = rows[-self.size:]
+        self._start = 0
+        self._count = len(rows)
+        for slot, row in enumerate(rows):
+            self._write(slot, row)
+        for slot in range(len(rows), self.size):
+            self._json[slot] = None
+
+    def _first_after(self, epoch):
+        """Index of the first reading newer than `epoch`"""
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._epochs[self._slot(mid)] <= epoch:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _reading(self, index):
+        slot = self._slot(index)
+        return {
+            "timestamp": epoch_to_key(self._epochs[slot]),
+            "tds": self._tds[slot],
+            "temperature": self._temperatures[slot],
+            "params": parameters_from_row(self._params_at(slot))
+        }
+
+    def get(self, limit, count=True):
+        """Return the last `limit` readings, or None when the window must be refetched"""
+        with self._lock:
+            if limit <= self.size and self._is_fresh():
+                if count:
+                    self.hits += 1
+                return [self._reading(i) for i in range(max(0, self._count - limit), self._count)]
+            if count:
+                self.misses += 1
+            return None
+
+    def get_json(self, limit):
+        """The last `limit` readings as a /data payload, or None when the window must be refetched
+
+        Only hits are counted; callers fall back to get(), which counts the miss.
+        """
+        with self._lock:
+            if limit > self.size or not self._is_fresh():
+                return None
+            self.hits += 1
+            return join_json(self._json[self._slot(i)] for i in range(max(0, self._count - limit), self._count))
+
+    def since_json(self, key, limit):
+        """Up to `limit` readings after `key` as a /data payload, or None when the
+        window does not reach back to `key`
+        """
+        epoch = key_to_epoch(key)
+        with self._lock:
+            if not self._count or not self._is_fresh() or self._epochs[self._start] > epoch:
+                return None
+            first = self._first_after(epoch)
+            return join_json(self._json[self._slot(i)] for i in range(first, min(first + limit, self._count)))
+
+    def since(self, key, limit):
+        """Up to `limit` readings after `key`, or None when the window does not reach back to `key`"""
+        epoch = key_to_epoch(key)
+        with self._lock:
+            if not self._count or not self._is_fresh() or self._epochs[self._start] > epoch:
+                return None
+            first = self._first_after(epoch)
+            return [self._reading(i) for i in range(first, min(first + limit, self._count))]
+
+    def fill(self, readings):
+        """Replace the window with freshly fetched readings, keeping newer local writes"""
+        rows = [self._row(r) for r in readings]
+        with self._lock:
+            merged = {row[0]: row for row in rows}
+            oldest = rows[0][0] if rows else None
+            for row in self._rows():
+                if row[0] not in merged and (oldest is None or row[0] > oldest):
+                    merged[row[0]] = row
+            self._reset(sorted(merged.values(), key=lambda row: row[0]))
+            self._loaded_at = time.monotonic()
+
+    def add(self, reading):
+        """Insert or replace a reading in place so readers never see a stale window"""
+        row = self._row(reading)
+        with self._lock:
+            newest = self._epochs[self._slot(self._count - 1)] if self._count else None
+            if newest is None or row[0] > newest:
+                # The usual case: append, overwriting the oldest reading once full
+                if self._count < self.size:
+                    self._count += 1
+                else:
+                    self._start = (self._start + 1) % self.size
+                self._write(self._slot(self._count - 1), row)
+            elif row[0] == newest:
+                self._write(self._slot(self._count - 1), row)
+            else:
+                rows = [r for r in self._rows() if r[0] != row[0]]
+                rows.insert(bisect.bisect_left([r[0] for r in rows], row[0]), row)
+                self._reset(rows)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "size": self._count,
+                "max_size": self.size,
+                "ttl_seconds": self.ttl,
+                "fresh": self._is_fresh()
+            }
+
+
+reading_cache = ReadingCache(READING_CACHE_TTL, READING_CACHE_SIZE)
+
+
+# ---------- WRITE-BEHIND BUFFER ----------
+
+WRITE_BUFFER_MAX_BATCH = int(os.environ.get("WRITE_BUFFER_MAX_BATCH", "100"))
+WRITE_BUFFER_MAX_AGE = float(os.environ.get("WRITE_BUFFER_MAX_AGE", "2.0"))
+WRITE_BUFFER_CAPACITY = int(os.environ.get("WRITE_BUFFER_CAPACITY", "5000"))
+MAX_BATCH_READINGS = int(os.environ.get("MAX_BATCH_READINGS", "500"))
+WRITE_WORKERS = int(os.environ.get("WRITE_WORKERS", "2"))
+WRITE_MAX_RETRIES = int(os.environ.get("WRITE_MAX_RETRIES", "5"))
+WRITE_RETRY_BASE = float(os.environ.get("WRITE_RETRY_BASE", "0.5"))
+WRITE_RETRY_MAX = float(os.environ.get("WRITE_RETRY_MAX", "30"))
+WRITE_DRAIN_TIMEOUT = float(os.environ.get("WRITE_DRAIN_TIMEOUT", "30"))
+WRITE_TICKET_HISTORY = int(os.environ.get("WRITE_TICKET_HISTORY", "10000"))
+
+
+class BufferFullError(Exception):
+    """Raised when the write-behind buffer cannot accept more readings"""
+
+
+class WriteTicket:
+    """Completes once every writer holding part of a submission has stored it"""
+
+    def __init__(self, ticket_id, parts):
+        self.id = ticket_id
+        self._remaining = parts
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def part_done(self):
+        with self._lock:
+            self._remaining -= 1
+            if self._remaining <= 0:
+                self._done.set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    @property
+    def stored(self):
+        return self._done.is_set()
+
+
+class WriteShard:
+    """Pending writes owned by one writer thread"""
+
+    def __init__(self, index):
+        self.index = index
+        self.pending = {}
+        self.waiters = []
+        self.oldest = None
+        self.thread = None
+
+
+class WriteBehindBuffer:
+    """Coalesces pending writes into multi-path storage updates drained by a writer pool
+
+    Paths are sharded across the writers so a path is only ever written by
+    one thread, which keeps repeated writes to the same path in order.
+    """
+
+    def __init__(self, max_batch, max_age, capacity, workers, max_retries, retry_base, retry_max):
+        self.max_batch = max_batch
+        self.max_age = max_age
+        self.capacity = capacity
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.flushes = 0
+        self.flushed_writes = 0
+        self.failed_writes = 0
+        self.requeued_writes = 0
+        self.rejected = 0
+        self._latencies = collections.deque(maxlen=1000)
+        self._shards = [WriteShard(i) for i in range(max(1, workers))]
+        self._tickets = collections.OrderedDict()
+        self._ticket_ids = itertools.count(1)
+        self._closing = False
+        self._cond = threading.Condition()
+
+    def _pending_count(self):
+        return sum(len(shard.pending) for shard in self._shards)
+
+    def submit(self, updates):
+        """Queue a {path: value} mapping; all-or-nothing, raises BufferFullError when full
+
+        Returns a WriteTicket that completes once every path has been stored.
+        """
+        by_shard = collections.defaultdict(dict)
+        for path, value in updates.items():
+            by_shard[zlib.crc32(path.encode()) % len(self._shards)][path] = value
+
+        with self._cond:
+            new_paths = sum(
+                1 for index, part in by_shard.items()
+                for path in part if path not in self._shards[index].pending
+            )
+            if self._closing:
+                self.rejected += len(updates)
+                raise BufferFullError("Write buffer is draining for shutdown, retry later")
+            if self._pending_count() + new_paths > self.capacity:
+                self.rejected += len(updates)
+                raise BufferFullError("Write buffer is full, retry later")
+
+            ticket = WriteTicket(next(self._ticket_ids), len(by_shard))
+            self._tickets[ticket.id] = ticket
+            if len(self._tickets) > WRITE_TICKET_HISTORY:
+                self._tickets.popitem(last=False)
+            now = time.monotonic()
+            wake = False
+            for index, part in by_shard.items():
+                shard = self._shards[index]
+                shard.pending.update(part)
+                shard.waiters.append(ticket)
+                if shard.oldest is None:
+                    # An idle writer sleeps without a deadline until its first write arrives
+                    shard.oldest = now
+                    wake = True
+                wake = wake or len(shard.pending) >= self.max_batch
+                self._ensure_thread(shard)
+            if wake:
+                self._cond.notify_all()
+            return ticket
+
+    def _ensure_thread(self, shard):
+        if shard.thread is None or not shard.thread.is_alive():
+            shard.thread = threading.Thread(target=self._run, args=(shard,),
+                                            name=f"write-behind-{shard.index}", daemon=True)
+            shard.thread.start()
+
+    def _due(self, shard):
+        if not shard.pending:
+            return False
+        return (self._closing
+                or len(shard.pending) >= self.max_batch
+                or time.monotonic() - shard.oldest >= self.max_age)
+
+    def _run(self, shard):
+        while True:
+            with self._cond:
+                while not self._due(shard):
+                    if self._closing and not shard.pending:
+                        return
+                    timeout = None
+                    if shard.oldest is not None:
+                        timeout = max(0.0, self.max_age - (time.monotonic() - shard.oldest))
+                    self._cond.wait(timeout)
+                updates, waiters = shard.pending, shard.waiters
+                shard.pending, shard.waiters, shard.oldest = {}, [], None
+            self._write(shard, updates, waiters)
+
+    def _write(self, shard, updates, waiters):
+        """Write one batch, retrying with exponential backoff before handing it back"""
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            try:
+                storage.update(updates)
+            except Exception as e:
+                with self._cond:
+                    self.failed_writes += 1
+                delay = min(self.retry_max, self.retry_base * 2 ** attempt)
+                print(f"Error writing {len(updates)} buffered writes (attempt {attempt + 1}): {e}")
+                if attempt < self.max_retries:
+                    time.sleep(delay)
+                continue
+
+            with self._cond:
+                self.flushes += 1
+                self.flushed_writes += len(updates)
+                self._latencies.append(time.monotonic() - started)
+            for ticket in waiters:
+                ticket.part_done()
+            return
+
+        with self._cond:
+            # Put the batch back without clobbering anything written since
+            for path, value in updates.items():
+                shard.pending.setdefault(path, value)
+            shard.waiters = waiters + shard.waiters
+            if shard.oldest is None:
+                shard.oldest = time.monotonic()
+            self.requeued_writes += len(updates)
+        time.sleep(self.retry_max)
+
+    def ticket(self, ticket_id):
+        """A recent submission's ticket by id, or None once it has aged out"""
+        with self._cond:
+            return self._tickets.get(ticket_id)
+
+    def drain(self, timeout=WRITE_DRAIN_TIMEOUT):
+        """Stop accepting writes and wait for the writers to store what is pending"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for shard in self._shards:
+            if shard.thread is not None:
+                shard.thread.join(max(0.0, deadline - time.monotonic()))
+        left = self._pending_count()
+        if left:
+            print(f"Write buffer drain timed out with {left} writes pending")
+        return left == 0
+
+    def stats(self):
+        with self._cond:
+            latencies = sorted(self._latencies)
+
+            def percentile(p):
+                if not latencies:
+                    return None
+                return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 2)
+
+            return {
+                "pending": self._pending_count(),
+                "pending_by_worker": [len(shard.pending) for shard in self._shards],
+                "capacity": self.capacity,
+                "workers": len(self._shards),
+                "max_batch": self.max_batch,
+                "max_age_seconds": self.max_age,
+                "flushes": self.flushes,
+                "flushed_writes": self.flushed_writes,
+                "failed_writes": self.failed_writes,
+                "requeued_writes": self.requeued_writes,
+                "rejected": self.rejected,
+                "write_latency_ms": {
+                    "p50": percentile(0.5),
+                    "p95": percentile(0.95),
+                    "max": percentile(1.0)
+                }
+            }
+
+
+write_buffer = WriteBehindBuffer(WRITE_BUFFER_MAX_BATCH, WRITE_BUFFER_MAX_AGE, WRITE_BUFFER_CAPACITY,
+                                 WRITE_WORKERS, WRITE_MAX_RETRIES, WRITE_RETRY_BASE, WRITE_RETRY_MAX)
+atexit.register(write_buffer.drain)
+
+
+# ---------- LIVE STREAM ----------
+
+STREAM_BACKLOG = int(os.environ.get("STREAM_BACKLOG", "500"))
+STREAM_HEARTBEAT = float(os.environ.get("STREAM_HEARTBEAT", "15"))
+
+
+class ReadingBroker:
+    """In-process pub/sub that fans newly ingested readings out to every stream client"""
+
+    def __init__(self, backlog):
+        self._cond = threading.Condition()
+        self._events = collections.deque(maxlen=backlog)
+        self._seq = 0
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Call `callback()` after every publish, e.g. to wake an event loop"""
+        self._listeners.append(callback)
+
+    def publish(self, readings):
+        with self._cond:
+            for reading in readings:
+                self._seq += 1
+                self._events.append((self._seq, reading))
+            self._cond.notify_all()
+        for listener in self._listeners:
+            listener()
+
+    def snapshot(self, last_key=None):
+        """Return (missed readings, cursor, covered) for a client resuming after `last_key`
+
+        `covered` is False unless `last_key` is a reading still in the backlog:
+        older keys, and keys this process never published (e.g. from before a
+        restart), may have missed readings only storage has.
+        """
+        with self._cond:
+            missed = []
+            covered = True
+            if last_key is not None:
+                missed = [r for _, r in self._events if r["timestamp"] > last_key]
+                covered = any(r["timestamp"] == last_key for _, r in self._events)
+            missed.sort(key=lambda x: x["timestamp"])
+            return missed, self._seq, covered
+
+    def wait(self, cursor, timeout):
+        """Block until readings newer than `cursor` arrive; returns (readings, cursor)"""
+        with self._cond:
+            if self._seq == cursor:
+                self._cond.wait(timeout)
+            return self._since(cursor)
+
+    def poll(self, cursor):
+        """Readings newer than `cursor` without blocking; returns (readings, cursor)"""
+        with self._cond:
+            return self._since(cursor)
+
+    def _since(self, cursor):
+        if self._seq == cursor:
+            return [], cursor
+        oldest = self._events[0][0] if self._events else self._seq + 1
+        if cursor < oldest - 1:
+            # Slow consumer fell off the backlog; resume from what is left
+            cursor = oldest - 1
+        readings = [r for seq, r in self._events if seq > cursor]
+        return readings, self._seq
+
+
+reading_broker = ReadingBroker(STREAM_BACKLOG)
+
+
+# ---------- INGEST LOCK ----------
+# Open rollup buckets, the anomaly detectors and the forecast model are kept
+# in process memory and written back as whole records, so exactly one process
+# may ingest into a database: with several pre-forked workers each would
+# overwrite the others' aggregates. The first process to ingest takes an
+# exclusive lock on INGEST_LOCK_FILE; the others answer device writes with
+# 503 until it exits. Scale reads with threads (gunicorn -w 1 --threads N) or
+# the ASGI app, and point every host sharing a database at one lock file.
+
+INGEST_LOCK_FILE = os.environ.get("INGEST_LOCK_FILE") or os.path.join(
+    tempfile.gettempdir(), f"hydroai-ingest-{hashlib.sha1(app.root_path.encode()).hexdigest()[:12]}.lock")
+
+
+class IngestLockedError(Exception):
+    """Raised when another process owns ingest for this database"""
+
+
+class IngestLock:
+    """Exclusive, process-wide claim on ingest, taken on the first device write"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """True once this process owns ingest; retried on each call until it does"""
+        if fcntl is None:
+            return True
+        with self._lock:
+            if self._file is None:
+                lock_file = open(self.path, "a")
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lock_file.close()
+                    return False
+                self._file = lock_file
+            return True
+
+    @property
+    def held(self):
+        return fcntl is None or self._file is not None
+
+
+ingest_lock = IngestLock(INGEST_LOCK_FILE)
+
+
+# ---------- ROLLUPS ----------
+
+# Bucket keys are prefixes of the water_data key, so they sort the same way
+ROLLUP_RESOLUTIONS = {
+    "minute": 16,   # 2024-01-31T14:05
+    "hour": 13,     # 2024-01-31T14
+    "day": 10       # 2024-01-31
+}
+ROLLUP_DISPLAY_FORMATS = {
+    "minute": ("%Y-%m-%dT%H:%M", "%H:%M"),
+    "hour": ("%Y-%m-%dT%H", "%d %b %H:00"),
+    "day": ("%Y-%m-%d", "%d %b %Y")
+}
+ROLLUP_SECONDS = {"minute": 60, "hour": 3600, "day": 86400}
+ROLLUP_FIELDS = ("tds", "temperature")
+ROLLUP_OPEN_BUCKETS = int(os.environ.get("ROLLUP_OPEN_BUCKETS", "4"))
+BACKFILL_PAGE_SIZE = int(os.environ.get("BACKFILL_PAGE_SIZE", "1000"))
+
+
+def rollup_add(record, reading):
+    """Fold one reading into a bucket record, returning the updated copy"""
+    if record is None:
+        record = {"count": 0, "last_key": ""}
+        for field in ROLLUP_FIELDS:
+            record[field] = {"min": reading[field], "max": reading[field], "sum": 0.0, "last": reading[field]}
+    else:
+        record = {k: dict(v) if isinstance(v, dict) else v for k, v in record.items()}
+
+    is_latest = reading["timestamp"] >= record["last_key"]
+    record["count"] += 1
+    for field in ROLLUP_FIELDS:
+        stats = record[field]
+        value = reading[field]
+        stats["min"] = min(stats["min"], value)
+        stats["max"] = max(stats["max"], value)
+        stats["sum"] += value
+        if is_latest:
+            stats["last"] = value
+    if is_latest:
+        record["last_key"] = reading["timestamp"]
+    return record
+
+
+def format_rollup(resolution, bucket, record):
+    """Shape a bucket record for chart display; tds/temperature are bucket means"""
+    parse_format, display_format = ROLLUP_DISPLAY_FORMATS[resolution]
+    count = record["count"]
+    formatted = {
+        "key": bucket,
+        "timestamp": datetime.datetime.strptime(bucket, parse_format).strftime(display_format),
+        "count": count
+    }
+    for field in ROLLUP_FIELDS:
+        stats = record[field]
+        formatted[field] = round(stats["sum"] / count, 2) if count else 0
+        formatted[f"{field}_min"] = stats["min"]
+        formatted[f"{field}_max"] = stats["max"]
+        formatted[f"{field}_last"] = stats["last"]
+    return formatted
+
+
+class RollupEngine:
+    """Keeps the open minute/hour/day buckets in memory and folds readings in on ingest"""
+
+    def __init__(self, open_buckets):
+        self.open_buckets = open_buckets
+        self.lock = threading.Lock()
+        self._buckets = {resolution: {} for resolution in ROLLUP_RESOLUTIONS}
+
+    def _load(self, resolution, bucket):
+        open_records = self._buckets[resolution]
+        if bucket not in open_records:
+            # First touch in this process; continue from whatever is already stored
+            open_records[bucket] = storage.get(f"rollups/{resolution}/{bucket}")
+        return open_records[bucket]
+
+    def accumulate(self, readings):
+        """Return {(resolution, bucket): record} after folding in `readings`; call under lock"""
+        touched = {}
+        for reading in readings:
+            for resolution, width in ROLLUP_RESOLUTIONS.items():
+                bucket = reading["timestamp"][:width]
+                record = touched.get((resolution, bucket))
+                if record is None:
+                    record = self._load(resolution, bucket)
+                touched[(resolution, bucket)] = rollup_add(record, reading)
+        return touched
+
+    def missing(self, readings):
+        """(resolution, bucket) pairs `readings` would have to load from storage"""
+        with self.lock:
+            return sorted({(resolution, reading["timestamp"][:width])
+                           for reading in readings
+                           for resolution, width in ROLLUP_RESOLUTIONS.items()
+                           if reading["timestamp"][:width] not in self._buckets[resolution]})
+
+    def preload(self, records):
+        """Adopt {(resolution, bucket): stored record} fetched elsewhere, e.g. by the async app"""
+        with self.lock:
+            for (resolution, bucket), record in records.items():
+                self._buckets[resolution].setdefault(bucket, record)
+
+    def commit(self, touched):
+        """Adopt records produced by accumulate() once they are safely queued; call under lock"""
+        for (resolution, bucket), record in touched.items():
+            open_records = self._buckets[resolution]
+            open_records[bucket] = record
+            while len(open_records) > self.open_buckets:
+                del open_records[min(open_records)]
+
+    def open_records(self, resolution, start, end):
+        """In-memory buckets in [start, end], which may be newer than what storage holds"""
+        with self.lock:
+            return {
+                bucket: record
+                for bucket, record in self._buckets[resolution].items()
+                if record and start <= bucket <= end
+            }
+
+    def reset(self):
+        with self.lock:
+            self._buckets = {resolution: {} for resolution in ROLLUP_RESOLUTIONS}
+
+
+rollup_engine = RollupEngine(ROLLUP_OPEN_BUCKETS)
+
+
+def rollup_bounds(resolution, start, end):
+    """Bucket keys covering two water_data keys"""
+    width = ROLLUP_RESOLUTIONS[resolution]
+    return start[:width], end[:width]
+
+
+def merge_rollups(resolution, start, end, limit, stored):
+    """Overlay the open in-memory buckets on stored records and format the first `limit`"""
+    records = dict(stored)
+    records.update(rollup_engine.open_records(resolution, start, end))
+    return [format_rollup(resolution, bucket, records[bucket]) for bucket in sorted(records)[:limit]]
+
+
+def get_rollups(resolution, start, end, limit):
+    """Bucket records between two water_data keys at the given resolution"""
+    if not storage.available:
+        return []
+
+    start, end = rollup_bounds(resolution, start, end)
+    try:
+        records = storage.query(f"rollups/{resolution}", start_at=start, end_at=end, limit_to_first=limit)
+    except Exception as e:
+        print(f"Error fetching {resolution} rollups: {e}")
+        records = {}
+
+    return merge_rollups(resolution, start, end, limit, records)
+
+
+def choose_rollup_resolution(start, end, max_points):
+    """Finest resolution that covers [start, end] within max_points buckets"""
+    span = (datetime.datetime.strptime(end, "%Y-%m-%dT%H:%M:%S")
+            - datetime.datetime.strptime(start, "%Y-%m-%dT%H:%M:%S")).total_seconds()
+    for resolution in ("minute", "hour"):
+        if span / ROLLUP_SECONDS[resolution] <= max_points:
+            return resolution
+    return "day"
+
+
+@app.cli.command("backfill-rollups")
+def backfill_rollups_command():
+    """Rebuild minute/hour/day rollups from the raw water_data readings."""
+    if not storage.available:
+        print("Storage is not initialized; nothing to backfill")
+        return
+
+    open_records = {resolution: {} for resolution in ROLLUP_RESOLUTIONS}
+    cursor = None
+    total = 0
+    written = 0
+
+    def flush(final):
+        nonlocal written
+        updates = {}
+        for resolution, records in open_records.items():
+            # Keys arrive in order, so every bucket before the current one is complete
+            done = list(records) if final else sorted(records)[:-1]
+            for bucket in done:
+                updates[f"rollups/{resolution}/{bucket}"] = records.pop(bucket)
+        if updates:
+            storage.update(updates)
+            written += len(updates)
+
+    while True:
+        if cursor is None:
+            page = readings_from(storage.query("water_data", limit_to_first=BACKFILL_PAGE_SIZE))
+        else:
+            page = fetch_sensor_data_since(cursor, BACKFILL_PAGE_SIZE)
+        if not page:
+            break
+
+        for reading in page:
+            for resolution, width in ROLLUP_RESOLUTIONS.items():
+                bucket = reading["timestamp"][:width]
+                open_records[resolution][bucket] = rollup_add(open_records[resolution].get(bucket), reading)
+        total += len(page)
+        cursor = page[-1]["timestamp"]
+        flush(final=False)
+        print(f"Backfilled {total} readings...")
+
+    flush(final=True)
+    rollup_engine.reset()
+    print(f"Rollup backfill complete: {total} readings, {written} buckets written")
+
+
+# ---------- ANOMALY DETECTION ----------
+
+ANOMALY_ALPHA = float(os.environ.get("ANOMALY_ALPHA", "0.1"))
+ANOMALY_Z_THRESHOLD = float(os.environ.get("ANOMALY_Z_THRESHOLD", "3.0"))
+ANOMALY_WARMUP = int(os.environ.get("ANOMALY_WARMUP", "10"))
+ANOMALY_BACKLOG = int(os.environ.get("ANOMALY_BACKLOG", "200"))
+# Largest plausible change per minute before a jump is flagged
+ANOMALY_MAX_RATES = {
+    "tds": float(os.environ.get("ANOMALY_MAX_TDS_RATE", "100")),
+    "temperature": float(os.environ.get("ANOMALY_MAX_TEMPERATURE_RATE", "5"))
+}
+
+
+class StreamingDetector:
+    """EWMA mean/variance, z-score and rate-of-change for one sensor, O(1) per reading"""
+
+    __slots__ = ("sensor", "alpha", "z_threshold", "max_rate", "warmup",
+                 "count", "mean", "var", "last_value", "last_time")
+
+    def __init__(self, sensor, alpha, z_threshold, max_rate, warmup):
+        self.sensor = sensor
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.max_rate = max_rate
+        self.warmup = warmup
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.last_value = None
+        self.last_time = None
+
+    def state(self):
+        return tuple(getattr(self, name) for name in ("count", "mean", "var", "last_value", "last_time"))
+
+    def restore(self, state):
+        self.count, self.mean, self.var, self.last_value, self.last_time = state
+
+    def update(self, key, value):
+        """Score a reading against the running state, then fold it in; returns an anomaly or None"""
+        when = datetime.datetime.strptime(key, "%Y-%m-%dT%H:%M:%S")
+        reasons = []
+
+        baseline = self.mean
+        std = self.var ** 0.5
+        z_score = (value - baseline) / std if std > 0 else 0.0
+        if self.count >= self.warmup and abs(z_score) > self.z_threshold:
+            reasons.append("z_score")
+
+        rate = None
+        if self.last_time is not None and when > self.last_time:
+            minutes = (when - self.last_time).total_seconds() / 60
+            change = value - self.last_value
+            rate = change / minutes
+            # Closely spaced samples get a full minute's allowance so sensor noise is not a "rate"
+            if abs(change) > self.max_rate * max(minutes, 1.0):
+                reasons.append("rate_of_change")
+
+        # Score first so a spike cannot mask itself
+        if self.count == 0:
+            self.mean = value
+        else:
+            diff = value - self.mean
+            increment = self.alpha * diff
+            self.mean += increment
+            self.var = (1 - self.alpha) * (self.var + diff * increment)
+        self.count += 1
+        if self.last_time is None or when >= self.last_time:
+            self.last_value = value
+            self.last_time = when
+
+        if not reasons:
+            return None
+        return {
+            "key": key,
+            "sensor": self.sensor,
+            "value": value,
+            "mean": round(baseline, 3),
+            "std": round(std, 3),
+            "z_score": round(z_score, 3),
+            "rate_per_minute": round(rate, 3) if rate is not None else None,
+            "reasons": reasons
+        }
+
+
+class AnomalyMonitor:
+    """One detector per sensor plus the most recent anomalies"""
+
+    def __init__(self):
+        self._detectors = {
+            sensor: StreamingDetector(sensor, ANOMALY_ALPHA, ANOMALY_Z_THRESHOLD, max_rate, ANOMALY_WARMUP)
+            for sensor, max_rate in ANOMALY_MAX_RATES.items()
+        }
+        self._recent = collections.deque(maxlen=ANOMALY_BACKLOG)
+        self._lock = threading.Lock()
+
+    def observe(self, readings):
+        """Run readings through the detectors; returns ({path: anomaly}, undo state)"""
+        found = {}
+        with self._lock:
+            undo = {sensor: detector.state() for sensor, detector in self._detectors.items()}
+            for reading in readings:
+                for sensor, detector in self._detectors.items():
+                    if is_missing(reading[sensor]):
+                        continue
+                    anomaly = detector.update(reading["timestamp"], reading[sensor])
+                    if anomaly:
+                        found[f"anomalies/{reading['timestamp']}_{sensor}"] = anomaly
+        return found, undo
+
+    def commit(self, found):
+        with self._lock:
+            self._recent.extend(found.values())
+
+    def rollback(self, undo):
+        with self._lock:
+            for sensor, state in undo.items():
+                self._detectors[sensor].restore(state)
+
+    def recent(self, since=None):
+        with self._lock:
+            return [a for a in self._recent if since is None or a["key"] > since]
+
+
+anomaly_monitor = AnomalyMonitor()
+
+
+def get_anomalies(since, limit):
+    """Stored anomalies after `since`, including ones still waiting to be written"""
+    found = {}
+    if storage.available:
+        try:
+            if since:
+                # Keys are <reading key>_<sensor>; "~" sorts after every sensor name
+                found = storage.query("anomalies", start_at=f"{since}_~", limit_to_first=limit)
+            else:
+                found = storage.query("anomalies", limit_to_last=limit)
+        except Exception as e:
+            print(f"Error fetching anomalies: {e}")
+    for anomaly in anomaly_monitor.recent(since):
+        found[f"{anomaly['key']}_{anomaly['sensor']}"] = anomaly
+    anomalies = [found[key] for key in sorted(found)]
+    return anomalies[:limit] if since else anomalies[-limit:]
+
+
+# ---------- FORECASTING ----------
+
+FORECAST_LEVEL_ALPHA = float(os.environ.get("FORECAST_LEVEL_ALPHA", "0.3"))
+FORECAST_TREND_BETA = float(os.environ.get("FORECAST_TREND_BETA", "0.1"))
+FORECAST_STATE_PATH = "model_state/forecast"
+MAX_FORECAST_HOURS = 24 * 7
+# TDS limits from get_water_quality_standards()
+TDS_LIMITS = (
+    ("WHO/EPA/BIS acceptable", 500),
+    ("BIS permissible", 2000)
+)
+
+
+class HoltForecaster:
+    """Holt's linear smoothing over irregularly spaced readings; trend is per second"""
+
+    def __init__(self, alpha, beta):
+        self.alpha = alpha
+        self.beta = beta
+        self.level = None
+        self.trend = 0.0
+        self.last_key = None
+        self.count = 0
+        self.late = 0
+
+    def state(self):
+        return {"level": self.level, "trend": self.trend, "last_key": self.last_key, "count": self.count,
+                "late": self.late}
+
+    def restore(self, state):
+        self.level = state.get("level")
+        self.trend = state.get("trend", 0.0)
+        self.last_key = state.get("last_key")
+        self.count = state.get("count", 0)
+        self.late = state.get("late", 0)
+
+    def update(self, key, value):
+        if self.level is None:
+            self.count += 1
+            self.level = value
+            self.last_key = key
+            return
+        if key <= self.last_key:
+            # Late reading, e.g. uploaded history: the level tracks the present, so only count it
+            self.late += 1
+            return
+
+        self.count += 1
+
+        dt = (datetime.datetime.strptime(key, "%Y-%m-%dT%H:%M:%S")
+              - datetime.datetime.strptime(self.last_key, "%Y-%m-%dT%H:%M:%S")).total_seconds()
+        previous = self.level
+        self.level = self.alpha * value + (1 - self.alpha) * (previous + self.trend * dt)
+        self.trend = self.beta * (self.level - previous) / dt + (1 - self.beta) * self.trend
+        self.last_key = key
+
+    def predict(self, seconds_ahead):
+        return self.level + self.trend * seconds_ahead
+
+
+class ForecastModel:
+    """Online TDS and temperature forecasters whose state survives restarts"""
+
+    def __init__(self):
+        self._models = {sensor: HoltForecaster(FORECAST_LEVEL_ALPHA, FORECAST_TREND_BETA)
+                        for sensor in ROLLUP_FIELDS}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def _load(self):
+        """Load the saved state once; False while storage cannot be read, to retry next call"""
+        if self._loaded:
+            return True
+        try:
+            saved = storage.get(FORECAST_STATE_PATH) or {}
+        except Exception as e:
+            print(f"Error loading forecast state, will retry: {e}")
+            return False
+        self._restore(saved)
+        return True
+
+    def _restore(self, saved):
+        self._loaded = True
+        for sensor, state in saved.items():
+            if sensor in self._models:
+                self._models[sensor].restore(state)
+
+    def preload(self, saved):
+        """Adopt saved state fetched elsewhere, e.g. by the async app"""
+        with self._lock:
+            if not self._loaded:
+                self._restore(saved or {})
+
+    def observe(self, readings):
+        """Fold readings into the models; returns ({path: state}, undo state)"""
+        with self._lock:
+            undo = {sensor: model.state() for sensor, model in self._models.items()}
+            if not self._load():
+                # Folding into cold models would overwrite the saved state on the next flush
+                return {}, undo
+            for reading in sorted(readings, key=lambda r: r["timestamp"]):
+                for sensor, model in self._models.items():
+                    if not is_missing(reading[sensor]):
+                        model.update(reading["timestamp"], reading[sensor])
+            # One small node; the write buffer coalesces it to a single write per flush
+            state = {sensor: model.state() for sensor, model in self._models.items()}
+            return {FORECAST_STATE_PATH: state}, undo
+
+    def rollback(self, undo):
+        with self._lock:
+            for sensor, state in undo.items():
+                self._models[sensor].restore(state)
+
+    def forecast(self, sensor, hours, step_minutes):
+        """Projected values over the next `hours` plus when TDS crosses its limits"""
+        with self._lock:
+            self._load()
+            model = self._models[sensor]
+            if model.level is None:
+                return None
+            level, trend, last_key, count, late = model.level, model.trend, model.last_key, model.count, model.late
+
+        start = datetime.datetime.strptime(last_key, "%Y-%m-%dT%H:%M:%S")
+        points = []
+        for minutes in range(step_minutes, int(hours * 60) + 1, step_minutes):
+            points.append({
+                "key": (start + datetime.timedelta(minutes=minutes)).strftime("%Y-%m-%dT%H:%M:%S"),
+                "value": round(level + trend * minutes * 60, 2)
+            })
+
+        result = {
+            "sensor": sensor,
+            "level": round(level, 2),
+            "trend_per_hour": round(trend * 3600, 3),
+            "last_key": last_key,
+            "readings_seen": count,
+            "late_readings_skipped": late,
+            "forecast": points
+        }
+        if sensor == "tds":
+            limits = []
+            for name, ppm in TDS_LIMITS:
+                crossing = {"name": name, "ppm": ppm}
+                if level >= ppm:
+                    crossing["status"] = "above"
+                elif trend > 0:
+                    seconds = (ppm - level) / trend
+                    crossing["status"] = "rising"
+                    crossing["hours"] = round(seconds / 3600, 2)
+                    crossing["key"] = (start + datetime.timedelta(seconds=seconds)).strftime("%Y-%m-%dT%H:%M:%S")
+                else:
+                    crossing["status"] = "not_rising"
+                limits.append(crossing)
+            result["limits"] = limits
+        return result
+
+
+forecast_model = ForecastModel()
+
+
+# ---------- RETENTION ----------
+# Raw readings older than RETENTION_DAYS are pruned once their hour has a
+# summary under rollups/hour. Each batch writes the summaries it needs, the
+# deletes and the checkpoint as one multi-path update, so an interrupted run
+# never loses data and resumes after the last pruned key. Every device
+# partition is pruned in turn; other devices keep their summaries and
+# checkpoint under devices/<id>/.
+
+RETENTION_DAYS = float(os.environ.get("RETENTION_DAYS", "0"))  # 0 keeps raw readings forever
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", "3600"))
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", "500"))
+RETENTION_PAUSE = float(os.environ.get("RETENTION_PAUSE", "1.0"))
+RETENTION_INGEST_BACKLOG = int(os.environ.get("RETENTION_INGEST_BACKLOG", "100"))
+RETENTION_CHECKPOINT_PATH = "model_state/retention"
+
+
+def retention_paths(device):
+    """(hourly summaries, checkpoint) paths for a device's partition"""
+    if device == DEFAULT_DEVICE_ID:
+        return "rollups/hour", RETENTION_CHECKPOINT_PATH
+    return f"devices/{device}/rollups/hour", f"devices/{device}/retention"
+
+
+def retention_cutoff(days, now=None):
+    """First key that is kept: now minus `days`, rounded down to the hour"""
+    cutoff = (now or datetime.datetime.now()) - datetime.timedelta(days=days)
+    return cutoff.replace(minute=0, second=0, microsecond=0).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+class RetentionJob:
+    """Compacts old raw readings into hourly summaries and prunes them in batches"""
+
+    def __init__(self, batch_size, pause, ingest_backlog):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.ingest_backlog = ingest_backlog
+        self.last_report = None
+        self._running = threading.Lock()
+
+    def _wait_for_ingest(self):
+        # Live writes go first; back off while the write buffer is busy
+        while write_buffer.stats()["pending"] > self.ingest_backlog:
+            time.sleep(self.pause)
+
+    def _flush(self, device, hours, report, dry_run):
+        """Summarize and delete a batch of one device's whole hours"""
+        summaries, checkpoint_path = retention_paths(device)
+        first, last = hours[0][0], hours[-1][0]
+        stored = storage.query(summaries, start_at=first, end_at=last)
+        updates = {}
+        for bucket, readings in hours:
+            summary = None
+            for reading in readings:
+                summary = rollup_add(summary, reading)
+            existing = stored.get(bucket)
+            # Ingest keeps hour rollups current; only fill in ones that are missing or short
+            if existing is None or existing.get("count", 0) < summary["count"]:
+                updates[f"{summaries}/{bucket}"] = summary
+                report["summaries_written"] += 1
+            for reading in readings:
+                updates[f"{device_path(device)}/{reading['timestamp']}"] = None
+            report["readings"] += len(readings)
+        report["hours"] += len(hours)
+        report["batches"] += 1
+        cursor = report["cursors"][device] = hours[-1][1][-1]["timestamp"]
+        if dry_run:
+            return
+
+        self._wait_for_ingest()
+        updates[checkpoint_path] = {
+            "cursor": cursor,
+            "cutoff": report["cutoff"],
+            "complete": False,
+            "updated_at": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        }
+        storage.update(updates)
+        print(f"Retention: pruned {report['readings']} readings through {cursor} for device {device}")
+        time.sleep(self.pause)
+
+    def run(self, days, dry_run=False):
+        """Prune readings older than `days`; returns a report, or None if a run is in progress"""
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            return self._run(days, dry_run)
+        finally:
+            self._running.release()
+
+    def _run(self, days, dry_run):
+        cutoff = retention_cutoff(days)
+        end = (datetime.datetime.strptime(cutoff, "%Y-%m-%dT%H:%M:%S")
+               - datetime.timedelta(seconds=1)).strftime("%Y-%m-%dT%H:%M:%S")
+        devices = fleet_devices()
+        report = {
+            "dry_run": dry_run,
+            "cutoff": cutoff,
+            "devices": len(devices),
+            "resumed_from": {},
+            "readings": 0,
+            "hours": 0,
+            "summaries_written": 0,
+            "batches": 0,
+            "cursors": {},
+            "started_at": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        }
+        for device in devices:
+            self._prune_device(device, end, report, dry_run)
+
+        report["finished_at"] = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        if not dry_run and report["cursors"].get(DEFAULT_DEVICE_ID):
+            reading_cache.invalidate()
+        self.last_report = report
+        return report
+
+    def _prune_device(self, device, end, report, dry_run):
+        _, checkpoint_path = retention_paths(device)
+        # Resume an interrupted run; a completed one starts over to catch late readings
+        checkpoint = storage.get(checkpoint_path) or {}
+        resume = None if checkpoint.get("complete") else checkpoint.get("cursor")
+        if resume:
+            report["resumed_from"][device] = resume
+
+        # Hours are never split across batches, so every summary sees its whole hour
+        batch = []
+        batch_size = 0
+        current = None
+        for page in iter_reading_pages(None, end, resume, self.batch_size, device):
+            for reading in page:
+                bucket = reading["timestamp"][:ROLLUP_RESOLUTIONS["hour"]]
+                if current is None or current[0] != bucket:
+                    if current is not None:
+                        batch.append(current)
+                        batch_size += len(current[1])
+                        if batch_size >= self.batch_size:
+                            self._flush(device, batch, report, dry_run)
+                            batch, batch_size = [], 0
+                    current = (bucket, [])
+                current[1].append(reading)
+        if current is not None:
+            batch.append(current)
+        if batch:
+            self._flush(device, batch, report, dry_run)
+
+        if not dry_run:
+            storage.update({checkpoint_path: {
+                "cursor": report["cursors"].get(device),
+                "cutoff": report["cutoff"],
+                "complete": True,
+                "updated_at": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+            }})
+
+
+retention_job = RetentionJob(RETENTION_BATCH_SIZE, RETENTION_PAUSE, RETENTION_INGEST_BACKLOG)
+
+
+def retention_loop():
+    while True:
+        time.sleep(RETENTION_INTERVAL)
+        if not storage.available:
+            continue
+        try:
+            retention_job.run(RETENTION_DAYS)
+        except Exception as e:
+            print(f"Retention run failed: {e}")
+
+
+if RETENTION_DAYS > 0 and RETENTION_INTERVAL > 0:
+    threading.Thread(target=retention_loop, name="retention", daemon=True).start()
+
+
+@app.cli.command("prune-water-data")
+@click.option("--days", type=float, default=None, help="Raw readings to keep, in days (default RETENTION_DAYS).")
+@click.option("--dry-run", is_flag=True, help="Report what would be compacted and pruned without writing.")
+def prune_water_data_command(days, dry_run):
+    """Compact raw readings older than the retention window into hourly summaries and prune them."""
+    days = RETENTION_DAYS if days is None else days
+    if days <= 0:
+        print("Set RETENTION_DAYS or pass --days to choose a retention window")
+        return
+    if not storage.available:
+        print("Storage is not initialized; nothing to prune")
+        return
+
+    report = retention_job.run(days, dry_run=dry_run)
+    if report is None:
+        print("A retention run is already in progress")
+        return
+    action = "Would prune" if dry_run else "Pruned"
+    print(f"{action} {report['readings']} readings in {report['hours']} hours before {report['cutoff']}; "
+          f"{report['summaries_written']} hourly summaries {'needed' if dry_run else 'written'}")
+
+
+# ---------- DEVICES ----------
+# Each device writes to its own partition. The default device keeps the
+# original water_data path; any other device writes under
+# devices/<id>/water_data. Ingest also maintains latest/<id>, the newest
+# reading per device, so the latest reading is a single lookup, and
+# registers devices under fleet/<id>.
+#
+# Threshold alerts, /fleet, /data?device=, /export and retention cover
+# every device. Rollups, anomaly detection, forecasts, the reading cache,
+# the live stream and the backfill commands follow the default device only.
+
+DEFAULT_DEVICE_ID = os.environ.get("DEFAULT_DEVICE_ID", "default")
+DEVICE_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+FLEET_WORKERS = int(os.environ.get("FLEET_WORKERS", "8"))
+MAX_FLEET_DEVICES = int(os.environ.get("MAX_FLEET_DEVICES", "200"))
+# Devices whose latest reading is older than this are reported offline
+FLEET_STALE_SECONDS = float(os.environ.get("FLEET_STALE_SECONDS", "300"))
+
+
+def parse_device_id(value):
+    """Validate a device ID; missing IDs belong to the default device"""
+    if value is None or value == "":
+        return DEFAULT_DEVICE_ID
+    value = str(value)
+    if not DEVICE_ID_PATTERN.fullmatch(value):
+        raise ValueError("device_id must be 1-64 letters, digits, '-' or '_'")
+    return value
+
+
+def device_path(device=None):
+    """Storage path holding a device's readings"""
+    if device is None or device == DEFAULT_DEVICE_ID:
+        return "water_data"
+    return f"devices/{device}/water_data"
+
+
+class LatestIndex:
+    """Newest reading key per device, mirroring latest/<device> in storage"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = {}
+
+    def _known(self, device):
+        if device not in self._keys:
+            try:
+                record = storage.get(f"latest/{device}")
+            except Exception as e:
+                # Not cached, so the next ingest asks again
+                print(f"Error reading latest/{device}: {e}")
+                return None
+            self._keys[device] = record.get("timestamp") if record else None
+        return self._keys[device]
+
+    def missing(self, devices):
+        """Devices whose latest/<device> entry has not been read yet"""
+        with self._lock:
+            return sorted(set(devices) - set(self._keys))
+
+    def preload(self, records):
+        """Adopt {device: latest/<device> value} fetched elsewhere, e.g. by the async app"""
+        with self._lock:
+            for device, record in records.items():
+                self._keys.setdefault(device, record.get("timestamp") if record else None)
+
+    def updates(self, newest):
+        """latest/ and fleet/ writes for {device: (key, record)}; commit() once they are queued"""
+        updates = {}
+        with self._lock:
+            for device, (key, record) in newest.items():
+                known = self._known(device)
+                if known is None:
+                    updates[f"fleet/{device}"] = {"first_seen": key}
+                if known is None or key >= known:
+                    updates[f"latest/{device}"] = dict(record, timestamp=key)
+        return updates
+
+    def commit(self, newest):
+        with self._lock:
+            for device, (key, _) in newest.items():
+                if self._keys.get(device) is None or key >= self._keys[device]:
+                    self._keys[device] = key
+
+
+latest_index = LatestIndex()
+fleet_executor = ThreadPoolExecutor(max_workers=FLEET_WORKERS, thread_name_prefix="fleet")
+
+
+def fleet_devices():
+    """Registered device IDs, always including the default device"""
+    registry = storage.get("fleet") or {}
+    return sorted(set(registry) | {DEFAULT_DEVICE_ID})
+
+
+def get_fleet(devices=None):
+    """Latest reading and status for each device, fetched concurrently"""
+    if not storage.available:
+        return []
+
+    devices = devices or fleet_devices()
+    now = datetime.datetime.now()
+    fleet = []
+    for device, reading in zip(devices, fleet_executor.map(get_latest_reading, devices)):
+        entry = {"device": device, "online": False, "age_seconds": None, "latest": None}
+        if reading:
+            age = (now - datetime.datetime.fromisoformat(reading["timestamp"])).total_seconds()
+            entry["online"] = age <= FLEET_STALE_SECONDS
+            entry["age_seconds"] = round(age, 1)
+            entry["latest"] = dict(format_reading(reading), params=reading["params"])
+        fleet.append(entry)
+    return fleet
+
+
+# ---------- ALERTS ----------
+# Threshold rules are checked against every reading at ingest. A rule fires
+# after `for_count` consecutive readings beyond its threshold and resolves
+# once a reading is back past its clear level, so a value hovering at the
+# limit cannot raise an alert storm. Rules are indexed by field and sorted by
+# threshold, so each reading only touches the rules it breaches plus the
+# ones already pending or firing for its device. Firing and resolved events
+# are stored under alerts/ and handed to the notification sinks (log,
+# webhook, email) through per-sink queues, off the ingest path.
+
+ALERT_DEBOUNCE = int(os.environ.get("ALERT_DEBOUNCE", "2"))
+# Clear level as a fraction of the threshold, on the safe side of it
+ALERT_HYSTERESIS = float(os.environ.get("ALERT_HYSTERESIS", "0.05"))
+ALERT_BACKLOG = int(os.environ.get("ALERT_BACKLOG", "200"))
+ALERT_QUEUE_SIZE = int(os.environ.get("ALERT_QUEUE_SIZE", "1000"))
+# JSON list of rule objects (see AlertRule) replacing DEFAULT_ALERT_RULES
+ALERT_RULES_FILE = os.environ.get("ALERT_RULES_FILE")
+# Comma-separated sink names from ALERT_SINK_TYPES
+ALERT_SINKS = os.environ.get("ALERT_SINKS", "log")
+ALERT_WEBHOOK_URL = os.environ.get("ALERT_WEBHOOK_URL")
+ALERT_WEBHOOK_TIMEOUT = float(os.environ.get("ALERT_WEBHOOK_TIMEOUT", "5"))
+ALERT_SMTP_HOST = os.environ.get("ALERT_SMTP_HOST", "localhost")
+ALERT_SMTP_PORT = int(os.environ.get("ALERT_SMTP_PORT", "587"))
+ALERT_SMTP_USER = os.environ.get("ALERT_SMTP_USER")
+ALERT_SMTP_PASSWORD = os.environ.get("ALERT_SMTP_PASSWORD")
+ALERT_EMAIL_FROM = os.environ.get("ALERT_EMAIL_FROM", "hydroai@localhost")
+ALERT_EMAIL_TO = os.environ.get("ALERT_EMAIL_TO", "")
+ALERT_FIELDS = ("tds", "temperature") + DERIVED_FIELDS
+
+# Limits from get_water_quality_standards() and the TDS risk levels
+DEFAULT_ALERT_RULES = (
+    {"name": "tds_acceptable", "field": "tds", "op": "above", "threshold": TDS_LIMITS[0][1],
+     "severity": "warning", "message": "TDS above the WHO/EPA/BIS acceptable limit"},
+    {"name": "tds_hazardous", "field": "tds", "op": "above", "threshold": TDS_QUALITY_THRESHOLDS[-1],
+     "severity": "critical", "message": "TDS in the Hazardous (Critical risk) band"},
+    {"name": "tds_permissible", "field": "tds", "op": "above", "threshold": TDS_LIMITS[1][1],
+     "severity": "critical", "message": "TDS above the BIS permissible limit"},
+    {"name": "ph_low", "field": "ph", "op": "below", "threshold": 6.5,
+     "severity": "warning", "message": "pH below the 6.5-8.5 range"},
+    {"name": "ph_high", "field": "ph", "op": "above", "threshold": 8.5,
+     "severity": "warning", "message": "pH above the 6.5-8.5 range"},
+    {"name": "turbidity_high", "field": "turbidity", "op": "above", "threshold": 5,
+     "severity": "warning", "message": "Turbidity above 5 NTU"},
+    {"name": "chlorine_high", "field": "chlorine", "op": "above", "threshold": 4,
+     "severity": "warning", "message": "Chlorine above the EPA 4 mg/L limit"},
+    {"name": "hardness_high", "field": "hardness", "op": "above", "threshold": 300,
+     "severity": "warning", "message": "Hardness above the BIS 300 mg/L limit"}
+)
+
+ALERTS_RAISED = metrics.REGISTRY.counter(
+    "hydroai_alerts_total", "Alert state changes", ("rule", "severity", "state"))
+ALERT_NOTIFICATIONS = metrics.REGISTRY.counter(
+    "hydroai_alert_notifications_total", "Alert notifications by sink and outcome", ("sink", "outcome"))
+
+
+class AlertRule:
+    """A threshold on one reading field, optionally limited to some devices"""
+
+    __slots__ = ("name", "field", "op", "threshold", "clear", "for_count", "severity", "message",
+                 "devices", "sign")
+
+    def __init__(self, name, field, op, threshold, clear=None, for_count=None, severity="warning",
+                 message=None, devices=None):
+        if field not in ALERT_FIELDS:
+            raise ValueError(f"Alert rule {name}: field must be one of {', '.join(ALERT_FIELDS)}")
+        if op not in ("above", "below"):
+            raise ValueError(f"Alert rule {name}: op must be above or below")
+        self.name = name
+        self.field = field
+        self.op = op
+        # Comparisons are done as sign * value > sign * threshold
+        self.sign = 1 if op == "above" else -1
+        self.threshold = float(threshold)
+        if clear is None:
+            clear = self.threshold - self.sign * abs(self.threshold) * ALERT_HYSTERESIS
+        self.clear = float(clear)
+        if self.sign * self.clear > self.sign * self.threshold:
+            raise ValueError(f"Alert rule {name}: clear must be on the safe side of threshold")
+        self.for_count = max(1, int(for_count if for_count is not None else ALERT_DEBOUNCE))
+        self.severity = severity
+        self.message = message or f"{field} {op} {threshold:g}"
+        self.devices = tuple(parse_device_id(d) for d in devices) if devices else None
+
+    def describe(self):
+        return {name: getattr(self, name) for name in self.__slots__ if name != "sign"}
+
+
+class RuleIndex:
+    """Rules grouped by (device scope, field) and sorted by signed threshold
+
+    breached() finds every rule a value crosses with one bisect per group.
+    """
+
+    def __init__(self, rules):
+        self.rules = {rule.name: rule for rule in rules}
+        groups = collections.defaultdict(list)
+        for rule in rules:
+            for scope in rule.devices or ("*",):
+                groups[(scope, rule.field, rule.sign)].append(rule)
+        self._groups = {}
+        for key, members in groups.items():
+            members.sort(key=lambda rule: rule.sign * rule.threshold)
+            self._groups[key] = ([rule.sign * rule.threshold for rule in members], members)
+        self._scopes = {key[0] for key in self._groups}
+
+    def breached(self, device, field, value):
+        found = []
+        for scope in ("*", device):
+            if scope not in self._scopes:
+                continue
+            for sign in (1, -1):
+                group = self._groups.get((scope, field, sign))
+                if group:
+                    thresholds, members = group
+                    found.extend(members[:bisect.bisect_left(thresholds, sign * value)])
+        return found
+
+
+def load_alert_rules():
+    rules = DEFAULT_ALERT_RULES
+    if ALERT_RULES_FILE:
+        with open(ALERT_RULES_FILE) as f:
+            rules = json.load(f)
+    return [AlertRule(**rule) for rule in rules]
+
+
+class AlertEngine:
+    """Per-device rule state, updated incrementally as readings arrive
+
+    Only rules that are pending (breached, not yet for_count times) or firing
+    are tracked, as {device: {rule name: (consecutive breaches, firing)}}.
+    """
+
+    def __init__(self, rules):
+        self.index = RuleIndex(rules)
+        self._states = {}
+        self._recent = collections.deque(maxlen=ALERT_BACKLOG)
+        self._lock = threading.Lock()
+
+    def _event(self, rule, device, key, value, state):
+        return {
+            "key": key,
+            "device": device,
+            "rule": rule.name,
+            "field": rule.field,
+            "value": value,
+            "threshold": rule.threshold,
+            "severity": rule.severity,
+            "state": state,
+            "message": rule.message
+        }
+
+    def observe(self, readings):
+        """Evaluate (device, key, values) readings; returns ({path: event}, undo state)"""
+        found = {}
+        with self._lock:
+            undo = {}
+            for device, key, values in readings:
+                if device not in undo:
+                    undo[device] = dict(self._states[device]) if device in self._states else None
+                tracked = self._states.setdefault(device, {})
+                breached = set()
+                for field, value in values.items():
+                    if is_missing(value):
+                        continue
+                    for rule in self.index.breached(device, field, value):
+                        breached.add(rule.name)
+                        count, firing = tracked.get(rule.name, (0, False))
+                        count += 1
+                        if not firing and count >= rule.for_count:
+                            firing = True
+                            found[f"alerts/{key}_{device}_{rule.name}"] = self._event(rule, device, key, value, "firing")
+                        tracked[rule.name] = (count, firing)
+
+                for name, (count, firing) in list(tracked.items()):
+                    if name in breached:
+                        continue
+                    rule = self.index.rules[name]
+                    value = values.get(rule.field)
+                    if value is None or is_missing(value):
+                        continue
+                    if not firing:
+                        # A pending breach has to be consecutive
+                        del tracked[name]
+                    elif rule.sign * value <= rule.sign * rule.clear:
+                        del tracked[name]
+                        found[f"alerts/{key}_{device}_{name}"] = self._event(rule, device, key, value, "resolved")
+                    else:
+                        # Between the clear level and the threshold: still firing
+                        tracked[name] = (0, True)
+        return found, undo
+
+    def commit(self, found):
+        with self._lock:
+            self._recent.extend(found.values())
+        for event in found.values():
+            ALERTS_RAISED.inc(rule=event["rule"], severity=event["severity"], state=event["state"])
+        alert_notifier.publish(list(found.values()))
+
+    def rollback(self, undo):
+        with self._lock:
+            for device, states in undo.items():
+                if states is None:
+                    self._states.pop(device, None)
+                else:
+                    self._states[device] = states
+
+    def recent(self, since=None):
+        with self._lock:
+            return [event for event in self._recent if since is None or event["key"] > since]
+
+    def active(self):
+        """Rules currently firing, per device"""
+        with self._lock:
+            return [{"device": device, "rule": name, "severity": self.index.rules[name].severity}
+                    for device, tracked in sorted(self._states.items())
+                    for name, (_, firing) in sorted(tracked.items()) if firing]
+
+
+class LogSink:
+    name = "log"
+
+    def send(self, event):
+        print(f"ALERT {event['state'].upper()} [{event['severity']}] {event['device']}: "
+              f"{event['message']} ({event['field']}={event['value']} at {event['key']})")
+
+
+class WebhookSink:
+    """POSTs each event as JSON to ALERT_WEBHOOK_URL"""
+    name = "webhook"
+
+    def __init__(self, url=None, timeout=None):
+        self.url = url or ALERT_WEBHOOK_URL
+        self.timeout = timeout or ALERT_WEBHOOK_TIMEOUT
+        if not self.url:
+            raise ValueError("The webhook alert sink needs ALERT_WEBHOOK_URL")
+
+    def send(self, event):
+        import urllib.request
+        req = urllib.request.Request(self.url, data=json.dumps(event).encode(),
+                                     headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=self.timeout) as response:
+            response.read()
+
+
+class EmailSink:
+    """Mails each event to ALERT_EMAIL_TO through ALERT_SMTP_HOST"""
+    name = "email"
+
+    def __init__(self):
+        self.recipients = [address.strip() for address in ALERT_EMAIL_TO.split(",") if address.strip()]
+        if not self.recipients:
+            raise ValueError("The email alert sink needs ALERT_EMAIL_TO")
+
+    def send(self, event):
+        import smtplib
+        from email.message import EmailMessage
+        message = EmailMessage()
+        message["Subject"] = f"[HYDROAI {event['severity']}] {event['state']}: {event['message']} ({event['device']})"
+        message["From"] = ALERT_EMAIL_FROM
+        message["To"] = ", ".join(self.recipients)
+        message.set_content(json.dumps(event, indent=2))
+        with smtplib.SMTP(ALERT_SMTP_HOST, ALERT_SMTP_PORT, timeout=ALERT_WEBHOOK_TIMEOUT) as smtp:
+            if ALERT_SMTP_USER:
+                smtp.starttls()
+                smtp.login(ALERT_SMTP_USER, ALERT_SMTP_PASSWORD or "")
+            smtp.send_message(message)
+
+
+ALERT_SINK_TYPES = {"log": LogSink, "webhook": WebhookSink, "email": EmailSink}
+
+
+class AlertNotifier:
+    """Delivers alert events to each sink from its own bounded queue and thread
+
+    publish() never blocks: when a sink's queue is full the event is dropped
+    for that sink and counted, so a slow webhook cannot hold up ingest or the
+    other sinks.
+    """
+
+    def __init__(self, sinks, capacity):
+        self.sinks = sinks
+        self._queues = {}
+        for sink in sinks:
+            self._queues[sink.name] = queue.Queue(maxsize=capacity)
+            threading.Thread(target=self._deliver, args=(sink, self._queues[sink.name]),
+                             name=f"alerts-{sink.name}", daemon=True).start()
+
+    def publish(self, events):
+        for event in events:
+            for name, pending in self._queues.items():
+                try:
+                    pending.put_nowait(event)
+                except queue.Full:
+                    ALERT_NOTIFICATIONS.inc(sink=name, outcome="dropped")
+
+    @staticmethod
+    def _deliver(sink, pending):
+        while True:
+            event = pending.get()
+            try:
+                sink.send(event)
+                ALERT_NOTIFICATIONS.inc(sink=sink.name, outcome="sent")
+            except Exception as e:
+                ALERT_NOTIFICATIONS.inc(sink=sink.name, outcome="failed")
+                print(f"Alert sink {sink.name} failed: {e}")
+            finally:
+                pending.task_done()
+
+    def pending(self):
+        return sum(pending.qsize() for pending in self._queues.values())
+
+    def join(self):
+        for pending in self._queues.values():
+            pending.join()
+
+
+def create_alert_sinks(names):
+    sinks = []
+    for name in filter(None, (name.strip() for name in names.split(","))):
+        if name not in ALERT_SINK_TYPES:
+            raise ValueError(f"Unknown alert sink {name}; expected one of {', '.join(ALERT_SINK_TYPES)}")
+        sinks.append(ALERT_SINK_TYPES[name]())
+    return sinks
+
+
+alert_engine = AlertEngine(load_alert_rules())
+alert_notifier = AlertNotifier(create_alert_sinks(ALERT_SINKS), ALERT_QUEUE_SIZE)
+metrics.REGISTRY.gauge("hydroai_alert_notifications_pending", "Alert notifications waiting for a sink",
+                       alert_notifier.pending)
+
+
+def get_alerts(since, limit):
+    """Stored alert events after `since`, including ones still waiting to be written"""
+    found = {}
+    if storage.available:
+        try:
+            if since:
+                # Keys are <reading key>_<device>_<rule>; "~" sorts after every device ID
+                found = storage.query("alerts", start_at=f"{since}_~", limit_to_first=limit)
+            else:
+                found = storage.query("alerts", limit_to_last=limit)
+        except Exception as e:
+            print(f"Error fetching alerts: {e}")
+    for event in alert_engine.recent(since):
+        found[f"{event['key']}_{event['device']}_{event['rule']}"] = event
+    events = [found[key] for key in sorted(found)]
+    return events[:limit] if since else events[-limit:]
+
+
 # ---------- ORIGINAL FUNCTIONS ----------
 
-def get_sensor_data():
-    """Fetch latest TDS and temperature data from Firebase."""
-    if not firebase_initialized:
+def readings_from(data):
+    """Turn {key: {"tds", "temperature", derived parameters}} children into reading dicts sorted by key
+
+    Readings stored before parameters were derived at ingest get them derived
+    here, in one vectorized pass (see `flask backfill-parameters`).
+    """
+    readings = []
+    pending = []
+    for key, value in data.items():
+        reading = {
+            "timestamp": key,
+            "tds": float(value.get("tds", 0)),
+            "temperature": float(value.get("temperature", 0))
+        }
+        if "ph" in value:
+            reading["params"] = {field: value[field] for field in DERIVED_FIELDS}
+        else:
+            pending.append(reading)
+        readings.append(reading)
+    if pending:
+        derived = derive_parameters_bulk([r["timestamp"] for r in pending], [r["tds"] for r in pending],
+                                         [r["temperature"] for r in pending])
+        for reading, params in zip(pending, derived):
+            reading["params"] = params
+    # Sort by timestamp
+    readings.sort(key=lambda x: x["timestamp"])
+    return readings
+
+
+def fetch_sensor_data(limit, device=None):
+    """Fetch the last `limit` TDS and temperature readings straight from storage."""
+    return readings_from(storage.query(device_path(device), limit_to_last=limit))
+
+
+def fetch_sensor_data_since(key, limit, device=None):
+    """Fetch up to `limit` readings with keys strictly after `key` from storage."""
+    data = storage.query(device_path(device), start_at=key, limit_to_first=limit + 1)
+    return [r for r in readings_from(data) if r["timestamp"] > key][:limit]
+
+
+def fetch_sensor_data_range(start, end, limit, device=None):
+    """Fetch up to `limit` readings with keys in [start, end] from storage."""
+    return readings_from(storage.query(device_path(device), start_at=start, end_at=end, limit_to_first=limit))
+
+
+def fetch_sensor_data_before(key, limit, device=None):
+    """Fetch up to `limit` readings with keys strictly before `key` from storage."""
+    data = storage.query(device_path(device), end_at=key, limit_to_last=limit + 1)
+    return [r for r in readings_from(data) if r["timestamp"] < key][-limit:]
+
+
+def iter_reading_pages(start, end, after, page_size, device=None):
+    """Yield a device's readings in key order, one storage query of `page_size` per page
+
+    Only keys in [start, end] and strictly after `after` are returned; any
+    bound may be None. Memory stays at one page whatever the range.
+    """
+    path = device_path(device)
+    while True:
+        if after is not None and (start is None or after >= start):
+            data = storage.query(path, start_at=after, end_at=end, limit_to_first=page_size + 1)
+            page = [r for r in readings_from(data) if r["timestamp"] > after][:page_size]
+        else:
+            page = readings_from(storage.query(path, start_at=start, end_at=end,
+                                               limit_to_first=page_size))
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        after = page[-1]["timestamp"]
+
+
+@app.cli.command("backfill-parameters")
+@click.option("--batch-size", type=int, default=1000, show_default=True,
+              help="Readings scanned per storage query.")
+@click.option("--dry-run", is_flag=True, help="Count readings lacking derived parameters without writing.")
+def backfill_parameters_command(batch_size, dry_run):
+    """Store derived parameters on readings written before they were computed at ingest."""
+    if not storage.available:
+        print("Storage is not initialized; nothing to backfill")
+        return
+
+    after = None
+    scanned = updated = 0
+    while True:
+        data = storage.query("water_data", start_at=after, limit_to_first=batch_size + 1)
+        rows = sorted((key, value) for key, value in data.items() if after is None or key > after)[:batch_size]
+        if not rows:
+            break
+        pending = [(key, value) for key, value in rows
+                   if "ph" not in value and not is_missing(float(value.get("tds", 0)))]
+        if pending:
+            derived = derive_parameters_bulk([key for key, _ in pending],
+                                             [float(value.get("tds", 0)) for _, value in pending],
+                                             [float(value.get("temperature", 0)) for _, value in pending])
+            if not dry_run:
+                # Whole records, so a path update never drops tds/temperature
+                storage.update({f"water_data/{key}": dict(value, **params)
+                                for (key, value), params in zip(pending, derived)})
+        scanned += len(rows)
+        updated += len(pending)
+        if len(rows) < batch_size:
+            break
+        after = rows[-1][0]
+
+    if not dry_run:
+        reading_cache.invalidate()
+    action = "Would backfill" if dry_run else "Backfilled"
+    print(f"{action} derived parameters on {updated} of {scanned} readings")
+
+
+@metrics.timed(STAGE_LATENCY, stage="get_sensor_data")
+def get_sensor_data(limit=20):
+    """Fetch latest TDS and temperature data, served from the reading cache when fresh."""
+    if not storage.available:
         return []
 
+    cached = reading_cache.get(limit)
+    if cached is not None:
+        return cached
+
     try:
-        ref = db.reference("water_data")
-        data = ref.order_by_key().limit_to_last(20).get()
-
-        readings = []
-        if data:
-            for key, value in data.items():
-                readings.append({
-                    "timestamp": key,
-                    "tds": float(value.get("tds", 0)),
-                    "temperature": float(value.get("temperature", 0))
-                })
-            # Sort by timestamp
-            readings.sort(key=lambda x: x["timestamp"])
-        return readings
+        # Only one thread refetches the window; the others wait and reuse it
+        with reading_cache.fill_lock:
+            cached = reading_cache.get(limit, count=False)
+            if cached is not None:
+                return cached
+            readings = fetch_sensor_data(max(limit, reading_cache.size))
+            reading_cache.fill(readings)
+            cached = reading_cache.get(limit, count=False)
+        return cached if cached is not None else readings[-limit:]
     except Exception as e:
-        print(f"Error fetching Firebase data: {e}")
+        print(f"Error fetching sensor data: {e}")
         return []
 
 
-def get_latest_reading():
-    """Get the most recent reading from Firebase."""
-    if not firebase_initialized:
-        return None
+def get_sensor_data_json(limit=20):
+    """get_sensor_data() as a /data payload, joined from records encoded at ingest."""
+    payload = reading_cache.get_json(limit)
+    if payload is None:
+        readings = get_sensor_data(limit)
+        payload = reading_cache.get_json(limit) or join_json(map(reading_json, readings))
+    return payload
+
+
+def get_sensor_data_since_json(key, limit):
+    """get_sensor_data_since() as a /data payload."""
+    payload = reading_cache.since_json(key, limit) if storage.available else None
+    if payload is None:
+        payload = join_json(map(reading_json, get_sensor_data_since(key, limit)))
+    return payload
+
+
+def get_sensor_data_since(key, limit):
+    """Readings after `key`, answered from the cached window when it reaches back far enough."""
+    if not storage.available:
+        return []
+
+    cached = reading_cache.since(key, limit)
+    if cached is not None:
+        return cached
 
     try:
-        ref = db.reference("water_data")
-        data = ref.order_by_key().limit_to_last(1).get()
-
-        if data:
-            for key, value in data.items():
-                return {
-                    "timestamp": key,
-                    "tds": float(value.get("tds", 0)),
-                    "temperature": float(value.get("temperature", 0))
-                }
+        return fetch_sensor_data_since(key, limit)
+    except Exception as e:
+        print(f"Error fetching readings since {key}: {e}")
+        return []
+
+
+def get_sensor_data_before(key, limit):
+    """One page of history ending just before `key`."""
+    if not storage.available:
+        return []
+
+    try:
+        return fetch_sensor_data_before(key, limit)
+    except Exception as e:
+        print(f"Error fetching readings before {key}: {e}")
+        return []
+
+
+def get_sensor_data_range(start, end, limit):
+    """Raw readings between two keys, oldest first."""
+    if not storage.available:
+        return []
+
+    try:
+        return fetch_sensor_data_range(start, end, limit)
+    except Exception as e:
+        print(f"Error fetching readings between {start} and {end}: {e}")
+        return []
+
+
+def get_device_readings(device, limit, since=None, before=None, range_query=None):
+    """Raw readings from one device's partition, for the /data query arguments."""
+    if not storage.available:
+        return []
+
+    try:
+        if range_query:
+            start, end, _ = range_query
+            return fetch_sensor_data_range(start, end, limit, device)
+        if before:
+            return fetch_sensor_data_before(before, limit, device)
+        if since:
+            return fetch_sensor_data_since(since, limit, device)
+        return fetch_sensor_data(limit, device)
+    except Exception as e:
+        print(f"Error fetching readings for device {device}: {e}")
+        return []
+
+
+@metrics.timed(STAGE_LATENCY, stage="get_latest_reading")
+def get_latest_reading(device=None):
+    """Get a device's most recent reading with one lookup in the latest/<device> index.
+
+    The default device is read from the newest water_data key instead (via
+    the reading cache): firmware writing straight to /water_data never
+    updates its index entry. Devices with no index entry yet, e.g. data
+    stored before it existed, fall back to querying their partition.
+    """
+    if not storage.available:
         return None
+
+    device = device or DEFAULT_DEVICE_ID
+    try:
+        if device == DEFAULT_DEVICE_ID:
+            readings = get_sensor_data(1)
+            return readings[-1] if readings else None
+        record = storage.get(f"latest/{device}")
+        if record:
+            record = dict(record)
+            return readings_from({record.pop("timestamp"): record})[0]
+        readings = fetch_sensor_data(1, device)
+        return readings[-1] if readings else None
     except Exception as e:
-        print(f"Error fetching latest reading: {e}")
+        print(f"Error fetching latest reading for device {device}: {e}")
         return None
 
 
-def add_real_time_data(tds, temperature):
-    """Add real-time sensor data to Firebase."""
-    if not firebase_initialized:
-        return False
+@metrics.timed(STAGE_LATENCY, stage="add_real_time_data")
+def add_real_time_data(tds, temperature, timestamp=None):
+    """Queue real-time sensor data for storage via the write-behind buffer.
 
-    try:
-        ref = db.reference("water_data")
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    Returns a WriteTicket, or None when storage is unavailable.
+    """
+    return add_real_time_batch([{
+        "tds": tds,
+        "temperature": temperature,
+        "timestamp": timestamp
+    }])
 
+
+@metrics.timed(STAGE_LATENCY, stage="add_real_time_batch")
+def add_real_time_batch(readings):
+    """Queue a batch of readings as one write-behind submission.
+
+    Raises BufferFullError when the buffer has no room for the whole batch,
+    IngestLockedError when another process owns ingest, and ValueError when
+    two readings for a device share a timestamp: keys have one-second
+    resolution, so the later reading would overwrite the earlier.
+    """
+    if not storage.available:
+        return None
+    if not ingest_lock.acquire():
+        raise IngestLockedError("Another process owns ingest for this database; retry later")
+
+    now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    timestamps = [reading.get("timestamp") or now for reading in readings]
+    keys = {(reading.get("device") or DEFAULT_DEVICE_ID, timestamp)
+            for reading, timestamp in zip(readings, timestamps)}
+    if len(keys) != len(readings):
+        raise ValueError("Readings in a batch need distinct timestamps; "
+                         "send a timestamp with each reading, at most one per second")
+    # Derived parameters are computed once here and stored with the reading
+    derived = derive_parameters_bulk(timestamps, [float(r["tds"]) for r in readings],
+                                     [float(r["temperature"]) for r in readings])
+    updates = {}
+    stored = []
+    newest = {}
+    evaluated = []
+    for timestamp, reading, params in zip(timestamps, readings, derived):
+        device = reading.get("device") or DEFAULT_DEVICE_ID
         data = {
-            "tds": tds,
-            "temperature": temperature
+            "tds": reading["tds"],
+            "temperature": reading["temperature"]
         }
+        if params["ph"] != "-":
+            data.update(params)
+        updates[f"{device_path(device)}/{timestamp}"] = data
+        evaluated.append((device, timestamp, data))
+        if device not in newest or timestamp >= newest[device][0]:
+            newest[device] = (timestamp, data)
+        # Rollups, models, the cache and the live stream follow the default device
+        if device == DEFAULT_DEVICE_ID:
+            stored.append({
+                "timestamp": timestamp,
+                "tds": float(data["tds"]),
+                "temperature": float(data["temperature"]),
+                "params": params
+            })
+
+    with rollup_engine.lock:
+        updates.update(latest_index.updates(newest))
+        touched = rollup_engine.accumulate(stored)
+        for (resolution, bucket), record in touched.items():
+            updates[f"rollups/{resolution}/{bucket}"] = record
+        anomalies, undo = anomaly_monitor.observe(stored)
+        updates.update(anomalies)
+        model_state, forecast_undo = forecast_model.observe(stored)
+        updates.update(model_state)
+        alerts, alert_undo = alert_engine.observe(evaluated)
+        updates.update(alerts)
+        try:
+            ticket = write_buffer.submit(updates)
+        except BufferFullError:
+            anomaly_monitor.rollback(undo)
+            forecast_model.rollback(forecast_undo)
+            alert_engine.rollback(alert_undo)
+            raise
+        rollup_engine.commit(touched)
+        anomaly_monitor.commit(anomalies)
+        latest_index.commit(newest)
+        alert_engine.commit(alerts)
+
+    for reading in stored:
+        reading_cache.add(reading)
+    if stored:
+        reading_broker.publish(stored)
+    print(f"Queued {len(readings)} reading(s) for storage")
+    return ticket
+
+
+def parse_reading(data):
+    """Validate one reading payload from a device"""
+    if not isinstance(data, dict):
+        raise ValueError("Each reading must be a JSON object")
+
+    reading = {
+        "tds": float(data.get('tds', 0)),
+        "temperature": float(data.get('temperature', 0)),
+        "timestamp": None,
+        "device": parse_device_id(data['device_id']) if data.get('device_id') else None
+    }
+    if data.get('timestamp'):
+        # Normalise to the key format used under water_data
+        timestamp_obj = datetime.datetime.strptime(str(data['timestamp']), "%Y-%m-%dT%H:%M:%S")
+        reading["timestamp"] = timestamp_obj.strftime("%Y-%m-%dT%H:%M:%S")
+    return reading
+
+
+# ---------- SENSOR WIRE FORMATS ----------
+# Besides JSON, /sensor_data accepts these bodies, optionally sent with
+# Content-Encoding: gzip:
+#
+#   application/msgpack            {"t0", "tds0", "temperature0", "dt": [...], "tds": [...], "temperature": [...]}
+#   application/vnd.hydroai.frame  a 16-byte FRAME_HEADER followed by 6-byte FRAME_SAMPLEs
+#
+# Both carry many delta-encoded samples as integers: TDS in tenths of a ppm
+# and temperature in hundredths of a degree. Each sample holds the seconds
+# and value changes since the previous one, starting from the base epoch and
+# values. The base epoch is Unix time (UTC) and is converted to the server's
+# local-time keys, like every other ingest path. Devices without a clock
+# send a frame epoch of 0 or a MessagePack body without "t0": the last
+# sample is then stamped with the time the request arrives. A MessagePack
+# body without "dt" is read like a JSON one.
+#
+# Readings name their device with a "device_id" field; otherwise the
+# X-Device-ID header or ?device= argument applies to the whole request.
+
+TDS_SCALE = 10
+TEMPERATURE_SCALE = 100
+FRAME_CONTENT_TYPE = "application/vnd.hydroai.frame"
+MSGPACK_CONTENT_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+FRAME_MAGIC = b"HF"
+FRAME_VERSION = 1
+# magic, version, reserved, base epoch (u32), base TDS and temperature (i32, scaled)
+FRAME_HEADER = struct.Struct("<2sBBIii")
+# seconds since the previous sample (u16), TDS and temperature changes (i16, scaled)
+FRAME_SAMPLE = struct.Struct("<Hhh")
+# Bound on a gzip-encoded body once inflated
+MAX_DECODED_BODY = int(os.environ.get("MAX_DECODED_BODY", str(1024 * 1024)))
+
+
+def request_body(req):
+    """The raw request body, inflated when it was sent gzip-encoded"""
+    body = req.get_data(cache=False)
+    encoding = req.headers.get("Content-Encoding", "identity").strip().lower()
+    if encoding == "identity":
+        return body
+    if encoding not in ("gzip", "x-gzip"):
+        raise ValueError(f"Unsupported Content-Encoding: {encoding}")
+
+    inflater = zlib.decompressobj(wbits=31)
+    body = inflater.decompress(body, MAX_DECODED_BODY)
+    if inflater.unconsumed_tail:
+        raise ValueError(f"Decoded body exceeds {MAX_DECODED_BODY} bytes")
+    if not inflater.eof:
+        raise ValueError("Truncated gzip body")
+    return body
+
+
+def delta_readings(t0, tds0, temperature0, dt, tds_steps, temperature_steps):
+    """Readings from delta-encoded sample columns (int sequences or NumPy views)"""
+    count = len(dt)
+    if not count or len(tds_steps) != count or len(temperature_steps) != count:
+        raise ValueError("Expected non-empty delta columns of the same length")
+    if count > MAX_BATCH_READINGS:
+        raise ValueError(f"At most {MAX_BATCH_READINGS} readings per batch")
+
+    now = key_to_epoch(datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"))
+
+    np = numpy_module()
+    if np is not None:
+        dt = np.asarray(dt, dtype=np.int64)
+        if dt.min() < 0:
+            raise ValueError("Sample intervals must not be negative")
+        offsets = np.cumsum(dt)
+        if t0 is None:
+            epochs = now - int(offsets[-1]) + offsets
+        else:
+            first, last = local_epoch(t0), local_epoch(t0 + int(offsets[-1]))
+            if last - first == int(offsets[-1]):
+                epochs = first + offsets
+            else:
+                # The samples span a UTC offset change; convert each one
+                epochs = np.array([local_epoch(t0 + int(offset)) for offset in offsets], dtype=np.int64)
+        # datetime64 renders the same %Y-%m-%dT%H:%M:%S keys as epoch_to_key
+        keys = np.datetime_as_string(epochs.astype("datetime64[s]")).tolist()
+        tds = ((tds0 + np.cumsum(tds_steps, dtype=np.int64)) / TDS_SCALE).tolist()
+        temperatures = ((temperature0 + np.cumsum(temperature_steps, dtype=np.int64)) / TEMPERATURE_SCALE).tolist()
+    else:
+        if min(dt) < 0:
+            raise ValueError("Sample intervals must not be negative")
+        offsets = list(itertools.accumulate(dt))
+        if t0 is None:
+            keys = [epoch_to_key(now - offsets[-1] + offset) for offset in offsets]
+        else:
+            keys = [epoch_to_key(local_epoch(t0 + offset)) for offset in offsets]
+        tds = [(tds0 + value) / TDS_SCALE for value in itertools.accumulate(tds_steps)]
+        temperatures = [(temperature0 + value) / TEMPERATURE_SCALE
+                        for value in itertools.accumulate(temperature_steps)]
+
+    return [{"timestamp": key, "tds": value, "temperature": temperature}
+            for key, value, temperature in zip(keys, tds, temperatures)]
+
+
+def decode_frame(body):
+    """Readings from a binary frame; samples are read in place from the body"""
+    view = memoryview(body)
+    if len(view) < FRAME_HEADER.size:
+        raise ValueError("Truncated frame header")
+    magic, version, _, t0, tds0, temperature0 = FRAME_HEADER.unpack_from(view)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError("Unsupported frame format")
+    if t0 == 0:
+        # The header has no null; 0 marks a device without a clock
+        t0 = None
+    samples = view[FRAME_HEADER.size:]
+    if len(samples) % FRAME_SAMPLE.size:
+        raise ValueError("Frame ends with a partial sample")
+    if len(samples) // FRAME_SAMPLE.size > MAX_BATCH_READINGS:
+        raise ValueError(f"At most {MAX_BATCH_READINGS} readings per batch")
+
+    np = numpy_module()
+    if np is not None:
+        columns = np.frombuffer(samples, dtype=np.dtype([("dt", "<u2"), ("tds", "<i2"), ("temperature", "<i2")]))
+        return delta_readings(t0, tds0, temperature0, columns["dt"], columns["tds"], columns["temperature"])
+    dt, tds, temperatures = zip(*FRAME_SAMPLE.iter_unpack(samples)) if samples else ((), (), ())
+    return delta_readings(t0, tds0, temperature0, dt, tds, temperatures)
+
+
+def decode_msgpack(body):
+    if msgpack is None:
+        raise ValueError("MessagePack payloads need the msgpack package")
+    data = msgpack.unpackb(body, raw=False)
+    if not (isinstance(data, dict) and "dt" in data):
+        return plain_readings(data)
+
+    # A missing or null t0 means the device has no clock
+    t0 = data.get("t0")
+    header = [0 if t0 is None else t0] + [data.get(name, 0) for name in ("tds0", "temperature0")]
+    columns = [data.get(name) for name in ("dt", "tds", "temperature")]
+    if not all(isinstance(value, int) for value in header) or not all(
+            isinstance(column, list) and all(isinstance(value, int) for value in column) for column in columns):
+        raise ValueError("Delta frames carry integer fields and lists of integers")
+    readings = delta_readings(t0, *header[1:], *columns)
+    if data.get("device_id"):
+        device = parse_device_id(data["device_id"])
+        for reading in readings:
+            reading["device"] = device
+    return readings
+
+
+def plain_readings(data):
+    """Readings from a decoded JSON-style body: one reading or a list of them"""
+    if isinstance(data, dict):
+        return [{
+            "tds": float(data.get('tds', 0)),
+            "temperature": float(data.get('temperature', 0)),
+            "timestamp": None,
+            "device": parse_device_id(data['device_id']) if data.get('device_id') else None
+        }]
+    if not isinstance(data, list) or not data:
+        raise ValueError("Expected a reading or a non-empty list of readings")
+    if len(data) > MAX_BATCH_READINGS:
+        raise ValueError(f"At most {MAX_BATCH_READINGS} readings per batch")
+    return [parse_reading(item) for item in data]
+
+
+def request_device(req):
+    """Device a request reports for when its readings do not name one"""
+    return parse_device_id(req.headers.get("X-Device-ID") or req.args.get("device"))
+
+
+def with_device(readings, device):
+    for reading in readings:
+        if not reading.get("device"):
+            reading["device"] = device
+    return readings
 
-        ref.child(timestamp).set(data)
-        print(f"Added real data to Firebase: TDS={tds}, Temp={temperature}")
-        return True
-    except Exception as e:
-        print(f"Error adding real-time data: {e}")
-        return False
+
+def decode_sensor_payload(req):
+    """Readings from a /sensor_data request in any supported wire format"""
+    device = request_device(req)
+    body = request_body(req)
+    if req.mimetype == FRAME_CONTENT_TYPE:
+        return with_device(decode_frame(body), device)
+    if req.mimetype in MSGPACK_CONTENT_TYPES:
+        return with_device(decode_msgpack(body), device)
+    return with_device(plain_readings(orjson.loads(body) if orjson is not None else json.loads(body)), device)
 
 
 # ---------- ROUTES ----------
 
-@app.route('/')
-def index():
-    latest_reading = get_latest_reading()
+DEFAULT_DATA_LIMIT = 20
+MAX_DATA_LIMIT = int(os.environ.get("MAX_DATA_LIMIT", "500"))
+MAX_CLASSIFY_READINGS = int(os.environ.get("MAX_CLASSIFY_READINGS", "100000"))
+# "async" acknowledges device writes with 202 once queued; "sync" waits for storage
+INGEST_MODE = os.environ.get("INGEST_MODE", "async")
+INGEST_SYNC_TIMEOUT = float(os.environ.get("INGEST_SYNC_TIMEOUT", "10"))
+
+
+def dashboard_version():
+    """Digest of the templates, static files and this module
+
+    Every worker of a deploy computes the same value, so ETags agree across
+    pre-forked processes, while a changed template or advisory table never
+    gets a stale 304. DASHBOARD_VERSION overrides it with a deploy version.
+    """
+    digest = hashlib.sha1()
+    paths = [__file__]
+    for folder in (app.template_folder, app.static_folder):
+        folder = os.path.join(app.root_path, folder)
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            paths += [os.path.join(root, name) for name in sorted(files)]
+    for path in paths:
+        digest.update(os.path.relpath(path, app.root_path).encode())
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+DASHBOARD_VERSION = os.environ.get("DASHBOARD_VERSION") or dashboard_version()
+
+
+@functools.lru_cache(maxsize=None)
+def advisory_for_bands(tds_band, temp_band, suggestion_tds_band, suggestion_temp_band):
+    """Advisory content and its pre-rendered HTML fragments for one band combination"""
+    quality_info = TDS_QUALITY_BANDS[tds_band]
+    temp_recommendations = TEMPERATURE_RECOMMENDATION_BANDS[temp_band]
+    improvement_suggestions = (IMPROVEMENT_TDS_SUGGESTIONS[suggestion_tds_band]
+                               + IMPROVEMENT_TEMPERATURE_SUGGESTIONS[suggestion_temp_band]
+                               + GENERAL_SUGGESTIONS)
+    return MappingProxyType({
+        "quality_info": quality_info,
+        "temp_recommendations": temp_recommendations,
+        "improvement_suggestions": improvement_suggestions,
+        "quality_details_html": get_template_attribute('fragments.html', 'quality_details')(quality_info),
+        "temperature_recommendations_html": get_template_attribute(
+            'fragments.html', 'temperature_recommendations')(temp_recommendations),
+        "improvement_suggestions_html": get_template_attribute(
+            'fragments.html', 'improvement_suggestions')(improvement_suggestions)
+    })
+
+
+def get_advisory(tds_value, temperature):
+    """Memoized advisory payload; it depends only on the bands the reading falls in"""
+    return advisory_for_bands(tds_quality_band(tds_value),
+                              temperature_band(temperature),
+                              improvement_tds_band(tds_value),
+                              improvement_temperature_band(temperature))
+
+
+@functools.lru_cache(maxsize=1)
+def quality_standards_fragment():
+    """The standards tab never changes, so it is rendered once per process"""
+    return get_template_attribute('fragments.html', 'quality_standards')(get_water_quality_standards())
 
+
+def dashboard_etag(latest_reading):
+    """ETag for the dashboard, keyed on the latest reading"""
+    parts = [DASHBOARD_VERSION, storage.name, str(storage.available)]
     if latest_reading:
-        latest_tds = latest_reading["tds"]
-        latest_temp = latest_reading["temperature"]
+        parts += [latest_reading["timestamp"], repr(latest_reading["tds"]), repr(latest_reading["temperature"])]
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()
 
-        # Get enhanced quality information
-        quality_info = get_tds_quality_details(latest_tds)
-        temp_recommendations = get_temperature_recommendations(latest_temp)
-        improvement_suggestions = get_improvement_suggestions(latest_tds, latest_temp)
-        additional_params = get_additional_parameters(latest_tds, latest_temp)
-        quality_standards = get_water_quality_standards()
 
+def dashboard_response(latest_reading, if_none_match):
+    """Dashboard page for a latest reading; shared with the async app"""
+    etag = dashboard_etag(latest_reading)
+    if etag in if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    if latest_reading:
+        latest_tds = latest_reading["tds"]
+        latest_temp = latest_reading["temperature"]
     else:
         latest_tds = 0
         latest_temp = 0
-        quality_info = get_tds_quality_details(0)
-        temp_recommendations = get_temperature_recommendations(0)
-        improvement_suggestions = get_improvement_suggestions(0, 0)
-        additional_params = get_additional_parameters(0, 0)
-        quality_standards = get_water_quality_standards()
-
-    return render_template('index.html',
-                           latest_tds=latest_tds,
-                           latest_temp=latest_temp,
-                           quality_info=quality_info,
-                           temp_recommendations=temp_recommendations,
-                           improvement_suggestions=improvement_suggestions,
-                           additional_params=additional_params,
-                           quality_standards=quality_standards,
-                           firebase_status=firebase_initialized,
-                           has_data=latest_reading is not None)
+
+    # Get enhanced quality information; derived parameters were stored at ingest
+    advisory = get_advisory(latest_tds, latest_temp)
+    additional_params = latest_reading["params"] if latest_reading else MISSING_PARAMETERS
+
+    with metrics.timer(STAGE_LATENCY, stage="render_template"):
+        response = make_response(render_template('index.html',
+                                                 latest_tds=latest_tds,
+                                                 latest_temp=latest_temp,
+                                                 advisory=advisory,
+                                                 additional_params=additional_params,
+                                                 quality_standards_html=quality_standards_fragment(),
+                                                 firebase_status=storage.available,
+                                                 storage_backend=storage.name,
+                                                 has_data=latest_reading is not None))
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    if latest_reading:
+        reading_time = datetime.datetime.strptime(latest_reading["timestamp"], "%Y-%m-%dT%H:%M:%S")
+        response.last_modified = reading_time.astimezone(datetime.timezone.utc)
+    return response
+
+
+@app.route('/')
+def index():
+    return dashboard_response(get_latest_reading(), request.if_none_match)
+
+
+def format_reading(reading):
+    """Shape a stored reading for chart display"""
+    # Keys are validated as %Y-%m-%dT%H:%M:%S, so the display time (HH:MM) is a slice
+    display_time = reading["timestamp"][11:16]
+
+    return {
+        "key": reading["timestamp"],
+        "timestamp": display_time,
+        "tds": reading["tds"],
+        "temperature": reading["temperature"]
+    }
+
+
+def parse_key_arg(name, args=None):
+    """Validate a water_data key passed as a query cursor"""
+    value = (request.args if args is None else args).get(name)
+    if value is None:
+        return None
+    datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+    return value
+
+
+def parse_data_query(args):
+    """Validate /data query arguments; raises ValueError
+
+    Returns (limit, since, before, range, device) where range is
+    (start, end, bucket) for ?from/?to queries and None otherwise.
+    """
+    device = parse_device_id(args.get('device'))
+    range_query = 'from' in args or 'to' in args
+    default_limit = MAX_DATA_LIMIT if range_query else DEFAULT_DATA_LIMIT
+    limit = int(args.get('limit', default_limit))
+    if limit < 1 or limit > MAX_DATA_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_DATA_LIMIT}")
+    since = parse_key_arg('since', args)
+    before = parse_key_arg('before', args)
+    if since and before:
+        raise ValueError("Use either since or before, not both")
+    if not range_query:
+        return limit, since, before, None, device
+
+    start = parse_key_arg('from', args)
+    end = parse_key_arg('to', args) or datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    if not start:
+        raise ValueError("from is required for range queries")
+    if start > end:
+        raise ValueError("from must not be after to")
+    if device != DEFAULT_DEVICE_ID:
+        # Rollups are only kept for the default device
+        bucket = args.get('bucket') or 'raw'
+        if bucket != 'raw':
+            raise ValueError("Other devices only serve bucket=raw")
+    else:
+        bucket = args.get('bucket') or choose_rollup_resolution(start, end, limit)
+    if bucket != 'raw' and bucket not in ROLLUP_RESOLUTIONS:
+        raise ValueError("bucket must be one of raw, minute, hour, day")
+    return limit, since, before, (start, end, bucket), device
 
 
 @app.route('/data')
 def data_api():
-    """API endpoint for live data chart"""
-    readings = get_sensor_data()
+    """API endpoint for live data chart
+
+    Supports key cursors: ?since=<key> for readings after a key and
+    ?before=<key> for the page of history preceding it, both bounded by ?limit.
+    ?from=<key>&to=<key>[&bucket=minute|hour|day|raw] serves a time range from
+    the rollups, picking the finest resolution that fits when bucket is omitted.
+    ?device=<id> reads another device's raw readings; rollups cover the default device.
+    """
+    try:
+        limit, since, before, range_query, device = parse_data_query(request.args)
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+
+    if device != DEFAULT_DEVICE_ID:
+        readings = get_device_readings(device, limit, since, before, range_query)
+    elif range_query:
+        start, end, bucket = range_query
+        if bucket != 'raw':
+            return jsonify(get_rollups(bucket, start, end, limit))
+        readings = get_sensor_data_range(start, end, limit)
+    elif before:
+        readings = get_sensor_data_before(before, limit)
+    else:
+        # The recent window is served from records encoded once at ingest
+        payload = get_sensor_data_since_json(since, limit) if since else get_sensor_data_json(limit)
+        return Response(payload, content_type="application/json")
     # Format for chart display
-    formatted_readings = []
-    for reading in readings:
-        # Convert timestamp to display format (HH:MM)
-        timestamp_obj = datetime.datetime.strptime(reading["timestamp"], "%Y-%m-%dT%H:%M:%S")
-        display_time = timestamp_obj.strftime("%H:%M")
+    with metrics.timer(STAGE_LATENCY, stage="format_readings"):
+        payload = join_json(map(reading_json, readings))
+    return Response(payload, content_type="application/json")
 
-        formatted_readings.append({
-            "timestamp": display_time,
-            "tds": reading["tds"],
-            "temperature": reading["temperature"]
+
+def sse_event(reading):
+    return f"id: {reading['timestamp']}\ndata: {reading_json(reading).decode()}\n\n"
+
+
+EXPORT_PAGE_SIZE = int(os.environ.get("EXPORT_PAGE_SIZE", "1000"))
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet"
+}
+
+
+@functools.lru_cache(maxsize=1)
+def pyarrow_modules():
+    """(pyarrow, pyarrow.parquet), imported on the first Parquet export; None when not installed"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow, pyarrow.parquet
+
+
+def export_csv(pages):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["device", "timestamp", "tds", "temperature"])
+    for device, page in pages:
+        writer.writerows((device, r["timestamp"], r["tds"], r["temperature"]) for r in page)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def export_ndjson(pages):
+    for device, page in pages:
+        yield b"".join(dump_json({"device": device, "timestamp": r["timestamp"], "tds": r["tds"],
+                                  "temperature": r["temperature"]}) + b"\n" for r in page)
+
+
+class ChunkSink:
+    """Write-only file object that hands back whatever was written since the last take()"""
+
+    def __init__(self):
+        self.closed = False
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def export_parquet(pages):
+    """One Parquet row group per page, streamed out as each group is written"""
+    pa, pq = pyarrow_modules()
+    schema = pa.schema([("device", pa.string()), ("timestamp", pa.string()),
+                        ("tds", pa.float64()), ("temperature", pa.float64())])
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for device, page in pages:
+            writer.write_table(pa.table({
+                "device": [device] * len(page),
+                "timestamp": [r["timestamp"] for r in page],
+                "tds": [r["tds"] for r in page],
+                "temperature": [r["temperature"] for r in page]
+            }, schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+EXPORT_ENCODERS = {"csv": export_csv, "ndjson": export_ndjson, "parquet": export_parquet}
+
+
+def iter_export_pages(devices, start, end, resume, page_size):
+    """Yield (device, readings) pages for each device's partition in turn
+
+    `resume` is a (device, key) cursor: devices listed before it are skipped
+    and its own partition continues after the key.
+    """
+    if resume is not None:
+        devices = devices[devices.index(resume[0]):]
+    for device in devices:
+        after = resume[1] if resume is not None and device == resume[0] else None
+        for page in iter_reading_pages(start, end, after, page_size, device):
+            yield device, page
+
+
+def logged_pages(pages):
+    """Pass pages through, logging the resume cursor if storage fails part way
+
+    The error is re-raised so the server aborts the response instead of
+    finishing a partial export as if it were complete.
+    """
+    last = (None, None)
+    try:
+        for device, page in pages:
+            yield device, page
+            last = (device, page[-1]["timestamp"])
+    except Exception as e:
+        print(f"Export interrupted, resume with cursor_device={last[0]}&cursor={last[1]}: {e}")
+        raise
+
+
+@app.route('/export')
+def export_api():
+    """Stream reading history as CSV, NDJSON or Parquet in key order
+
+    ?format=csv|ndjson|parquet, optional ?from=<key>&to=<key> bounds, and
+    ?cursor_device=<id>&cursor=<key> to resume an interrupted download after
+    the last device and key received. Every device partition is exported in
+    turn, each row naming its device; ?device=<id> exports just one. Readings
+    are fetched EXPORT_PAGE_SIZE at a time, so memory use does not grow with
+    the size of the export. A storage error part way aborts the response
+    rather than ending the file early.
+    """
+    try:
+        export_format = request.args.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError("format must be one of csv, ndjson, parquet")
+        if export_format == 'parquet' and pyarrow_modules() is None:
+            raise ValueError("Parquet export needs pyarrow installed")
+        start = parse_key_arg('from')
+        end = parse_key_arg('to')
+        cursor = parse_key_arg('cursor')
+        if start and end and start > end:
+            raise ValueError("from must not be after to")
+        device = request.args.get('device')
+        devices = [parse_device_id(device)] if device else None
+        cursor_device = parse_device_id(request.args.get('cursor_device') or device)
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+
+    if not storage.available:
+        return jsonify({
+            "success": False,
+            "error": "Storage is unavailable"
+        }), 503
+
+    try:
+        devices = devices or fleet_devices()
+    except Exception as e:
+        print(f"Error listing devices for export: {e}")
+        return jsonify({
+            "success": False,
+            "error": "Storage is unavailable"
+        }), 503
+    if cursor_device not in devices:
+        return jsonify({
+            "success": False,
+            "error": "cursor_device is not being exported"
+        }), 400
+
+    resume = (cursor_device, cursor) if cursor else None
+    pages = logged_pages(iter_export_pages(devices, start, end, resume, EXPORT_PAGE_SIZE))
+    response = Response(EXPORT_ENCODERS[export_format](pages), content_type=EXPORT_FORMATS[export_format])
+    response.headers["Content-Disposition"] = f"attachment; filename=water_data.{export_format}"
+    return response
+
+
+@app.route('/data/stream')
+def data_stream():
+    """Server-Sent Events stream of newly ingested readings"""
+    try:
+        last_key = parse_key_arg('last_event_id', {
+            'last_event_id': request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        })
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": f"Last-Event-ID must be a reading key: {e}"
+        }), 400
+    missed, cursor, covered = reading_broker.snapshot(last_key)
+
+    if last_key and not covered and storage.available:
+        # The backlog does not reach back to the client's last reading; fill the gap from storage once
+        try:
+            seen = {r["timestamp"] for r in missed}
+            stored = fetch_sensor_data_since(last_key, STREAM_BACKLOG)
+            missed = sorted(missed + [r for r in stored if r["timestamp"] not in seen],
+                            key=lambda x: x["timestamp"])
+        except Exception as e:
+            print(f"Error replaying missed readings: {e}")
+
+    def generate():
+        nonlocal cursor
+        yield "retry: 3000\n\n"
+        for reading in missed:
+            yield sse_event(reading)
+        while True:
+            readings, cursor = reading_broker.wait(cursor, STREAM_HEARTBEAT)
+            if not readings:
+                yield ": heartbeat\n\n"
+            for reading in readings:
+                yield sse_event(reading)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_LATENCY.observe(time.perf_counter() - started, route=route, method=request.method)
+        REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+        if response.status_code >= 500:
+            REQUEST_ERRORS.inc(route=route, method=request.method)
+    return response
+
+
+metrics.REGISTRY.gauge("hydroai_reading_cache_hits", "Reading cache hits since start",
+                       lambda: reading_cache.stats()["hits"])
+metrics.REGISTRY.gauge("hydroai_reading_cache_misses", "Reading cache misses since start",
+                       lambda: reading_cache.stats()["misses"])
+metrics.REGISTRY.gauge("hydroai_write_buffer_pending", "Writes waiting in the write-behind buffer",
+                       lambda: write_buffer.stats()["pending"])
+metrics.REGISTRY.gauge("hydroai_write_buffer_failed_writes", "Writes that exhausted their retries",
+                       lambda: write_buffer.stats()["failed_writes"])
+metrics.REGISTRY.gauge("hydroai_write_buffer_rejected", "Submissions rejected because the buffer was full",
+                       lambda: write_buffer.stats()["rejected"])
+metrics.REGISTRY.gauge("hydroai_storage_available", "1 when the storage backend is reachable",
+                       lambda: int(bool(storage.available)))
+
+
+@app.route('/metrics')
+def metrics_api():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/debug/profile')
+def profile_api():
+    """Sample all thread stacks for ?seconds= and return the hottest collapsed stacks
+
+    Only available when PROFILER_ENABLED=1; the output can be fed to
+    flamegraph tools directly.
+    """
+    if not PROFILER_ENABLED:
+        return jsonify({"success": False, "error": "Profiler disabled; set PROFILER_ENABLED=1"}), 404
+    try:
+        seconds = float(request.args.get('seconds', 5))
+        interval = float(request.args.get('interval', 0.01))
+        top = int(request.args.get('top', 50))
+        if not 0 < seconds <= PROFILER_MAX_SECONDS or not 0.001 <= interval <= 1 or top < 1:
+            raise ValueError(f"seconds must be in (0, {PROFILER_MAX_SECONDS}], interval in [0.001, 1], top >= 1")
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    stacks = metrics.sample_stacks(seconds, interval, ignore_thread=threading.get_ident())
+    lines = [f"{stack} {count}" for stack, count in stacks.most_common(top)]
+    return Response("\n".join(lines) + "\n", content_type="text/plain; charset=utf-8")
+
+
+@app.route('/health')
+def health_api():
+    """Storage health and startup timing; 503 while the backend is unavailable"""
+    health = {
+        "storage": storage.health(),
+        "app_load_seconds": round(APP_LOAD_SECONDS, 4),
+        "ingest_owner": ingest_lock.held,
+        "uptime_seconds": round(time.perf_counter() - APP_LOAD_STARTED, 1)
+    }
+    return jsonify(health), 200 if storage.available else 503
+
+
+@app.route('/retention')
+def retention_api():
+    """Retention settings and the report of the last run"""
+    return jsonify({
+        "retention_days": RETENTION_DAYS,
+        "interval_seconds": RETENTION_INTERVAL,
+        "last_report": retention_job.last_report
+    })
+
+
+@app.route('/cache/stats')
+def cache_stats_api():
+    """Hit/miss counters for the reading cache"""
+    return jsonify(reading_cache.stats())
+
+
+def ingest_response(ticket, accepted, stored_message, failed_message, stored=None):
+    """Reply to a device write according to INGEST_MODE
+
+    In async mode the readings are acknowledged with 202 once queued, with a
+    ticket id to poll at /sensor_data/tickets/<id>. In sync mode the request
+    waits for the writer pool to store them, unless the caller already waited
+    and passes the outcome as `stored`.
+    """
+    if ticket is None:
+        return jsonify({
+            "success": False,
+            "message": failed_message
         })
-    return jsonify(formatted_readings)
+
+    if INGEST_MODE == "sync":
+        if stored is None:
+            stored = ticket.wait(INGEST_SYNC_TIMEOUT)
+        if stored:
+            return jsonify({
+                "success": True,
+                "accepted": accepted,
+                "message": stored_message
+            })
+        return jsonify({
+            "success": False,
+            "accepted": accepted,
+            "message": "Timed out waiting for storage; the data is still queued"
+        }), 504
+
+    return jsonify({
+        "success": True,
+        "accepted": accepted,
+        "message": f"{accepted} reading(s) accepted for storage",
+        "ticket": ticket.id,
+        "status_url": f"/sensor_data/tickets/{ticket.id}"
+    }), 202
 
 
 @app.route('/add_real_data', methods=['POST'])
@@ -445,11 +3353,18 @@ def add_real_data_route():
         tds = float(data.get('tds', 0))
         temperature = float(data.get('temperature', 0))
 
-        success = add_real_time_data(tds, temperature)
+        ticket = add_real_time_data(tds, temperature)
+        return ingest_response(ticket, 1, "Real data added successfully", "Failed to add real data")
+    except BufferFullError as e:
         return jsonify({
-            "success": success,
-            "message": "Real data added successfully" if success else "Failed to add real data"
-        })
+            "success": False,
+            "error": str(e)
+        }), 429
+    except IngestLockedError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 503
     except Exception as e:
         return jsonify({
             "success": False,
@@ -459,20 +3374,224 @@ def add_real_data_route():
 
 @app.route('/sensor_data', methods=['POST'])
 def receive_sensor_data():
-    """Endpoint for IoT sensors to send data"""
+    """Endpoint for IoT sensors to send data (JSON, MessagePack or binary frames)"""
+    try:
+        readings = decode_sensor_payload(request)
+        ticket = add_real_time_batch(readings)
+        return ingest_response(ticket, len(readings), "Sensor data stored successfully", "Failed to store sensor data")
+    except BufferFullError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 429
+    except IngestLockedError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 503
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+
+
+@app.route('/sensor_data/batch', methods=['POST'])
+def receive_sensor_data_batch():
+    """Endpoint for IoT sensors to send many readings in one request"""
     try:
         data = request.get_json()
+        if isinstance(data, dict):
+            data = data.get('readings')
+        if not isinstance(data, list) or not data:
+            raise ValueError("Expected a non-empty list of readings")
+        if len(data) > MAX_BATCH_READINGS:
+            raise ValueError(f"At most {MAX_BATCH_READINGS} readings per batch")
+
+        readings = with_device([parse_reading(item) for item in data], request_device(request))
+        ticket = add_real_time_batch(readings)
+        return ingest_response(ticket, len(readings), "Sensor batch stored successfully", "Failed to store sensor batch")
+    except BufferFullError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 429
+    except IngestLockedError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 503
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
 
-        # Extract sensor readings
-        tds = float(data.get('tds', 0))
-        temperature = float(data.get('temperature', 0))
 
-        # Add to Firebase
-        success = add_real_time_data(tds, temperature)
+@app.route('/fleet')
+def fleet_api():
+    """Latest reading and online status for every device
+
+    ?devices=a,b,c restricts the overview to the listed devices.
+    """
+    try:
+        devices = None
+        if request.args.get('devices'):
+            devices = list(dict.fromkeys(parse_device_id(d.strip()) for d in request.args['devices'].split(',')))
+            if len(devices) > MAX_FLEET_DEVICES:
+                raise ValueError(f"At most {MAX_FLEET_DEVICES} devices per request")
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+
+    fleet = get_fleet(devices)
+    return jsonify({
+        "devices": fleet,
+        "count": len(fleet),
+        "online": sum(entry["online"] for entry in fleet)
+    })
+
+
+@app.route('/sensor_data/buffer')
+def write_buffer_stats_api():
+    """Queue depth, write latency and flush counters for the ingest writer pool"""
+    return jsonify(write_buffer.stats())
+
+
+@app.route('/sensor_data/tickets/<int:ticket_id>')
+def write_ticket_api(ticket_id):
+    """Whether an accepted submission has been stored yet
+
+    Tickets are held per process for the last WRITE_TICKET_HISTORY submissions.
+    """
+    ticket = write_buffer.ticket(ticket_id)
+    if ticket is None:
+        return jsonify({
+            "success": False,
+            "error": "Unknown or expired ticket"
+        }), 404
+    return jsonify({
+        "success": True,
+        "ticket": ticket.id,
+        "status": "stored" if ticket.stored else "queued"
+    })
+
+
+@app.route('/anomalies')
+def anomalies_api():
+    """Anomalies flagged by the streaming detectors, oldest first
+
+    ?since=<key> returns anomalies after a reading key; ?limit caps the count.
+    """
+    try:
+        limit = int(request.args.get('limit', DEFAULT_DATA_LIMIT))
+        if limit < 1 or limit > MAX_DATA_LIMIT:
+            raise ValueError(f"limit must be between 1 and {MAX_DATA_LIMIT}")
+        since = parse_key_arg('since')
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+
+    return jsonify(get_anomalies(since, limit))
+
+
+@app.route('/alerts')
+def alerts_api():
+    """Alert events (firing and resolved), oldest first
+
+    ?since=<key> returns events after a reading key; ?limit caps the count.
+    """
+    try:
+        limit = int(request.args.get('limit', DEFAULT_DATA_LIMIT))
+        if limit < 1 or limit > MAX_DATA_LIMIT:
+            raise ValueError(f"limit must be between 1 and {MAX_DATA_LIMIT}")
+        since = parse_key_arg('since')
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+
+    return jsonify(get_alerts(since, limit))
+
+
+@app.route('/alerts/active')
+def active_alerts_api():
+    """Rules currently firing per device, with the configured rules"""
+    return jsonify({
+        "active": alert_engine.active(),
+        "rules": [rule.describe() for rule in alert_engine.index.rules.values()],
+        "pending_notifications": alert_notifier.pending()
+    })
+
+
+@app.route('/forecast')
+def forecast_api():
+    """Forecast from the online model: ?sensor=tds|temperature&hours=N&step=<minutes>"""
+    try:
+        sensor = request.args.get('sensor', 'tds')
+        if sensor not in ROLLUP_FIELDS:
+            raise ValueError("sensor must be tds or temperature")
+        hours = float(request.args.get('hours', 24))
+        if hours <= 0 or hours > MAX_FORECAST_HOURS:
+            raise ValueError(f"hours must be between 0 and {MAX_FORECAST_HOURS}")
+        step = int(request.args.get('step', 60))
+        if step < 1 or hours * 60 / step > MAX_DATA_LIMIT:
+            raise ValueError(f"step must be at least 1 minute and give at most {MAX_DATA_LIMIT} points")
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+
+    result = forecast_model.forecast(sensor, hours, step)
+    if result is None:
+        return jsonify({
+            "success": False,
+            "message": "No readings have been ingested yet"
+        }), 404
+    result["success"] = True
+    return jsonify(result)
 
+
+@app.route('/classify', methods=['POST'])
+def classify_api():
+    """Classify many readings in one call
+
+    Accepts {"tds": [...], "temperature": [...]} or {"readings": [{"tds", "temperature"}, ...]}
+    and returns band indices plus the band tables they point into. As with the
+    single-reading classifiers, 0, '-', null and empty values are No Data (band 0).
+    """
+    try:
+        data = request.get_json()
+        if 'readings' in data:
+            tds_values = [reading.get('tds', 0) for reading in data['readings']]
+            temperatures = [reading.get('temperature', 0) for reading in data['readings']]
+        else:
+            tds_values = data.get('tds', [])
+            temperatures = data.get('temperature', [0] * len(tds_values))
+        if not isinstance(tds_values, list) or not isinstance(temperatures, list):
+            raise ValueError("tds and temperature must be lists")
+        if len(tds_values) != len(temperatures):
+            raise ValueError("tds and temperature must have the same length")
+        if len(tds_values) > MAX_CLASSIFY_READINGS:
+            raise ValueError(f"At most {MAX_CLASSIFY_READINGS} readings per request")
+
+        tds_bands, temp_bands = classify_bulk(tds_values, temperatures)
+
+        level_counts = collections.Counter(TDS_QUALITY_BANDS[band]["level"] for band in tds_bands)
         return jsonify({
-            "success": success,
-            "message": "Sensor data stored successfully" if success else "Failed to store sensor data"
+            "success": True,
+            "count": len(tds_bands),
+            "tds_bands": tds_bands,
+            "temperature_bands": temp_bands,
+            "tds_band_details": [dict(band) for band in TDS_QUALITY_BANDS],
+            "temperature_band_recommendations": [list(band) for band in TEMPERATURE_RECOMMENDATION_BANDS],
+            "level_counts": dict(level_counts)
         })
     except Exception as e:
         return jsonify({
@@ -481,6 +3600,34 @@ def receive_sensor_data():
         }), 400
 
 
+@app.route('/questionnaire/bulk', methods=['POST'])
+def process_questionnaire_bulk():
+    """Score a survey campaign uploaded as CSV or NDJSON
+
+    Columns/keys source, change, test and filter hold the answers, with an
+    optional id or respondent_id. The response is NDJSON: one line per
+    respondent (omitted with ?details=0), then a summary line with score
+    distribution, tier counts and answer distributions.
+    """
+    try:
+        stream, upload_format = questionnaire_upload()
+        rows = questionnaire_rows(stream, upload_format)
+    except (ValueError, OSError) as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+
+    details = request.args.get('details', '1') != '0'
+
+    def generate():
+        try:
+            yield from score_questionnaires(rows, details)
+        finally:
+            stream.close()
+    return Response(generate(), content_type="application/x-ndjson")
+
+
 @app.route('/questionnaire', methods=['POST'])
 def process_questionnaire():
     """Process water quality questionnaire"""
@@ -489,37 +3636,12 @@ def process_questionnaire():
         score = calculate_questionnaire_score(data)
 
         # Generate recommendations based on score
-        if score >= 80:
-            recommendations = [
-                "Your water quality practices are excellent!",
-                "Continue regular maintenance and monitoring.",
-                "Consider annual professional testing to maintain standards."
-            ]
-        elif score >= 60:
-            recommendations = [
-                "Your water quality is generally good.",
-                "Consider more frequent filter changes (every 3-6 months).",
-                "Schedule professional testing within 6 months."
-            ]
-        elif score >= 40:
-            recommendations = [
-                "Your water quality needs attention.",
-                "Install or upgrade your water filtration system.",
-                "Schedule immediate professional testing.",
-                "Consider using bottled water temporarily."
-            ]
-        else:
-            recommendations = [
-                "Immediate action required for water quality.",
-                "Use bottled water for drinking immediately.",
-                "Contact water authority with concerns.",
-                "Schedule comprehensive professional testing."
-            ]
+        _, _, recommendations = QUESTIONNAIRE_TIERS[questionnaire_tier(score)]
 
         return jsonify({
             "success": True,
             "score": score,
-            "recommendations": recommendations
+            "recommendations": list(recommendations)
         })
     except Exception as e:
         return jsonify({
@@ -528,52 +3650,268 @@ def process_questionnaire():
         }), 400
 
 
-def calculate_questionnaire_score(data):
-    """Calculate score based on questionnaire responses"""
-    score = 0
-
-    # Water source scoring
-    source_scores = {
+# Points per answer; unanswered questions and unknown answers score 0
+QUESTIONNAIRE_SCORES = MappingProxyType({
+    'source': MappingProxyType({
         'municipal': 30,
         'filtered': 30,
         'bottled': 25,
         'well': 15
-    }
-
-    # Changes in water scoring
-    change_scores = {
+    }),
+    'change': MappingProxyType({
         'no': 40,
         'slight': 30,
         'noticeable': 15,
         'significant': 5
-    }
-
-    # Testing frequency scoring
-    test_scores = {
+    }),
+    'test': MappingProxyType({
         '3months': 30,
         '6months': 20,
         '1year': 10,
         'never': 0
-    }
-
-    # Filtration system scoring
-    filter_scores = {
+    }),
+    'filter': MappingProxyType({
         'ro': 30,
         'uv': 25,
         'carbon': 20,
         'none': 5
-    }
+    })
+})
+QUESTIONNAIRE_FIELDS = tuple(QUESTIONNAIRE_SCORES)
+QUESTIONNAIRE_MAX_SCORE = sum(max(points.values()) for points in QUESTIONNAIRE_SCORES.values())
+# Answer codes for bulk scoring: 0 is "other" (unanswered or unknown), then answers in table order
+QUESTIONNAIRE_CODES = MappingProxyType({
+    field: MappingProxyType({answer: code for code, answer in enumerate(points, 1)})
+    for field, points in QUESTIONNAIRE_SCORES.items()
+})
+QUESTIONNAIRE_POINTS = tuple((0,) + tuple(points.values()) for points in QUESTIONNAIRE_SCORES.values())
+
+# (minimum score, tier, recommendations), best tier first
+QUESTIONNAIRE_TIERS = (
+    (80, "excellent", (
+        "Your water quality practices are excellent!",
+        "Continue regular maintenance and monitoring.",
+        "Consider annual professional testing to maintain standards."
+    )),
+    (60, "good", (
+        "Your water quality is generally good.",
+        "Consider more frequent filter changes (every 3-6 months).",
+        "Schedule professional testing within 6 months."
+    )),
+    (40, "needs_attention", (
+        "Your water quality needs attention.",
+        "Install or upgrade your water filtration system.",
+        "Schedule immediate professional testing.",
+        "Consider using bottled water temporarily."
+    )),
+    (0, "action_required", (
+        "Immediate action required for water quality.",
+        "Use bottled water for drinking immediately.",
+        "Contact water authority with concerns.",
+        "Schedule comprehensive professional testing."
+    ))
+)
+QUESTIONNAIRE_TIER_MINIMUMS = tuple(minimum for minimum, _, _ in reversed(QUESTIONNAIRE_TIERS))
+
+QUESTIONNAIRE_CHUNK_SIZE = int(os.environ.get("QUESTIONNAIRE_CHUNK_SIZE", "5000"))
+MAX_QUESTIONNAIRE_ROWS = int(os.environ.get("MAX_QUESTIONNAIRE_ROWS", "1000000"))
+QUESTIONNAIRE_ID_FIELDS = ("id", "respondent_id")
+QUESTIONNAIRE_UPLOAD_FORMATS = {
+    "text/csv": "csv",
+    "application/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/jsonl": "ndjson"
+}
+
+
+def calculate_questionnaire_score(data):
+    """Calculate score based on questionnaire responses"""
+    return sum(points.get(data[field], 0) for field, points in QUESTIONNAIRE_SCORES.items() if field in data)
+
+
+def questionnaire_tier(score):
+    """Index into QUESTIONNAIRE_TIERS for a score"""
+    return len(QUESTIONNAIRE_TIER_MINIMUMS) - bisect.bisect_right(QUESTIONNAIRE_TIER_MINIMUMS, score)
+
+
+def score_questionnaire_chunk(answers):
+    """Scores, tier indices and answer codes for a chunk of answer tuples
+
+    Answers are looked up once into small integer codes per question, then
+    scored and tiered with NumPy array lookups when it is installed.
+    """
+    codes = [[lookup.get(row[i], 0) for row in answers] for i, lookup in enumerate(QUESTIONNAIRE_CODES.values())]
+    np = numpy_module()
+    if np is None:
+        scores = [sum(points[code] for points, code in zip(QUESTIONNAIRE_POINTS, row)) for row in zip(*codes)]
+        return scores, [questionnaire_tier(score) for score in scores], codes
+
+    codes = np.array(codes, dtype=np.intp).reshape(len(QUESTIONNAIRE_FIELDS), len(answers))
+    scores = sum(np.array(points)[field_codes] for points, field_codes in zip(QUESTIONNAIRE_POINTS, codes))
+    tiers = len(QUESTIONNAIRE_TIER_MINIMUMS) - np.searchsorted(QUESTIONNAIRE_TIER_MINIMUMS, scores, side='right')
+    return scores.tolist(), tiers.tolist(), codes
+
+
+class QuestionnaireSummary:
+    """Fixed-size running aggregates over scored responses"""
+
+    def __init__(self):
+        self.count = 0
+        self.invalid = 0
+        self.truncated = False
+        self.score_counts = [0] * (QUESTIONNAIRE_MAX_SCORE + 1)
+        self.tier_counts = [0] * len(QUESTIONNAIRE_TIERS)
+        self.answer_counts = [[0] * (len(points)) for points in QUESTIONNAIRE_POINTS]
+
+    def add(self, scores, tiers, codes):
+        np = numpy_module()
+        self.count += len(scores)
+        if np is not None:
+            for total, counts in ((self.score_counts, np.bincount(scores, minlength=len(self.score_counts))),
+                                  (self.tier_counts, np.bincount(tiers, minlength=len(self.tier_counts)))):
+                for i, n in enumerate(counts.tolist()):
+                    total[i] += n
+            for totals, field_codes in zip(self.answer_counts, codes):
+                for i, n in enumerate(np.bincount(field_codes, minlength=len(totals)).tolist()):
+                    totals[i] += n
+            return
+        for score in scores:
+            self.score_counts[score] += 1
+        for tier in tiers:
+            self.tier_counts[tier] += 1
+        for totals, field_codes in zip(self.answer_counts, codes):
+            for code in field_codes:
+                totals[code] += 1
+
+    def _percentile(self, fraction):
+        rank = fraction * (self.count - 1)
+        seen = 0
+        for score, n in enumerate(self.score_counts):
+            seen += n
+            if seen > rank:
+                return score
+
+    def result(self):
+        summary = {
+            "count": self.count,
+            "invalid": self.invalid,
+            "truncated": self.truncated,
+            "tier_counts": {tier: n for (_, tier, _), n in zip(QUESTIONNAIRE_TIERS, self.tier_counts)},
+            "score_distribution": {str(score): n for score, n in enumerate(self.score_counts) if n},
+            "answer_distribution": {
+                field: dict(zip(("other",) + tuple(QUESTIONNAIRE_SCORES[field]), counts))
+                for field, counts in zip(QUESTIONNAIRE_FIELDS, self.answer_counts)
+            }
+        }
+        if self.count:
+            summary.update({
+                "mean": round(sum(score * n for score, n in enumerate(self.score_counts)) / self.count, 2),
+                "min": next(score for score, n in enumerate(self.score_counts) if n),
+                "max": max(score for score, n in enumerate(self.score_counts) if n),
+                "median": self._percentile(0.5),
+                "p25": self._percentile(0.25),
+                "p75": self._percentile(0.75)
+            })
+        return summary
+
+
+def questionnaire_upload():
+    """(binary stream, format) for a bulk questionnaire upload: a multipart "file" or the raw body"""
+    upload = request.files.get('file')
+    if upload is not None:
+        # Take the spooled file over: closing the request would close it mid-stream
+        stream, upload.stream = upload.stream, io.BytesIO()
+        upload_format = request.args.get('format') or QUESTIONNAIRE_UPLOAD_FORMATS.get(upload.mimetype)
+        if upload_format is None and upload.filename:
+            upload_format = {"csv": "csv", "ndjson": "ndjson", "jsonl": "ndjson"}.get(
+                upload.filename.rsplit('.', 1)[-1].lower())
+    else:
+        stream = request.stream
+        upload_format = request.args.get('format') or QUESTIONNAIRE_UPLOAD_FORMATS.get(request.mimetype)
+        encoding = request.headers.get("Content-Encoding", "identity").strip().lower()
+        if encoding in ("gzip", "x-gzip"):
+            stream = gzip.GzipFile(fileobj=stream)
+        elif encoding != "identity":
+            raise ValueError(f"Unsupported Content-Encoding: {encoding}")
+    if upload_format not in ("csv", "ndjson"):
+        raise ValueError("Upload CSV (text/csv) or NDJSON (application/x-ndjson), or pass ?format=csv|ndjson")
+    return stream, upload_format
+
+
+def questionnaire_rows(stream, upload_format):
+    """Iterator of (respondent ID, answers) read a line at a time; answers is None for an invalid row
+
+    The CSV header is checked before returning so a bad upload fails before
+    the response starts.
+    """
+    text = io.TextIOWrapper(stream if isinstance(stream, io.BufferedIOBase) else io.BufferedReader(stream),
+                            encoding="utf-8-sig", newline="")
+    if upload_format == "csv":
+        reader = csv.DictReader(text)
+        if not reader.fieldnames or not set(QUESTIONNAIRE_FIELDS) & set(reader.fieldnames):
+            raise ValueError(f"CSV header must name at least one of {', '.join(QUESTIONNAIRE_FIELDS)}")
+        id_field = next((field for field in QUESTIONNAIRE_ID_FIELDS if field in reader.fieldnames), None)
+        return ((row[id_field] if id_field else line,
+                 tuple((row.get(field) or "").strip() for field in QUESTIONNAIRE_FIELDS))
+                for line, row in enumerate(reader, 1))
+
+    def ndjson_rows():
+        for line, raw in enumerate(text, 1):
+            if not raw.strip():
+                continue
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                yield line, None
+                continue
+            respondent = next((data[field] for field in QUESTIONNAIRE_ID_FIELDS if field in data), line)
+            yield respondent, tuple(data.get(field) if isinstance(data.get(field), str) else ""
+                                    for field in QUESTIONNAIRE_FIELDS)
+    return ndjson_rows()
+
+
+def score_questionnaires(rows, details=True):
+    """NDJSON lines: one {"id", "score", "tier"} per respondent in upload order, then {"summary": ...}
+
+    Responses are scored QUESTIONNAIRE_CHUNK_SIZE at a time, so memory stays
+    flat however large the upload is.
+    """
+    summary = QuestionnaireSummary()
+    rows = iter(rows)
+    while summary.count + summary.invalid < MAX_QUESTIONNAIRE_ROWS:
+        chunk = list(itertools.islice(rows, min(QUESTIONNAIRE_CHUNK_SIZE,
+                                                MAX_QUESTIONNAIRE_ROWS - summary.count - summary.invalid)))
+        if not chunk:
+            break
+        valid = [answers for _, answers in chunk if answers is not None]
+        summary.invalid += len(chunk) - len(valid)
+        scores = tiers = ()
+        if valid:
+            scores, tiers, codes = score_questionnaire_chunk(valid)
+            summary.add(scores, tiers, codes)
+        if details:
+            # Lines follow the upload's row order, invalid rows included
+            tier_names = [tier for _, tier, _ in QUESTIONNAIRE_TIERS]
+            results = zip(scores, tiers)
+            lines = []
+            for respondent, answers in chunk:
+                if answers is None:
+                    lines.append(dump_json({"id": respondent, "error": "Invalid response"}) + b"\n")
+                else:
+                    score, tier = next(results)
+                    lines.append(dump_json({"id": respondent, "score": score, "tier": tier_names[tier]}) + b"\n")
+            yield b"".join(lines)
+    else:
+        summary.truncated = next(rows, None) is not None
+    yield dump_json({"summary": summary.result()}) + b"\n"
 
-    if 'source' in data:
-        score += source_scores.get(data['source'], 0)
-    if 'change' in data:
-        score += change_scores.get(data['change'], 0)
-    if 'test' in data:
-        score += test_scores.get(data['test'], 0)
-    if 'filter' in data:
-        score += filter_scores.get(data['filter'], 0)
 
-    return score
+APP_LOAD_SECONDS = time.perf_counter() - APP_LOAD_STARTED
+metrics.REGISTRY.gauge("hydroai_app_load_seconds", "Time taken to set up the app module",
+                       lambda: APP_LOAD_SECONDS)
 
 
 # ---------- MAIN ----------
@@ -0,0 +1,575 @@
+import asyncio
+import datetime
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import request
+
+import app as sync_app
+from app import BufferFullError, IngestLockedError, reading_cache, reading_json, join_json, dump_json, storage
+from storage import STORAGE_ERRORS, STORAGE_LATENCY
+
+try:
+    import httpx
+except ImportError:  # reads go through the sync backend on worker threads
+    httpx = None
+
+
+# ---------- ASYNC SERVING MODE ----------
+#
+# An ASGI entry point for the same app. /, /data and /sensor_data run on the
+# event loop and read the Realtime Database through a pooled keep-alive
+# HTTP client, so a slow database round trip no longer ties up a worker
+# thread. /data/stream is served from the broker on the event loop too.
+# Every other route is handed to the Flask app on a worker thread; the
+# bodies of streaming responses such as /export are pulled on their own
+# bounded pool so they cannot starve the default executor.
+#
+#   uvicorn async_app:asgi_app --host 0.0.0.0 --port 5000
+#
+# `python app.py` (or any WSGI server) remains the sync fallback.
+
+ASYNC_DB_MAX_CONNECTIONS = int(os.environ.get("ASYNC_DB_MAX_CONNECTIONS", "100"))
+ASYNC_DB_MAX_KEEPALIVE = int(os.environ.get("ASYNC_DB_MAX_KEEPALIVE", "20"))
+ASYNC_DB_TIMEOUT = float(os.environ.get("ASYNC_DB_TIMEOUT", "10"))
+MAX_REQUEST_BODY = int(os.environ.get("MAX_REQUEST_BODY", str(1024 * 1024)))
+ASYNC_STREAM_WORKERS = int(os.environ.get("ASYNC_STREAM_WORKERS", "8"))
+
+FIREBASE_SCOPES = [
+    "https://www.googleapis.com/auth/firebase.database",
+    "https://www.googleapis.com/auth/userinfo.email"
+]
+
+flask_app = sync_app.app
+stream_executor = ThreadPoolExecutor(max_workers=ASYNC_STREAM_WORKERS, thread_name_prefix="wsgi-stream")
+
+
+class AsyncFirebaseClient:
+    """Realtime Database REST client sharing one pool of keep-alive connections"""
+
+    name = "firebase-rest"
+
+    def __init__(self, database_url, credential_path):
+        self.database_url = database_url.rstrip("/")
+        self.credential_path = credential_path
+        self._client = None
+        self._credentials = None
+        self._token_lock = asyncio.Lock()
+
+    def _http(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.database_url,
+                limits=httpx.Limits(max_connections=ASYNC_DB_MAX_CONNECTIONS,
+                                    max_keepalive_connections=ASYNC_DB_MAX_KEEPALIVE),
+                timeout=ASYNC_DB_TIMEOUT
+            )
+        return self._client
+
+    async def _token(self):
+        async with self._token_lock:
+            if self._credentials is None:
+                from google.oauth2 import service_account
+                self._credentials = service_account.Credentials.from_service_account_file(
+                    self.credential_path, scopes=FIREBASE_SCOPES)
+            if not self._credentials.valid:
+                # google-auth refreshes synchronously; keep it off the loop
+                from google.auth.transport.requests import Request
+                await asyncio.to_thread(self._credentials.refresh, Request())
+            return self._credentials.token
+
+    async def _request(self, method, path, params=None, body=None):
+        labels = {"backend": self.name, "operation": method.lower(), "collection": path.split("/", 1)[0]}
+        started = time.perf_counter()
+        try:
+            headers = {"Authorization": f"Bearer {await self._token()}"}
+            response = await self._http().request(method, f"/{path}.json", params=params,
+                                                  headers=headers, json=body)
+            response.raise_for_status()
+            return response.json()
+        except Exception:
+            STORAGE_ERRORS.inc(**labels)
+            raise
+        finally:
+            STORAGE_LATENCY.observe(time.perf_counter() - started, **labels)
+
+    async def get(self, path):
+        return await self._request("GET", path.strip("/"))
+
+    async def query(self, path, start_at=None, end_at=None, limit_to_first=None, limit_to_last=None):
+        params = {"orderBy": json.dumps("$key")}
+        if start_at is not None:
+            params["startAt"] = json.dumps(start_at)
+        if end_at is not None:
+            params["endAt"] = json.dumps(end_at)
+        if limit_to_first is not None:
+            params["limitToFirst"] = str(limit_to_first)
+        if limit_to_last is not None:
+            params["limitToLast"] = str(limit_to_last)
+        data = await self._request("GET", path.strip("/"), params) or {}
+        return {key: data[key] for key in sorted(data)}
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class AsyncThreadStorage:
+    """Runs a sync storage backend's calls on worker threads"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+
+    async def get(self, path):
+        return await asyncio.to_thread(self.backend.get, path)
+
+    async def query(self, path, start_at=None, end_at=None, limit_to_first=None, limit_to_last=None):
+        return await asyncio.to_thread(self.backend.query, path, start_at, end_at, limit_to_first, limit_to_last)
+
+    async def aclose(self):
+        pass
+
+
+def create_async_storage():
+    """REST client for Firebase when httpx is installed, the sync backend on threads otherwise"""
+    if sync_app.STORAGE_BACKEND == "firebase" and httpx is not None:
+        return AsyncFirebaseClient(storage.database_url, storage.credential_path)
+    return AsyncThreadStorage(storage)
+
+
+database = create_async_storage()
+fill_lock = asyncio.Lock()
+
+
+# ---------- ASYNC DATA ACCESS ----------
+
+async def get_sensor_data(limit=20):
+    """Async get_sensor_data(): the reading cache first, one fetch per loop on a miss"""
+    if not storage.available:
+        return []
+
+    cached = reading_cache.get(limit)
+    if cached is not None:
+        return cached
+
+    try:
+        async with fill_lock:
+            cached = reading_cache.get(limit, count=False)
+            if cached is not None:
+                return cached
+            data = await database.query("water_data", limit_to_last=max(limit, reading_cache.size))
+            readings = sync_app.readings_from(data)
+            reading_cache.fill(readings)
+            cached = reading_cache.get(limit, count=False)
+        return cached if cached is not None else readings[-limit:]
+    except Exception as e:
+        print(f"Error fetching sensor data: {e}")
+        return []
+
+
+async def get_sensor_data_since(key, limit):
+    if not storage.available:
+        return []
+
+    cached = reading_cache.since(key, limit)
+    if cached is not None:
+        return cached
+
+    try:
+        data = await database.query("water_data", start_at=key, limit_to_first=limit + 1)
+        return [r for r in sync_app.readings_from(data) if r["timestamp"] > key][:limit]
+    except Exception as e:
+        print(f"Error fetching readings since {key}: {e}")
+        return []
+
+
+async def get_sensor_data_before(key, limit):
+    if not storage.available:
+        return []
+
+    try:
+        data = await database.query("water_data", end_at=key, limit_to_last=limit + 1)
+        return [r for r in sync_app.readings_from(data) if r["timestamp"] < key][-limit:]
+    except Exception as e:
+        print(f"Error fetching readings before {key}: {e}")
+        return []
+
+
+async def get_sensor_data_range(start, end, limit):
+    if not storage.available:
+        return []
+
+    try:
+        data = await database.query("water_data", start_at=start, end_at=end, limit_to_first=limit)
+        return sync_app.readings_from(data)
+    except Exception as e:
+        print(f"Error fetching readings between {start} and {end}: {e}")
+        return []
+
+
+async def get_rollups(resolution, start, end, limit):
+    if not storage.available:
+        return []
+
+    start, end = sync_app.rollup_bounds(resolution, start, end)
+    try:
+        records = await database.query(f"rollups/{resolution}", start_at=start, end_at=end, limit_to_first=limit)
+    except Exception as e:
+        print(f"Error fetching {resolution} rollups: {e}")
+        records = {}
+    return sync_app.merge_rollups(resolution, start, end, limit, records)
+
+
+async def prefetch_ingest_state(readings):
+    """Fetch the rollup buckets, latest/ entries and forecast state an ingest will touch, all at once
+
+    Returns True when add_real_time_batch() can then run without storage I/O.
+    """
+    missing = sync_app.rollup_engine.missing(readings)
+    devices = sync_app.latest_index.missing(
+        reading.get("device") or sync_app.DEFAULT_DEVICE_ID for reading in readings)
+    paths = [f"rollups/{resolution}/{bucket}" for resolution, bucket in missing]
+    paths += [f"latest/{device}" for device in devices]
+    load_forecast = not sync_app.forecast_model.loaded
+    if load_forecast:
+        paths.append(sync_app.FORECAST_STATE_PATH)
+    if not paths:
+        return True
+
+    try:
+        values = await asyncio.gather(*(database.get(path) for path in paths))
+    except Exception as e:
+        print(f"Error prefetching ingest state: {e}")
+        return False
+    sync_app.rollup_engine.preload(dict(zip(missing, values)))
+    sync_app.latest_index.preload(dict(zip(devices, values[len(missing):])))
+    if load_forecast:
+        sync_app.forecast_model.preload(values[-1])
+    return True
+
+
+async def add_real_time_batch(readings):
+    if not storage.available:
+        return None
+    # Stamp now so the prefetch sees the same buckets the ingest will touch
+    now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    readings = [dict(reading, timestamp=reading.get("timestamp") or now) for reading in readings]
+    if await prefetch_ingest_state(readings):
+        return sync_app.add_real_time_batch(readings)
+    return await asyncio.to_thread(sync_app.add_real_time_batch, readings)
+
+
+# ---------- ASYNC ROUTES ----------
+
+def json_response(value, status=200):
+    return flask_app.response_class(dump_json(value), status=status, content_type="application/json")
+
+
+async def index(request):
+    readings = await get_sensor_data(1)
+    latest_reading = readings[-1] if readings else None
+    return sync_app.dashboard_response(latest_reading, request.if_none_match)
+
+
+async def data_api(request):
+    """Async /data; same query arguments as the Flask route"""
+    try:
+        limit, since, before, range_query, device = sync_app.parse_data_query(request.args)
+    except ValueError as e:
+        return json_response({
+            "success": False,
+            "error": str(e)
+        }, 400)
+
+    if device != sync_app.DEFAULT_DEVICE_ID:
+        readings = await asyncio.to_thread(sync_app.get_device_readings, device, limit, since, before, range_query)
+    elif range_query:
+        start, end, bucket = range_query
+        if bucket != 'raw':
+            return json_response(await get_rollups(bucket, start, end, limit))
+        readings = await get_sensor_data_range(start, end, limit)
+    elif before:
+        readings = await get_sensor_data_before(before, limit)
+    elif since:
+        payload = reading_cache.since_json(since, limit) if storage.available else None
+        if payload is None:
+            payload = join_json(map(reading_json, await get_sensor_data_since(since, limit)))
+        return flask_app.response_class(payload, content_type="application/json")
+    else:
+        payload = reading_cache.get_json(limit)
+        if payload is None:
+            readings = await get_sensor_data(limit)
+            payload = reading_cache.get_json(limit) or join_json(map(reading_json, readings))
+        return flask_app.response_class(payload, content_type="application/json")
+    return flask_app.response_class(join_json(map(reading_json, readings)), content_type="application/json")
+
+
+async def receive_sensor_data(request):
+    """Async /sensor_data for IoT sensors"""
+    try:
+        readings = sync_app.decode_sensor_payload(request)
+        ticket = await add_real_time_batch(readings)
+        stored = None
+        if ticket is not None and sync_app.INGEST_MODE == "sync":
+            stored = await asyncio.to_thread(ticket.wait, sync_app.INGEST_SYNC_TIMEOUT)
+        return sync_app.ingest_response(ticket, len(readings), "Sensor data stored successfully",
+                                        "Failed to store sensor data", stored)
+    except BufferFullError as e:
+        return json_response({
+            "success": False,
+            "error": str(e)
+        }, 429)
+    except IngestLockedError as e:
+        return json_response({
+            "success": False,
+            "error": str(e)
+        }, 503)
+    except Exception as e:
+        return json_response({
+            "success": False,
+            "error": str(e)
+        }, 400)
+
+
+class StreamSignal:
+    """Wakes stream clients on the event loop whenever the broker publishes
+
+    Clients take `event` before polling the broker, so a publish between the
+    poll and the wait still wakes them.
+    """
+
+    def __init__(self, loop):
+        self.event = asyncio.Event()
+        sync_app.reading_broker.add_listener(lambda: loop.call_soon_threadsafe(self._fire))
+
+    def _fire(self):
+        self.event.set()
+        self.event = asyncio.Event()
+
+
+stream_signal = None
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def serve_stream(environ, receive, send):
+    """Async /data/stream: Server-Sent Events fed from the broker on the event loop
+
+    Each client is a coroutine rather than a worker thread, so open dashboards
+    do not use up the threads shared with the Flask fallback.
+    """
+    global stream_signal
+    if stream_signal is None:
+        stream_signal = StreamSignal(asyncio.get_running_loop())
+
+    with flask_app.request_context(environ):
+        raw_key = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_key = sync_app.parse_key_arg('last_event_id', {'last_event_id': raw_key})
+    except ValueError as e:
+        sync_app.REQUESTS.inc(route="/data/stream", method="GET", status=400)
+        await send_response(send, 400, [("Content-Type", "application/json")], [dump_json({
+            "success": False,
+            "error": f"Last-Event-ID must be a reading key: {e}"
+        })])
+        return
+
+    missed, cursor, covered = sync_app.reading_broker.snapshot(last_key)
+    if last_key and not covered:
+        # The backlog does not reach back to the client's last reading; fill the gap from storage once
+        seen = {r["timestamp"] for r in missed}
+        stored = await get_sensor_data_since(last_key, sync_app.STREAM_BACKLOG)
+        missed = sorted(missed + [r for r in stored if r["timestamp"] not in seen], key=lambda x: x["timestamp"])
+
+    sync_app.REQUESTS.inc(route="/data/stream", method="GET", status=200)
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                    (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no")]
+    })
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        events = ["retry: 3000\n\n"] + [sync_app.sse_event(reading) for reading in missed]
+        await send({"type": "http.response.body", "body": "".join(events).encode(), "more_body": True})
+        while not disconnected.done():
+            published = asyncio.ensure_future(stream_signal.event.wait())
+            readings, cursor = sync_app.reading_broker.poll(cursor)
+            if not readings:
+                done, _ = await asyncio.wait({published, disconnected}, timeout=sync_app.STREAM_HEARTBEAT,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    await send({"type": "http.response.body", "body": b": heartbeat\n\n", "more_body": True})
+                published.cancel()
+                continue
+            published.cancel()
+            body = "".join(sync_app.sse_event(reading) for reading in readings).encode()
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+    finally:
+        disconnected.cancel()
+
+
+ASYNC_ROUTES = {
+    ("GET", "/"): index,
+    ("HEAD", "/"): index,
+    ("GET", "/data"): data_api,
+    ("HEAD", "/data"): data_api,
+    ("POST", "/sensor_data"): receive_sensor_data
+}
+
+
+# ---------- ASGI PLUMBING ----------
+
+def wsgi_environ(scope, body):
+    """A WSGI environ for an ASGI HTTP request whose body has been read"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": io.StringIO(),
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def read_body(receive):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > MAX_REQUEST_BODY:
+            raise ValueError("Request body too large")
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+async def send_response(send, status, headers, chunks):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+    })
+    for chunk in chunks:
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def serve_async(handler, environ, send):
+    route = environ["PATH_INFO"]
+    method = environ["REQUEST_METHOD"]
+    started = time.perf_counter()
+    with flask_app.request_context(environ):
+        response = flask_app.make_response(await handler(request))
+    status = response.status_code
+    body = b"" if method == "HEAD" else response.get_data()
+    sync_app.REQUEST_LATENCY.observe(time.perf_counter() - started, route=route, method=method)
+    sync_app.REQUESTS.inc(route=route, method=method, status=status)
+    if status >= 500:
+        sync_app.REQUEST_ERRORS.inc(route=route, method=method)
+    await send_response(send, status, response.headers.to_wsgi_list(), [body])
+
+
+async def serve_wsgi(environ, send):
+    """Run a Flask route on a worker thread, streaming its body chunk by chunk"""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+
+    result = await asyncio.to_thread(flask_app.wsgi_app, environ, start_response)
+    chunks = iter(result)
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": started["status"],
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                        for name, value in started["headers"]]
+        })
+        done = object()
+        loop = asyncio.get_running_loop()
+        while True:
+            # Streaming routes such as /export block between chunks
+            chunk = await loop.run_in_executor(stream_executor, next, chunks, done)
+            if chunk is done:
+                break
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        close = getattr(result, "close", None)
+        if close is not None:
+            await asyncio.to_thread(close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await database.aclose()
+            await asyncio.to_thread(sync_app.write_buffer.drain)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def asgi_app(scope, receive, send):
+    """ASGI application: the hot routes natively, everything else via Flask"""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    try:
+        body = await read_body(receive)
+    except ValueError as e:
+        await send_response(send, 413, [("Content-Type", "text/plain")], [str(e).encode()])
+        return
+    environ = wsgi_environ(scope, body)
+
+    if (scope["method"], scope["path"]) == ("GET", "/data/stream"):
+        await serve_stream(environ, receive, send)
+        return
+    handler = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        await serve_wsgi(environ, send)
+    else:
+        await serve_async(handler, environ, send)
@@ -0,0 +1,330 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# ---------- OFFLINE BENCHMARK AND LOAD-TEST SUITE ----------
+#
+#   python -m benchmarks.bench                       # micro + load, in-memory Firebase
+#   python -m benchmarks.bench --latency-ms 80       # simulate RTDB round trips
+#   python -m benchmarks.bench --backend sqlite      # local embedded store
+#   python -m benchmarks.bench --url http://host:5000 --skip-micro
+#   python -m benchmarks.bench --compare benchmarks/results/<earlier run>.json
+#
+# Results are written as JSON to benchmarks/results/ so runs can be compared.
+
+LOAD_MIX = (("/", 1), ("/data", 3), ("/sensor_data", 1))
+
+
+@contextlib.contextmanager
+def quiet():
+    """The app logs every write with print(); keep that out of the timings"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def seed_readings(count):
+    start = datetime.datetime(2024, 1, 1)
+    readings = {}
+    for i in range(count):
+        key = (start + datetime.timedelta(seconds=30 * i)).strftime("%Y-%m-%dT%H:%M:%S")
+        readings[key] = {"tds": round(random.uniform(40, 950), 2), "temperature": round(random.uniform(2, 55), 2)}
+    return readings
+
+
+def load_app(backend, latency_ms, readings):
+    """Import the app against an offline backend seeded with `readings` readings"""
+    os.chdir(ROOT)
+    os.environ["STORAGE_BACKEND"] = backend
+    if backend == "sqlite":
+        os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="hydroai-bench-"), "bench.db")
+
+    from benchmarks import fake_firebase
+    import storage
+    storage.FirebaseStorage._connect = lambda self: fake_firebase
+
+    with quiet():
+        import app
+
+    data = seed_readings(readings)
+    if backend == "firebase":
+        fake_firebase.reset({"water_data": data}, latency_ms / 1000.0)
+    else:
+        app.storage.update({f"water_data/{key}": value for key, value in data.items()})
+    return app
+
+
+def encode_frame(app, t0, samples):
+    """A binary /sensor_data frame for (seconds offset, tds, temperature) samples"""
+    tds0, temperature0 = round(samples[0][1] * app.TDS_SCALE), round(samples[0][2] * app.TEMPERATURE_SCALE)
+    parts = [app.FRAME_HEADER.pack(app.FRAME_MAGIC, app.FRAME_VERSION, 0, t0, tds0, temperature0)]
+    previous = (samples[0][0], tds0, temperature0)
+    for offset, tds, temperature in samples:
+        current = (offset, round(tds * app.TDS_SCALE), round(temperature * app.TEMPERATURE_SCALE))
+        parts.append(app.FRAME_SAMPLE.pack(*(c - p for c, p in zip(current, previous))))
+        previous = current
+    return b"".join(parts)
+
+
+def time_per_op(fn, number, repeat=5):
+    """Best and median microseconds per call over `repeat` rounds of `number` calls"""
+    rounds = sorted(t / number * 1e6 for t in timeit.repeat(fn, number=number, repeat=repeat))
+    return {"best_us": round(rounds[0], 3), "median_us": round(rounds[len(rounds) // 2], 3), "calls": number}
+
+
+def run_micro(app):
+    values = [random.uniform(-5, 1200) for _ in range(1000)]
+    temps = [random.uniform(-5, 70) for _ in range(1000)]
+    bulk_tds = [random.uniform(0, 1200) for _ in range(10000)]
+    bulk_temps = [random.uniform(0, 70) for _ in range(10000)]
+    window = app.get_sensor_data()
+    samples = [(10 * i, round(random.uniform(40, 950), 1), round(random.uniform(2, 55), 2)) for i in range(500)]
+    json_body = json.dumps([{"tds": tds, "temperature": temperature} for _, tds, temperature in samples]).encode()
+    frame_body = encode_frame(app, 1704067200, samples)
+    client = app.app.test_client()
+    pick = iter(range(10 ** 9))
+
+    def value():
+        return values[next(pick) % len(values)]
+
+    results = {}
+    with quiet():
+        results["get_tds_quality_details"] = time_per_op(lambda: app.get_tds_quality_details(value()), 20000)
+        results["get_temperature_recommendations"] = time_per_op(
+            lambda: app.get_temperature_recommendations(temps[next(pick) % len(temps)]), 20000)
+        results["get_improvement_suggestions"] = time_per_op(
+            lambda: app.get_improvement_suggestions(value(), temps[next(pick) % len(temps)]), 20000)
+        results["classify_bulk_10k"] = time_per_op(lambda: app.classify_bulk(bulk_tds, bulk_temps), 20)
+        results["data_api_formatting_20"] = time_per_op(
+            lambda: app.join_json(map(app.reading_json, window)), 2000)
+        results["reading_cache_get_json_20"] = time_per_op(lambda: app.reading_cache.get_json(20), 20000)
+        results["decode_json_500"] = time_per_op(lambda: app.plain_readings(json.loads(json_body)), 200)
+        results["decode_frame_500"] = time_per_op(lambda: app.decode_frame(frame_body), 200)
+        with app.app.test_request_context("/"):
+            results["get_advisory"] = time_per_op(lambda: app.get_advisory(value(), 20.0), 20000)
+        results["GET /data"] = time_per_op(lambda: client.get("/data"), 500)
+        results["GET /"] = time_per_op(lambda: client.get("/"), 200)
+    return results
+
+
+COLD_START_SCRIPT = (
+    "import sys, time\n"
+    "started = time.perf_counter()\n"
+    "import app\n"
+    "print(time.perf_counter() - started, app.APP_LOAD_SECONDS, 'firebase_admin' in sys.modules)\n"
+)
+
+
+def run_cold_start(backend, repeats):
+    """Import the app in fresh interpreters, as a newly forked worker would"""
+    env = dict(os.environ, STORAGE_BACKEND=backend)
+    imports = []
+    app_loads = []
+    sdk_imported = False
+    for _ in range(repeats):
+        if backend == "sqlite":
+            env["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="hydroai-bench-"), "bench.db")
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", COLD_START_SCRIPT], cwd=ROOT, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        total = time.perf_counter() - started
+        import_seconds, app_load_seconds, sdk = output.strip().splitlines()[-1].split()
+        imports.append((total, float(import_seconds)))
+        app_loads.append(float(app_load_seconds))
+        sdk_imported = sdk_imported or sdk == "True"
+    imports.sort()
+    return {
+        "repeats": repeats,
+        "process_ms": round(imports[len(imports) // 2][0] * 1000, 1),
+        "import_app_ms": round(imports[len(imports) // 2][1] * 1000, 1),
+        "app_load_ms": round(sorted(app_loads)[len(app_loads) // 2] * 1000, 1),
+        "firebase_admin_imported": sdk_imported
+    }
+
+
+def make_requester(app, url):
+    """Return a function performing one request against the in-process app or a live server"""
+    if url is None:
+        client = app.app.test_client()
+
+        def request(route):
+            if route == "/sensor_data":
+                payload = {"tds": round(random.uniform(40, 950), 2), "temperature": round(random.uniform(2, 55), 2)}
+                return client.post(route, json=payload).status_code
+            return client.get(route).status_code
+        return request
+
+    def request(route):
+        body = None
+        headers = {}
+        if route == "/sensor_data":
+            body = json.dumps({"tds": round(random.uniform(40, 950), 2),
+                               "temperature": round(random.uniform(2, 55), 2)}).encode()
+            headers["Content-Type"] = "application/json"
+        req = urllib.request.Request(url.rstrip("/") + route, data=body, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=30) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+    return request
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+
+
+def run_load(app, url, concurrency, duration):
+    routes = [route for route, weight in LOAD_MIX for _ in range(weight)]
+    latencies = {route: [] for route, _ in LOAD_MIX}
+    errors = {route: 0 for route, _ in LOAD_MIX}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(seed):
+        rng = random.Random(seed)
+        request = make_requester(app, url)
+        local = {route: [] for route in latencies}
+        local_errors = {route: 0 for route in errors}
+        while time.monotonic() < deadline:
+            route = rng.choice(routes)
+            started = time.perf_counter()
+            try:
+                status = request(route)
+            except Exception:
+                status = 0
+            local[route].append(time.perf_counter() - started)
+            if status >= 400 or status == 0:
+                local_errors[route] += 1
+        with lock:
+            for route in latencies:
+                latencies[route].extend(local[route])
+                errors[route] += local_errors[route]
+
+    with quiet():
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+    report = {"concurrency": concurrency, "duration_seconds": round(elapsed, 3), "routes": {}}
+    total = 0
+    for route, samples in latencies.items():
+        samples.sort()
+        total += len(samples)
+        report["routes"][route] = {
+            "requests": len(samples),
+            "errors": errors[route],
+            "throughput_rps": round(len(samples) / elapsed, 2),
+            "mean_ms": round(sum(samples) / len(samples) * 1000, 3) if samples else None,
+            "p50_ms": percentile(samples, 0.50),
+            "p95_ms": percentile(samples, 0.95),
+            "p99_ms": percentile(samples, 0.99)
+        }
+    report["total_rps"] = round(total / elapsed, 2)
+    return report
+
+
+def compare(baseline_path, results):
+    """Print current/baseline ratios for every shared timing (below 1.0 is faster)"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    print(f"\nCompared with {baseline_path}:")
+    for name, current in results.get("micro", {}).items():
+        before = baseline.get("micro", {}).get(name)
+        if before:
+            print(f"  {name:34s} {current['median_us'] / before['median_us']:6.2f}x median")
+    for name in ("process_ms", "import_app_ms"):
+        current = results.get("cold_start", {}).get(name)
+        before = baseline.get("cold_start", {}).get(name)
+        if current and before:
+            print(f"  cold start {name:23s} {current / before:6.2f}x")
+    for route, current in results.get("load", {}).get("routes", {}).items():
+        before = baseline.get("load", {}).get("routes", {}).get(route)
+        if before and before.get("p95_ms") and current.get("p95_ms"):
+            print(f"  {route:34s} {current['p95_ms'] / before['p95_ms']:6.2f}x p95")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks and load test for the water quality dashboard")
+    parser.add_argument("--backend", choices=("firebase", "sqlite"), default="firebase",
+                        help="firebase uses the in-memory stand-in; sqlite uses a temporary local store")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated Firebase round trip")
+    parser.add_argument("--readings", type=int, default=5000, help="readings to seed")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="load test length in seconds")
+    parser.add_argument("--url", help="load-test a running server instead of the in-process app")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--skip-load", action="store_true")
+    parser.add_argument("--cold-start", type=int, default=3, metavar="N",
+                        help="fresh-interpreter imports of the app to time (0 to skip)")
+    parser.add_argument("--output", help="where to write the JSON results")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    random.seed(1234)
+    app = load_app(args.backend, args.latency_ms, args.readings)
+    results = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": args.backend,
+            "latency_ms": args.latency_ms,
+            "readings": args.readings,
+            "url": args.url
+        }
+    }
+
+    if args.cold_start:
+        results["cold_start"] = run_cold_start(args.backend, args.cold_start)
+        cold = results["cold_start"]
+        print(f"cold start: process {cold['process_ms']} ms, import app {cold['import_app_ms']} ms,"
+              f" app setup {cold['app_load_ms']} ms, firebase_admin imported: {cold['firebase_admin_imported']}")
+    if not args.skip_micro:
+        results["micro"] = run_micro(app)
+        for name, timing in results["micro"].items():
+            print(f"{name:36s} {timing['median_us']:12.3f} us/op")
+    if not args.skip_load:
+        results["load"] = run_load(app, args.url, args.concurrency, args.duration)
+        for route, stats in results["load"]["routes"].items():
+            print(f"{route:14s} {stats['throughput_rps']:9.1f} req/s  p50 {stats['p50_ms']} ms"
+                  f"  p95 {stats['p95_ms']} ms  p99 {stats['p99_ms']} ms  errors {stats['errors']}")
+        print(f"total          {results['load']['total_rps']:9.1f} req/s")
+
+    output = args.output or os.path.join(
+        ROOT, "benchmarks", "results", f"bench-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        compare(args.compare, results)
+
+    app.write_buffer.drain(5)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import json
+import threading
+import time
+
+
+# ---------- IN-MEMORY FIREBASE STAND-IN ----------
+#
+# Mimics the parts of firebase_admin.db the app uses: reference(), child(),
+# order_by_key() with start_at/end_at/limit_to_first/limit_to_last, get(),
+# set(), update() and delete(). Values are JSON round-tripped like they would
+# be over the wire, and an optional per-call latency simulates the network.
+
+_root = {}
+_lock = threading.Lock()
+latency = 0.0
+calls = {"get": 0, "query": 0, "set": 0, "update": 0, "delete": 0}
+
+
+def reset(data=None, call_latency=0.0):
+    """Replace the whole database and the simulated round-trip latency (seconds)"""
+    global _root, latency
+    with _lock:
+        _root = json.loads(json.dumps(data or {}))
+        latency = call_latency
+        for name in calls:
+            calls[name] = 0
+
+
+def _round_trip(name):
+    calls[name] += 1
+    if latency:
+        time.sleep(latency)
+
+
+def _parts(path):
+    return [part for part in path.strip("/").split("/") if part]
+
+
+def _node(parts):
+    node = _root
+    for part in parts:
+        if not isinstance(node, dict) or part not in node:
+            return None
+        node = node[part]
+    return node
+
+
+def _put(parts, value):
+    if not parts:
+        raise ValueError("Cannot overwrite the database root")
+    node = _root
+    for part in parts[:-1]:
+        child = node.get(part)
+        if not isinstance(child, dict):
+            child = node[part] = {}
+        node = child
+    if value is None:
+        node.pop(parts[-1], None)
+    else:
+        node[parts[-1]] = json.loads(json.dumps(value))
+
+
+class Query:
+    def __init__(self, parts):
+        self._parts = parts
+        self._start = None
+        self._end = None
+        self._first = None
+        self._last = None
+
+    def start_at(self, value):
+        self._start = value
+        return self
+
+    def end_at(self, value):
+        self._end = value
+        return self
+
+    def limit_to_first(self, limit):
+        self._first = limit
+        return self
+
+    def limit_to_last(self, limit):
+        self._last = limit
+        return self
+
+    def get(self):
+        _round_trip("query")
+        with _lock:
+            node = _node(self._parts)
+            if not isinstance(node, dict):
+                return None
+            keys = sorted(node)
+            if self._start is not None:
+                keys = [key for key in keys if key >= self._start]
+            if self._end is not None:
+                keys = [key for key in keys if key <= self._end]
+            if self._first is not None:
+                keys = keys[:self._first]
+            if self._last is not None:
+                keys = keys[-self._last:]
+            return json.loads(json.dumps({key: node[key] for key in keys}))
+
+
+class Reference:
+    def __init__(self, parts):
+        self._parts = parts
+
+    def child(self, path):
+        return Reference(self._parts + _parts(path))
+
+    def order_by_key(self):
+        return Query(self._parts)
+
+    def get(self):
+        _round_trip("get")
+        with _lock:
+            return json.loads(json.dumps(_node(self._parts)))
+
+    def set(self, value):
+        _round_trip("set")
+        with _lock:
+            _put(self._parts, value)
+
+    def update(self, values):
+        _round_trip("update")
+        with _lock:
+            for path, value in values.items():
+                _put(self._parts + _parts(path), value)
+
+    def delete(self):
+        _round_trip("delete")
+        with _lock:
+            _put(self._parts, None)
+
+
+def reference(path="/"):
+    return Reference(_parts(path))
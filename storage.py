@@ -0,0 +1,457 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+
+
+# ---------- STORAGE BACKENDS ----------
+#
+# Every backend exposes the same small, path-based API modelled on the
+# Realtime Database:
+#
+#   get(path)                  -> value stored at path (or None)
+#   query(path, start_at=None, end_at=None, limit_to_first=None, limit_to_last=None)
+#                              -> {key: value} of path's children, ordered by key
+#   update({path: value})      -> multi-path write; a value of None deletes
+#   health()                   -> {"backend", "state", ...} for the /health route
+#
+# Records are written one level below their collection, e.g.
+# water_data/<timestamp> or rollups/hour/<bucket>.
+
+
+FIREBASE_RETRY_BASE = float(os.environ.get("FIREBASE_RETRY_BASE", "2"))
+FIREBASE_RETRY_MAX = float(os.environ.get("FIREBASE_RETRY_MAX", "60"))
+
+
+class FirebaseStorage:
+    """Storage backed by the Firebase Realtime Database
+
+    firebase_admin is imported and the client initialized on first use rather
+    than at import time. A failed initialization marks the backend unavailable
+    and keeps retrying in the background with exponential backoff, so the
+    backend recovers without a restart.
+    """
+
+    name = "firebase"
+
+    def __init__(self, credential_path, database_url):
+        self.credential_path = credential_path
+        self.database_url = database_url
+        self._db = None
+        self._lock = threading.Lock()
+        self._state = "uninitialized"
+        self._attempts = 0
+        self._last_error = None
+        self._retry_at = None
+        self._retrying = False
+        self._init_seconds = None
+
+    @property
+    def available(self):
+        # Optimistic until the first attempt, so the first real call triggers it
+        return self._state != "failed"
+
+    def _connect(self):
+        """Import the SDK and initialize the default app; returns the db module"""
+        import firebase_admin
+        from firebase_admin import credentials, db
+
+        try:
+            firebase_admin.get_app()
+        except ValueError:
+            cred = credentials.Certificate(self.credential_path)
+            firebase_admin.initialize_app(cred, {
+                'databaseURL': self.database_url
+            })
+        return db
+
+    def _initialize(self):
+        """Run one initialization attempt; the caller holds self._lock"""
+        self._attempts += 1
+        started = time.perf_counter()
+        try:
+            self._db = self._connect()
+        except Exception as e:
+            self._state = "failed"
+            self._last_error = str(e)
+            print(f"Firebase initialization failed: {e}")
+            return False
+        finally:
+            self._init_seconds = time.perf_counter() - started
+        self._state = "ready"
+        self._last_error = None
+        self._retry_at = None
+        print(f"Firebase initialized successfully in {self._init_seconds:.3f}s")
+        return True
+
+    def _schedule_retry(self):
+        """Start the background retry loop unless one is already running"""
+        if self._retrying:
+            return
+        self._retrying = True
+        self._retry_at = time.time() + FIREBASE_RETRY_BASE
+        threading.Thread(target=self._retry_loop, name="firebase-init", daemon=True).start()
+
+    def _retry_loop(self):
+        delay = FIREBASE_RETRY_BASE
+        while True:
+            time.sleep(max(0.0, self._retry_at - time.time()))
+            with self._lock:
+                if self._db is not None or self._initialize():
+                    self._retrying = False
+                    return
+                delay = min(delay * 2, FIREBASE_RETRY_MAX)
+                self._retry_at = time.time() + delay
+
+    def _client(self):
+        db = self._db
+        if db is not None:
+            return db
+        with self._lock:
+            if self._db is None and self._state != "failed":
+                if not self._initialize():
+                    self._schedule_retry()
+            if self._db is None:
+                raise RuntimeError(f"Firebase is unavailable: {self._last_error}")
+            return self._db
+
+    def start(self):
+        """Initialize in the background now instead of on the first call"""
+        threading.Thread(target=self._warm_up, name="firebase-warmup", daemon=True).start()
+
+    def _warm_up(self):
+        try:
+            self._client()
+        except RuntimeError:
+            pass
+
+    def health(self):
+        with self._lock:
+            return {
+                "backend": self.name,
+                "state": self._state,
+                "attempts": self._attempts,
+                "last_error": self._last_error,
+                "retry_in_seconds": round(max(0.0, self._retry_at - time.time()), 3) if self._retry_at else None,
+                "init_seconds": round(self._init_seconds, 4) if self._init_seconds is not None else None
+            }
+
+    def get(self, path):
+        return self._client().reference(path).get()
+
+    def query(self, path, start_at=None, end_at=None, limit_to_first=None, limit_to_last=None):
+        query = self._client().reference(path).order_by_key()
+        if start_at is not None:
+            query = query.start_at(start_at)
+        if end_at is not None:
+            query = query.end_at(end_at)
+        if limit_to_first is not None:
+            query = query.limit_to_first(limit_to_first)
+        if limit_to_last is not None:
+            query = query.limit_to_last(limit_to_last)
+        data = query.get() or {}
+        return {key: data[key] for key in sorted(data)}
+
+    def update(self, updates):
+        self._client().reference().update(updates)
+
+
+class SQLiteStorage:
+    """Local embedded storage in a SQLite database running in WAL mode
+
+    Each record is one row keyed by (parent path, key), so latest-N and
+    timestamp range scans are index range reads.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.available = False
+        self.last_error = None
+        self._local = threading.local()
+        try:
+            conn = self._connection()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS nodes ("
+                " parent TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " PRIMARY KEY (parent, key)"
+                ") WITHOUT ROWID"
+            )
+            conn.commit()
+            self.available = True
+            print(f"Local store initialized at {db_path}")
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"Local store initialization failed: {e}")
+
+    def _connection(self):
+        # sqlite3 connections are per thread; WAL lets readers run alongside the writer
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def health(self):
+        return {
+            "backend": self.name,
+            "state": "ready" if self.available else "failed",
+            "last_error": self.last_error
+        }
+
+    @staticmethod
+    def _split(path):
+        path = path.strip("/")
+        parent, _, key = path.rpartition("/")
+        return parent, key
+
+    def get(self, path):
+        path = path.strip("/")
+        parent, key = self._split(path)
+        conn = self._connection()
+        row = conn.execute("SELECT value FROM nodes WHERE parent = ? AND key = ?", (parent, key)).fetchone()
+        if row:
+            return json.loads(row[0])
+
+        # Assemble the subtree below path from its descendant rows
+        rows = conn.execute(
+            "SELECT parent, key, value FROM nodes"
+            " WHERE parent = ? OR (parent >= ? AND parent < ?)",
+            (path, path + "/", path + "0")
+        ).fetchall()
+        if not rows:
+            return None
+        tree = {}
+        for row_parent, row_key, value in rows:
+            node = tree
+            for part in row_parent[len(path):].strip("/").split("/"):
+                if part:
+                    node = node.setdefault(part, {})
+            node[row_key] = json.loads(value)
+        return tree
+
+    def query(self, path, start_at=None, end_at=None, limit_to_first=None, limit_to_last=None):
+        sql = "SELECT key, value FROM nodes WHERE parent = ?"
+        params = [path.strip("/")]
+        if start_at is not None:
+            sql += " AND key >= ?"
+            params.append(start_at)
+        if end_at is not None:
+            sql += " AND key <= ?"
+            params.append(end_at)
+        if limit_to_last is not None:
+            sql += " ORDER BY key DESC LIMIT ?"
+            params.append(limit_to_last)
+        else:
+            sql += " ORDER BY key"
+            if limit_to_first is not None:
+                sql += " LIMIT ?"
+                params.append(limit_to_first)
+
+        rows = self._connection().execute(sql, params).fetchall()
+        if limit_to_last is not None:
+            rows.reverse()
+            if limit_to_first is not None:
+                rows = rows[:limit_to_first]
+        return {key: json.loads(value) for key, value in rows}
+
+    def update(self, updates):
+        conn = self._connection()
+        with conn:
+            for path, value in updates.items():
+                path = path.strip("/")
+                parent, key = self._split(path)
+                conn.execute("DELETE FROM nodes WHERE parent = ? AND key = ?", (parent, key))
+                conn.execute(
+                    "DELETE FROM nodes WHERE parent = ? OR (parent >= ? AND parent < ?)",
+                    (path, path + "/", path + "0")
+                )
+                if value is not None:
+                    conn.execute(
+                        "INSERT INTO nodes (parent, key, value) VALUES (?, ?, ?)",
+                        (parent, key, json.dumps(value))
+                    )
+
+
+MIRROR_OUTBOX_PATH = "mirror_outbox"
+MIRROR_REPLAY_INTERVAL = float(os.environ.get("MIRROR_REPLAY_INTERVAL", "5"))
+MIRROR_REPLAY_BATCH = int(os.environ.get("MIRROR_REPLAY_BATCH", "50"))
+
+
+class MirroredStorage:
+    """Serves reads from a local store and writes through to both local and remote
+
+    A write the remote cannot take, because it is unavailable or the call
+    fails, is recorded under mirror_outbox/ in the same local transaction as
+    the write itself. A background thread replays the outbox in order once
+    the remote recovers; until it is empty, later writes queue behind it so
+    the remote never applies them out of order. health() reports the backlog.
+    """
+
+    def __init__(self, local, remote):
+        self.local = local
+        self.remote = remote
+        self.name = f"{local.name}+{remote.name}"
+        self.replayed = 0
+        self._lock = threading.Lock()
+        self._last_key = 0
+        self._last_error = None
+        self._thread = None
+        # Entries left by an earlier run are replayed as well
+        self._backlog = len(local.query(MIRROR_OUTBOX_PATH)) if local.available else 0
+        if self._backlog:
+            self._ensure_replay()
+
+    @property
+    def available(self):
+        return self.local.available
+
+    def health(self):
+        local = self.local.health()
+        with self._lock:
+            outbox = {
+                "pending": self._backlog,
+                "replayed": self.replayed,
+                "last_error": self._last_error
+            }
+        return {
+            "backend": self.name,
+            "state": local["state"],
+            "diverged": outbox["pending"] > 0,
+            "outbox": outbox,
+            "local": local,
+            "remote": self.remote.health()
+        }
+
+    def get(self, path):
+        return self.local.get(path)
+
+    def query(self, path, start_at=None, end_at=None, limit_to_first=None, limit_to_last=None):
+        return self.local.query(path, start_at, end_at, limit_to_first, limit_to_last)
+
+    def _outbox_key(self):
+        # Nanosecond keys, forced to increase, keep the outbox in write order
+        self._last_key = max(self._last_key + 1, time.time_ns())
+        return f"{self._last_key:020d}"
+
+    def _write_with_outbox(self, updates):
+        """Write locally and record the write for the remote in one local transaction; call under lock"""
+        self.local.update(dict(updates, **{f"{MIRROR_OUTBOX_PATH}/{self._outbox_key()}": {"updates": updates}}))
+        self._backlog += 1
+        self._ensure_replay()
+
+    def update(self, updates):
+        with self._lock:
+            if self._backlog or not self.remote.available:
+                self._write_with_outbox(updates)
+                return
+        self.local.update(updates)
+        try:
+            self.remote.update(updates)
+        except Exception as e:
+            print(f"Remote write failed, queued for replay: {e}")
+            with self._lock:
+                self._last_error = str(e)
+                self._write_with_outbox(updates)
+
+    def _ensure_replay(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._replay_loop, name="mirror-replay", daemon=True)
+            self._thread.start()
+
+    def _replay_loop(self):
+        while True:
+            time.sleep(MIRROR_REPLAY_INTERVAL)
+            if not self.remote.available:
+                continue
+            entries = self.local.query(MIRROR_OUTBOX_PATH, limit_to_first=MIRROR_REPLAY_BATCH)
+            for key, entry in entries.items():
+                try:
+                    self.remote.update(entry["updates"])
+                except Exception as e:
+                    with self._lock:
+                        self._last_error = str(e)
+                    break
+                with self._lock:
+                    self.local.update({f"{MIRROR_OUTBOX_PATH}/{key}": None})
+                    self._backlog -= 1
+                    self.replayed += 1
+            with self._lock:
+                if not self._backlog:
+                    self._thread = None
+                    return
+
+
+STORAGE_LATENCY = metrics.REGISTRY.histogram(
+    "hydroai_storage_call_duration_seconds", "Latency of storage backend calls",
+    ("backend", "operation", "collection"))
+STORAGE_ERRORS = metrics.REGISTRY.counter(
+    "hydroai_storage_errors_total", "Storage backend calls that raised",
+    ("backend", "operation", "collection"))
+
+
+class InstrumentedStorage:
+    """Times every call into a backend and counts the ones that fail"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        # name, available and backend-specific attributes come from the backend
+        return getattr(self.backend, name)
+
+    def _call(self, operation, collection, fn, *args):
+        labels = {"backend": self.backend.name, "operation": operation, "collection": collection}
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        except Exception:
+            STORAGE_ERRORS.inc(**labels)
+            raise
+        finally:
+            STORAGE_LATENCY.observe(time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _collection(path):
+        return path.strip("/").split("/", 1)[0]
+
+    def get(self, path):
+        return self._call("get", self._collection(path), self.backend.get, path)
+
+    def query(self, path, start_at=None, end_at=None, limit_to_first=None, limit_to_last=None):
+        return self._call("query", self._collection(path), self.backend.query,
+                          path, start_at, end_at, limit_to_first, limit_to_last)
+
+    def update(self, updates):
+        names = {self._collection(path) for path in updates}
+        collection = names.pop() if len(names) == 1 else "multi"
+        return self._call("update", collection, self.backend.update, updates)
+
+
+def create_storage(backend):
+    """Build the storage backend named by STORAGE_BACKEND"""
+    credential_path = os.environ.get("FIREBASE_CREDENTIALS", "firebase_config.json")
+    database_url = os.environ.get("FIREBASE_DATABASE_URL", "https://project-2625a-default-rtdb.firebaseio.com/")
+    sqlite_path = os.environ.get("SQLITE_PATH", "hydroai.db")
+    # Firebase connects on first use; FIREBASE_EAGER_INIT=1 starts it in the background at boot
+    eager = os.environ.get("FIREBASE_EAGER_INIT", "0") == "1"
+
+    if backend in ("firebase", "mirrored"):
+        firebase = FirebaseStorage(credential_path, database_url)
+        if eager:
+            firebase.start()
+    if backend == "firebase":
+        return InstrumentedStorage(firebase)
+    if backend == "sqlite":
+        return InstrumentedStorage(SQLiteStorage(sqlite_path))
+    if backend == "mirrored":
+        return MirroredStorage(InstrumentedStorage(SQLiteStorage(sqlite_path)), InstrumentedStorage(firebase))
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -150,31 +150,15 @@ void loop() {
     Serial.printf("Temperature: %.2f °C\n", tempValue);
     Serial.println("------------------------");
 
-    // Send data to Firebase
-    bool tdsSuccess = false;
-    bool tempSuccess = false;
-
-    // Send TDS data
-    if (Firebase.setFloat(fbdo, basePath + "/tds", tdsValue)) {
-      Serial.println("✅ TDS data sent to Firebase");
-      tdsSuccess = true;
-    } else {
-      Serial.println("❌ TDS upload failed: " + fbdo.errorReason());
-    }
-
-    // Send temperature data
-    if (Firebase.setFloat(fbdo, basePath + "/temperature", tempValue)) {
-      Serial.println("✅ Temperature data sent to Firebase");
-      tempSuccess = true;
-    } else {
-      Serial.println("❌ Temperature upload failed: " + fbdo.errorReason());
-    }
+    // Send both values as one JSON node so each sample costs a single write
+    FirebaseJson json;
+    json.set("tds", tdsValue);
+    json.set("temperature", tempValue);
 
-    // Overall status
-    if (tdsSuccess && tempSuccess) {
+    if (Firebase.setJSON(fbdo, basePath, json)) {
       Serial.println("🎉 All data successfully uploaded to Firebase!");
     } else {
-      Serial.println("⚠️ Some data failed to upload");
+      Serial.println("❌ Upload failed: " + fbdo.errorReason());
     }
 
     Serial.println("⏰ Next update in 30 seconds...");